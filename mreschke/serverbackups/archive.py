@@ -0,0 +1,231 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import tarfile
+import zlib
+from datetime import date, timedelta
+from types import SimpleNamespace as obj
+
+from . import retention
+
+# An archived snapshot folder keeps its name and only holds these two files
+ARCHIVE = 'archive.tar.gz'
+INDEX = 'archive.index.gz'
+
+# Suffixes of the folders of a conversion in progress, retention ignores both (see recover)
+BUILDING = '.archiving'
+LIVE = '.live'
+
+# Archive options (top level archive:), servers may override single keys
+DEFAULTS = {
+    'enabled': False,
+    'olderThan': 180,
+    'level': 6,
+    'memberSize': 4194304,
+    'remoteCmd': None,
+}
+
+
+def options(archive=None):
+    """Archive options merged with the defaults
+    """
+    return {**DEFAULTS, **(archive or {})}
+
+
+class _Members:
+    """Binary sink writing a multi member gzip file, cut() starts a new member
+
+    The concatenated members are one valid gzip stream (tar xzf reads the whole
+    archive), while a single file is read by decompressing only its own member.
+    """
+
+    def __init__(self, file, level, size):
+        self.file = file
+        self.level = level
+        self.size = size
+        self.position = 0  # Uncompressed bytes written
+        self.member = 0  # Compressed offset of the current member
+        self.start = 0  # Uncompressed offset of the current member
+        self._z = None
+
+    def write(self, data):
+        if self._z is None: self._z = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        self.file.write(self._z.compress(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def cut(self, force=False):
+        """Finish the current member once it holds size uncompressed bytes (or now with force)
+        """
+        if self._z is None or (not force and self.position - self.start < self.size): return
+        self.file.write(self._z.flush())
+        self._z = None
+        self.member = self.file.tell()
+        self.start = self.position
+
+
+def is_archived(snapshot):
+    """True if a snapshot folder was converted into an archive
+    """
+    return os.path.isfile(os.path.join(snapshot, INDEX))
+
+
+def build(snapshot, folder, level=6, member_size=4194304):
+    """Write the files of a live snapshot folder into folder/archive.tar.gz and its index
+    Every file starts in the gzip member open when it is reached, a member is cut once it holds
+    member_size bytes.  Hard links inside the snapshot are stored once (tar link entries).
+    Returns obj(files, bytes, archive_bytes)
+    """
+    os.makedirs(folder)
+    files = size = 0
+    with open(os.path.join(folder, ARCHIVE), 'wb') as raw, gzip.open(os.path.join(folder, INDEX), 'wt') as index:
+        members = _Members(raw, level, member_size)
+        tar = tarfile.open(fileobj=members, mode='w', format=tarfile.PAX_FORMAT)
+        for top, dirs, names in os.walk(snapshot):
+            dirs.sort()
+            for name in sorted(dirs) + sorted(names):
+                path = os.path.join(top, name)
+                info = tar.gettarinfo(path, os.path.relpath(path, snapshot))
+                if info is None: continue  # Sockets and fifos are not archived
+                members.cut()
+                member = members.member
+                if info.isreg():
+                    with open(path, 'rb') as f: tar.addfile(info, f)
+                    size += info.size
+                else:
+                    tar.addfile(info)
+                # Data ends the entry, followed by padding up to a 512 byte block
+                padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE if info.isreg() else 0
+                entry = {
+                    'path': info.name,
+                    'type': 'f' if info.isreg() else 'd' if info.isdir() else 'l' if info.issym() else 'h' if info.islnk() else 'o',
+                    'size': info.size,
+                    'mode': info.mode,
+                    'mtime': info.mtime,
+                    'member': member,
+                    'offset': members.position - padded - members.start,
+                }
+                if info.issym() or info.islnk(): entry['link'] = info.linkname
+                index.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                files += 1
+        tar.close()
+        members.cut(force=True)
+        raw.flush()
+        os.fsync(raw.fileno())
+    return obj(files=files, bytes=size, archive_bytes=os.path.getsize(os.path.join(folder, ARCHIVE)))
+
+
+def entries(snapshot):
+    """Index entries of an archived snapshot, in archive order
+    """
+    with gzip.open(os.path.join(snapshot, INDEX), 'rt') as f:
+        for line in f:
+            if line.strip(): yield json.loads(line)
+
+
+def extract(snapshot, path, out):
+    """Write one file of an archived snapshot to a binary file object, only its gzip member is read
+    """
+    path = path.strip('/')
+    found = {}
+    for entry in entries(snapshot):
+        if entry['path'] == path: found = entry; break
+    if found.get('type') == 'h':
+        # Hard links point to the first path of the inode, stored earlier in the archive
+        return extract(snapshot, found['link'], out)
+    if found.get('type') != 'f': raise OSError("{} is not a file archived in {}".format(path, snapshot))
+
+    remaining = found['size']
+    skip = found['offset']
+    z = zlib.decompressobj(31)
+    with open(os.path.join(snapshot, ARCHIVE), 'rb') as f:
+        f.seek(found['member'])
+        while remaining > 0:
+            chunk = f.read(65536)
+            data = z.decompress(chunk) if chunk else z.flush()
+            if skip:
+                cut = min(skip, len(data))
+                data = data[cut:]
+                skip -= cut
+            if data:
+                out.write(data[:remaining])
+                remaining -= min(remaining, len(data))
+            if not chunk or z.eof: break
+    if remaining: raise OSError("Archive {} ends before {}".format(os.path.join(snapshot, ARCHIVE), path))
+
+
+def read(snapshot, path):
+    """Content of one file of an archived snapshot as bytes
+    """
+    out = io.BytesIO()
+    extract(snapshot, path, out)
+    return out.getvalue()
+
+
+def discard(path, trash=None):
+    """Delete a replaced live snapshot tree, or move it into trash for the reaper
+    """
+    if not trash:
+        shutil.rmtree(path)
+        return
+    os.makedirs(trash, exist_ok=True)
+    target = os.path.join(trash, os.path.basename(path))
+    if os.path.exists(target): target += '.{}'.format(os.getpid())
+    os.rename(path, target)
+
+
+def recover(snapshots, trash=None):
+    """Finish or roll back conversions a killed archiver left in a snapshots folder
+    """
+    names = sorted(os.listdir(snapshots))
+    for name in [x for x in names if x.endswith(BUILDING)]:
+        path = os.path.join(snapshots, name)
+        live = path[:-len(BUILDING)]
+        if os.path.exists(live):
+            # Killed while building, the live snapshot is untouched
+            shutil.rmtree(path)
+        elif os.path.exists(live + LIVE):
+            # Killed between the two renames, the archive is complete
+            os.rename(path, live)
+    for name in [x for x in names if x.endswith(LIVE)]:
+        path = os.path.join(snapshots, name)
+        if is_archived(path[:-len(LIVE)]): discard(path, trash)
+
+
+def candidates(server, older_than, today=None):
+    """Names of live snapshots of a server folder older than older_than days, never the current one
+    """
+    snapshots = os.path.join(server, 'snapshots')
+    current = os.path.basename(os.path.realpath(os.path.join(server, 'current')))
+    limit = (today or date.today()) - timedelta(days=int(older_than))
+    return [
+        x.name for x in retention.parse(os.listdir(snapshots))[0]
+        if x.date < limit and x.name != current and not is_archived(os.path.join(snapshots, x.name))
+    ]
+
+
+def archive_server(server, older_than, today=None, level=6, member_size=4194304, trash=None, dryrun=False, on_archived=None):
+    """Convert the old live snapshots of one server folder, run where the snapshots are (local filesystem)
+    Each snapshot is built next to itself under a BUILDING name, then swapped in by two renames, so a
+    snapshot is always either live or completely archived under its own name.  Returns {name: obj stats}
+    """
+    snapshots = os.path.join(server, 'snapshots')
+    if not os.path.isdir(snapshots): return {}
+    if not dryrun: recover(snapshots, trash)
+    results = {}
+    for name in candidates(server, older_than, today):
+        path = os.path.join(snapshots, name)
+        if dryrun:
+            results[name] = None
+            continue
+        results[name] = build(path, path + BUILDING, level, member_size)
+        os.rename(path, path + LIVE)
+        os.rename(path + BUILDING, path)
+        discard(path + LIVE, trash)
+        if on_archived: on_archived(name, results[name])
+    return results
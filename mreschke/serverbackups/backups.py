@@ -4,7 +4,10 @@ from glob import glob
 
 import yaml
 
+from . import log, report
 from .backupserver import BackupServer
+from .scheduler import Scheduler
+from .ssh import SshPool
 from .utils import dd, dump
 
 
@@ -21,6 +24,7 @@ class Backups:
         self.config_path = None
         self.configd_path = None
         self.defaults_file = None
+        self.ssh_pool = None
 
         # Get defaults from parameter, or config path defaults.yml
         self.defaults = self.__get_defaults(servers, defaults, config_path)
@@ -33,19 +37,61 @@ class Backups:
         for server in servers:
             self.servers[server] = self.__merge_defaults(servers[server], self.defaults)
 
-    def run(self, server=None, cluster=None):
+    def run(self, server=None, cluster=None, workers=1, max_per_destination=None, max_per_source=None,
+            report_json=None, report_prometheus=None):
+        """Run backups for one server, one cluster or all servers
+        Servers run on a pool of workers (1 = one after another) and a summary of
+        every server is returned once all workers are done.  The run reports of every
+        server are optionally written as JSON and as a Prometheus textfile.
+        """
         if server:
             # Backup a single server from the config
-            if server in self.servers:
-                BackupServer(server, self.servers[server], self.defaults).run()
+            jobs = [(server, self.servers[server])] if server in self.servers else []
         elif cluster:
             # Backup all servers marked with this cluster
-            for server, options in self.servers.items():
-                if options['cluster'] == cluster:
-                    BackupServer(server, options, self.defaults).run()
+            jobs = [(name, options) for name, options in self.servers.items() if options['cluster'] == cluster]
         else:
-            for server, options in self.servers.items():
-                BackupServer(server, options, self.defaults).run()
+            jobs = list(self.servers.items())
+
+        # All servers share persistent ssh connections, so servers backing up to the same
+        # destination reuse one master connection
+        self.ssh_pool = SshPool()
+        try:
+            scheduler = Scheduler(workers, max_per_destination, max_per_source)
+            results = scheduler.run(jobs, self.server)
+        finally:
+            self.ssh_pool.close()
+            self.ssh_pool = None
+
+        self.write_reports([x['result'] for x in results if x['result']], report_json, report_prometheus)
+        return results
+
+    def write_reports(self, reports, json_file=None, prometheus_file=None):
+        """Write server run reports as JSON and as a Prometheus textfile (disabled servers are not metrics)
+        """
+        if json_file:
+            report.write(json_file, report.to_json(reports))
+            log.bullet("Run report written to {}".format(json_file))
+        if prometheus_file:
+            report.write(prometheus_file, report.to_prometheus([x for x in reports if x.status != 'disabled']))
+            log.bullet("Prometheus metrics written to {}".format(prometheus_file))
+
+    def server(self, server, options):
+        """Get a BackupServer instance for one server of this set
+        """
+        return BackupServer(server, options, self.defaults, ssh_pool=self.ssh_pool, siblings=self.siblings(server, options))
+
+    def siblings(self, server, options):
+        """Other servers of the cluster of a server backing up to the same destination folder
+        Their snapshots are on the same filesystem, so rsync can hard link against them.
+        """
+        if not options['cluster']: return []
+        key = (Scheduler.destination_key(options), options['destination']['path'].rstrip('/'))
+        return sorted(
+            name for name, x in self.servers.items()
+            if name != server and x['cluster'] == options['cluster']
+            and (Scheduler.destination_key(x), x['destination']['path'].rstrip('/')) == key
+        )
 
     def __get_defaults(self, servers, defaults, config_path):
         """Get defaults from parameter, or config path defaults.yml
@@ -98,6 +144,11 @@ class Backups:
         options.setdefault('cluster', '')
         options.setdefault('prune', {})
         options.setdefault('rsync', {})
+        options.setdefault('compression', {})
+        options.setdefault('report', {})
+        options.setdefault('store', {})
+        options.setdefault('phases', {})
+        options.setdefault('archive', {})
         options.setdefault('source', {})
         options.setdefault('destination', {})
         options['source'].setdefault('ssh', {})
@@ -121,11 +172,18 @@ class Backups:
         # Replace dictionaries
         options['prune'] = {**defaults['prune'], **options['prune']}
         options['rsync'] = {**defaults['rsync'], **options['rsync']}
+        options['compression'] = {**defaults.get('compression', {}), **options['compression']}
+        options['report'] = {**defaults.get('report', {}), **options['report']}
+        options['store'] = {**defaults.get('store', {}), **options['store']}
+        options['phases'] = {**defaults.get('phases', {}), **options['phases']}
+        options['archive'] = {**defaults.get('archive', {}), **options['archive']}
         options['source']['ssh'] = {**defaults['source']['ssh'], **options['source']['ssh']}
         options['source'] = {**defaults['source'], **options['source']}
         options['destination']['ssh'] = {**defaults['destination']['ssh'], **options['destination']['ssh']}
         options['destination'] = {**defaults['destination'], **options['destination']}
 
+        if 'binlog' in options['backup']['mysql']:
+            options['backup']['mysql']['binlog'] = {**defaults['backup']['mysql'].get('binlog', {}), **options['backup']['mysql']['binlog']}
         options['backup']['mysql'] = {**defaults['backup']['mysql'], **options['backup']['mysql']}
 
         options['backup']['preScripts'] = {**defaults['backup']['preScripts'], **options['backup']['preScripts']}
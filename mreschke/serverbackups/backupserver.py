@@ -1,13 +1,35 @@
+import hashlib
+import json
 import os
 import sys
+import shlex
 import shutil
-import subprocess
-from datetime import date, datetime, timedelta
-import calendar
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from types import SimpleNamespace as obj
 
-from . import log
-from .utils import dd, dump
+from . import archive, binlog, catalog, log, reaper, retention
+from .compression import Compression, decompress_argv
+from .graph import Graph
+from .meter import Meter, stats
+from .report import Report
+from .rsyncstats import RsyncStats
+from .runner import Runner, pipeline_string, quote
+from .ssh import SshPool
+from .store import RECIPE_EXT, STORE_DIR, Store
+from .transport import Transport
+from .utils import dd, dump, human_bytes
+from .workspace import Workspace
+
+
+# Suffix of a snapshot folder until its backup completed, retention never counts or deletes these
+PARTIAL = '.partial'
+
+# Most --link-dest folders rsync accepts
+LINK_DEST_MAX = 20
 
 
 class BackupServer:
@@ -16,8 +38,10 @@ class BackupServer:
     __author__ = "Matthew Reschke <mail@mreschke.com>"
     __license__ = "MIT"
 
-    def __init__(self, server, options, defaults=None):
+    def __init__(self, server, options, defaults=None, ssh_pool=None, siblings=None):
         """Initialize backup class
+        An ssh_pool may be shared by many servers, else one is opened and closed for this run.
+        siblings are the other servers of the cluster backing up to the same destination folder.
         """
         # This class assumes a perfact and complete options dictionary for ONE single server
         # All defaults are already merged by the handling Backups class before being passed in
@@ -26,9 +50,10 @@ class BackupServer:
         # Make option attributes for easier usage
         self.enabled = options['enabled']
         self.cluster = options['cluster']
+        self.siblings = siblings or []
         self.prune = obj(**options['prune'])
         self.rsync = obj(**options['rsync'])
-        self.rsync.exclude_file = '/tmp/backups.exclude'
+        self.transport = Transport.from_options(options['rsync'])
         self.src = obj(**options['source'])
         self.src.ssh = obj(**options['source']['ssh'])
         self.dest = obj(**options['destination'])
@@ -49,6 +74,34 @@ class BackupServer:
                     **options['backup']['postScripts'][script]
                 }))
         self.mysql = obj(**options['backup']['mysql'])
+        self.binlog = obj(**binlog.options(options['backup']['mysql'].get('binlog')))
+        self.binlog_record = None
+        self.rsync_results = None
+        self.files_complete = None
+        self.mysql_results = []
+        self.script_results = {}
+
+        # Server wide compression for dump and script outputs, each item may override it
+        self.compression = options.get('compression') or {}
+        self.available = {}
+
+        # Optional content addressed chunk store for dump and script outputs (see store.py)
+        self.store_options = options.get('store') or {}
+        self._store = None
+        self._store_lock = threading.Lock()
+
+        # Seconds between throughput reports of streamed outputs
+        self.meter_interval = 10
+
+        # Archival of old snapshots (see archive.py)
+        self.archive_options = archive.options(options.get('archive'))
+
+        # Phase ordering options (see phase_graph)
+        self.phase_options = options.get('phases') or {}
+
+        # Run report options, the report itself is built by run()
+        self.report_options = options.get('report') or {}
+        self.report = None
 
         # Set today date and time
         NOW = None
@@ -60,15 +113,31 @@ class BackupServer:
         self.src.server = server
         self.dest.server = self.src.server if self.dest.location == 'local' else self.dest.ssh.host
         self.dest.snapshot = self.now_datetime.strftime("%Y-%m-%d_%H%M%S")
-        self.dest.snapshot_path = self.path('snapshots/' + self.dest.snapshot)
+        # Snapshots are written under a staging name and only renamed to their final name once complete
+        self.dest.staging_path = self.path('snapshots/' + self.dest.snapshot + PARTIAL)
+        self.dest.snapshot_path = self.dest.staging_path
+        self.promoted = False
+
+        # Private temp folder of this run (exclude list and other local files), opened by prepare()
+        self.workspace = Workspace(server)
+
+        # Every local and remote command runs through this runner (exit codes and timings in self.runner.results)
+        self.runner = Runner()
+
+        # Persistent ssh master connections, shared with other servers if passed in
+        self.ssh_pool = ssh_pool or SshPool()
+        self.owns_ssh_pool = ssh_pool is None
 
     def run(self):
         """Run backups
+        Every phase is timed and a Report (durations, bytes, exit codes, snapshot size) is returned
         """
+        self.report = Report(self.src.server, self.cluster, self.dest.snapshot, self.src.location, self.dest.location)
+
         # Do not run if backup is disabled
         if not self.enabled:
             log.notice("Server {} configuration DISABLED, skipping server".format(self.src.server))
-            return
+            return self.report.finish('disabled')
 
         # Begin backup routine
         log.line()
@@ -83,43 +152,242 @@ class BackupServer:
         log.info((self.options))
         dump(self.options)  # Keep this one, nice output
 
-        # Prepare backup directories
-        self.prepare()
-
-        # Run pre-scripts
-        self.backup_scripts('pre', self.pre_scripts)
+        failed = True
+        try:
+            self.phase_graph().run()
+            failed = False
+        finally:
+            # Shared pools are closed by their owner
+            self.report.details = self.report_details()
+            if self.report.snapshot_bytes is None: self.estimate_snapshot_size()
+            self.report.finish('failed' if failed else None)
+            self.catalog_snapshot()
+            self.workspace.close()
+            if self._store: self._store.close()
+            if self.owns_ssh_pool: self.ssh_pool.close()
+        return self.report
+
+    def cancel(self):
+        """Kill every running command of this run, later commands fail at once as cancelled
+        """
+        self.runner.cancel()
+
+    def phase_graph(self):
+        """Get the Graph of backup phases, each phase timed into the run report
+        By default every phase waits for the previous one (prepare, pre scripts, files, mysql, post
+        scripts, snapshot size, cleanup, prune, archive).  With phases.concurrent files and mysql run at the
+        same time after the pre scripts and post scripts only wait for phases.postAfter.  Cleanup
+        always comes after everything else, so current only moves once the snapshot is done.
+        """
+        def backup_files():
+            self.backup_files()
+            return self.rsync_results['literalBytes'] if self.rsync_results else None
+
+        def snapshot_size():
+            self.report.snapshot_bytes = self.snapshot_size()
+
+        steps = [
+            ('prepare', self.prepare),
+            ('pre_scripts', lambda: self.output_bytes(self.backup_scripts('pre', self.pre_scripts))),
+            ('backup_files', backup_files),
+            ('backup_mysql', lambda: self.output_bytes(self.backup_mysql())),
+            ('post_scripts', lambda: self.output_bytes(self.backup_scripts('post', self.post_scripts))),
+        ]
+        # Size of the new snapshot, before current is moved onto it
+        if self.report_options.get('snapshotSize'): steps.append(('snapshot_size', snapshot_size))
+        steps += [
+            ('cleanup', self.cleanup),
+            ('prune_snapshots', self.prune_snapshots),
+        ]
+        if self.archive_options['enabled']: steps.append(('archive_snapshots', self.archive_snapshots))
+
+        after = {}
+        if self.phase_options.get('concurrent'):
+            names = {'pre': 'pre_scripts', 'files': 'backup_files', 'mysql': 'backup_mysql'}
+            post = []
+            for name in self.phase_options.get('postAfter') or []:
+                if name not in names: raise ValueError("Unknown phases.postAfter '{}', use pre, files or mysql".format(name))
+                post.append(names[name])
+            after = {
+                'pre_scripts': ['prepare'],
+                'backup_files': ['pre_scripts'],
+                'backup_mysql': ['pre_scripts'],
+                'post_scripts': sorted(set(['pre_scripts'] + post)),
+                'snapshot_size': ['backup_files', 'backup_mysql', 'post_scripts'],
+                'cleanup': [name for name, _ in steps if name not in ('cleanup', 'prune_snapshots', 'archive_snapshots')],
+                'prune_snapshots': ['cleanup'],
+                'archive_snapshots': ['prune_snapshots'],
+            }
+
+        # Ctrl-C only reaches the main thread running the graph, it kills the commands of the running phases
+        graph = Graph(on_interrupt=self.cancel)
+        previous = None
+        for name, func in steps:
+            graph.add(name, partial(self.run_phase, name, func), after.get(name, [previous] if previous else []))
+            previous = name
+        return graph
+
+    def run_phase(self, name, func):
+        """Run one phase inside its report phase, a returned number is the bytes written by the phase
+        """
+        with self.phase(name) as phase:
+            phase.bytes = func()
 
-        # Backup files
-        self.backup_files()
+    def phase(self, name):
+        """Time one backup phase into the run report
+        """
+        return self.report.phase(name, self.runner)
 
-        # Backup MySQL
-        self.backup_mysql()
+    def output_bytes(self, results):
+        """Total bytes written by a list of dump or script results, None if nothing was written
+        """
+        counted = [x.stats['bytes'] for x in results or [] if x.stats]
+        return sum(counted) if counted else None
 
-        # Run post-scripts
-        self.backup_scripts('post', self.post_scripts)
+    def report_details(self):
+        """Per item results of this run for the report
+        """
+        details = {'complete': self.promoted, 'rsync': self.rsync_results, 'mysql': [], 'binlog': self.binlog_record, 'scripts': []}
+        for result in self.mysql_results:
+            details['mysql'].append({
+                'name': result.name,
+                'ok': result.ok,
+                'returncode': result.returncode,
+                'duration': round(result.duration, 3),
+                'bytes': result.stats['bytes'] if result.stats else None,
+                'rawBytes': result.stats['rawBytes'] if result.stats else None,
+                'error': result.error,
+                'file': os.path.relpath(result.file, self.dest.staging_path),
+                'fingerprint': getattr(result, 'fingerprint', None),
+                'linked': getattr(result, 'linked', None),
+            })
+        for type in ('pre', 'post'):
+            for result in self.script_results.get(type, []):
+                details['scripts'].append({
+                    'name': result.name,
+                    'type': result.type,
+                    'ok': result.ok,
+                    'returncode': result.returncode,
+                    'duration': round(result.duration, 3),
+                    'bytes': result.stats['bytes'] if result.stats else None,
+                    'output': self.promoted_path(result.output),
+                    'timedOut': result.timed_out,
+                    'skipped': result.skipped,
+                })
+        return details
+
+    def catalog_snapshot(self):
+        """Append this run to the DEST catalog, only if its snapshot folder was created
+        """
+        if not self.report.phases or not self.report.phases[0].ok: return
+        try:
+            self.append_dest(self.path(catalog.CATALOG), catalog.dumps(catalog.entry(self.report)).encode())
+        except Exception as e:
+            log.error("Unable to write catalog entry for snapshot {} ({})".format(self.dest.snapshot, e))
 
-        # Cleanup old snapshots
-        self.cleanup()
+    def read_catalog(self):
+        """Get the Catalog of this server from DEST (snapshot metadata without walking the snapshots)
+        """
+        result = self.run_dest("cat {} 2>/dev/null || true".format(shlex.quote(self.path(catalog.CATALOG))), skip_logging=True)
+        return catalog.Catalog(result.stdout)
 
     def prepare(self):
         """Prepare backup system
         """
         log.header4("Preparing System")
+        # Lock this server and create the private workspace of this run
+        self.workspace.open()
+        log.bullet("Workspace {}".format(self.workspace.folder))
+
         # Create DEST snapshot directory
-        log.bullet("Creating DEST snapshot folder {}:{}".format(self.dest.server, self.dest.snapshot_path))
-        self.execute_dest("mkdir -p " + self.dest.snapshot_path)
+        # The partial link points to the snapshot being written.  If it still points to a snapshot a
+        # failed or killed run left behind, that one is resumed (rsync only sends what is missing).
+        # Its dumps are removed, they are dumped again and binary logs copied again.  The new name is checked
+        # to not exist, then a plain (portable) mv cannot move the old snapshot into a folder of that name.
+        log.bullet("Creating DEST snapshot folder {}:{}".format(self.dest.server, self.dest.staging_path))
+        result = self.execute_dest(
+            'old=$(readlink {0} 2>/dev/null || true); '
+            'if [ -n "$old" ] && [ "$old" != {1} ] && [ -d "$old" ]; then [ ! -e {1} ] && mv "$old" {1} && rm -rf {1}/mysqldump {1}/{2} && echo "$old"; fi; '
+            'mkdir -p {1} && ln -sfn {1} {0}'.format(shlex.quote(self.path('partial')), shlex.quote(self.dest.staging_path), binlog.FOLDER)
+        )
+        if result:
+            log.bullet("Resuming incomplete snapshot {}".format(result[0]))
+            # The old snapshot name is gone from disk, so it is gone from the catalog too
+            name = os.path.basename(result[0])
+            if name.endswith(PARTIAL): name = name[:-len(PARTIAL)]
+            self.append_dest(self.path(catalog.CATALOG), catalog.dumps(catalog.deleted([name])).encode())
 
     def backup_scripts(self, type, scripts):
-        """Execute script on DEST and optionally backup the output to snapshot folder
+        """Execute scripts on SRC and optionally backup their output to the snapshot folder
+        Scripts run one after another in order.  A script with parallel: True does not wait for the
+        scripts before it, after: [names] makes a script wait for other scripts and only run if they
+        succeeded.  At most phases.scriptWorkers scripts run at once, timeout kills a script after seconds.
         """
-        for script in scripts:
-            if not script.enabled: continue
-            log.header4("Running {} script '{}'".format(type.upper(), script.name))
-            output = None
-            if hasattr(script, 'output'):
-                log.bullet("Saving script output to '{}' to DEST snapshot".format(script.output))
-                output = self.dest.snapshot_path + '/' + script.output
-            self.execute(cmd=script.script, outfile=output)
+        enabled = [x for x in scripts if x.enabled]
+        names = [x.name for x in enabled]
+        results = {}
+        graph = Graph(workers=max(1, int(self.phase_options.get('scriptWorkers') or 4)))
+        for i, script in enumerate(enabled):
+            after = getattr(script, 'after', None) or []
+            if isinstance(after, str): after = [after]
+            unknown = [x for x in after if x not in [y.name for y in scripts]]
+            if unknown: raise ValueError("{} script '{}' runs after unknown scripts {}".format(type.upper(), script.name, ', '.join(unknown)))
+            # Disabled scripts never run, nothing to wait for
+            after = [x for x in after if x in names]
+            wait = after + ([] if getattr(script, 'parallel', False) else names[:i])
+            graph.add(script.name, self.runner.wrap(partial(self.run_script, type, script, after, results)), sorted(set(wait)))
+        graph.run()
+        results = [results[x] for x in names]
+        self.script_results[type] = results
+        return results
+
+    def run_script(self, type, script, after, results):
+        """Run one script (skipped if a script it runs after failed), its result is added to results
+        """
+        failed = [x for x in after if not results[x].ok]
+        if failed:
+            log.error("{} script '{}' skipped, {} failed".format(type.upper(), script.name, ', '.join(failed)))
+            results[script.name] = obj(
+                name=script.name, type=type, ok=False, returncode=None, duration=0.0, output=None, stats=None,
+                timed_out=False, skipped=True,
+            )
+            return
+
+        log.header4("Running {} script '{}'".format(type.upper(), script.name))
+        output = None
+        cmd = script.script
+        compression = None
+        # Seconds (yaml may give a string), the runner kills the script with every process it started.
+        # On ssh sources the runner only kills ssh, timeout(1) stops the script on SRC (see remote_command)
+        timeout = float(script.timeout) if getattr(script, 'timeout', None) else None
+        if hasattr(script, 'output'):
+            name = script.output
+            if getattr(script, 'compression', None):
+                # Compress the script output with the server/script codec
+                compression = self.compressor(script.compression)
+                if compression.argv(): cmd = [['sh', '-c', script.script], compression.argv()]
+                name = compression.filename(name)
+            if self.uses_store(script):
+                # Output kept in the chunk store, the snapshot only gets its recipe
+                name = script.output + RECIPE_EXT
+            log.bullet("Saving script output to '{}' to DEST snapshot".format(name))
+            output = self.dest.snapshot_path + '/' + name
+        if output and self.uses_store(script):
+            result = self.store_output(script.script, output, compression, timeout=timeout)
+        else:
+            result = self.execute(cmd=cmd, outfile=output, stream=True, timeout=timeout)
+        self.check(result, "{} script '{}'".format(type.upper(), script.name))
+        results[script.name] = obj(
+            name=script.name,
+            type=type,
+            ok=result.ok,
+            returncode=result.returncode,
+            duration=result.duration,
+            output=output,
+            stats=getattr(result, 'stats', None),
+            timed_out=result.timed_out,
+            skipped=False,
+        )
 
     def backup_files(self):
         """Backup local or remote files using rsync hardlink snapshots
@@ -131,19 +399,8 @@ class BackupServer:
         files = self.options['backup']['files']['common'] + self.options['backup']['files']['extra']
         if (not files): return
 
-        # Create exclude file for rsync
-        if os.path.exists(self.rsync.exclude_file): os.remove(self.rsync.exclude_file)
-        with open(self.rsync.exclude_file, 'w') as f: f.write('\n'.join(self.options['backup']['files']['exclude']))
-
-        # Get a string of source files.  This means many files can be backed up
-        # with a single rsync command
-        src = []
-        for file in files:
-            if self.src.location == 'local':
-                src.append(file)
-            elif self.src.location == 'ssh':
-                src.append(self.src.ssh.user + "@" + self.src.ssh.host + ":" + file)
-        src = ' '.join(src)  # Array to string rsync
+        # Create exclude file for rsync in the private workspace of this run
+        exclude_file = self.workspace.write('rsync.exclude', '\n'.join(self.options['backup']['files']['exclude']))
 
         # Get destination string
         dest = self.path()
@@ -151,40 +408,204 @@ class BackupServer:
             dest = self.dest.ssh.user + "@" + self.dest.ssh.host + ":" + dest
 
         # Snapshot folder (from dest, so either local or user@server remote)
-        snapshot = dest + '/snapshots/' + self.dest.snapshot  # Will be either local or user@server
+        snapshot = dest + '/snapshots/' + os.path.basename(self.dest.staging_path)  # Will be either local or user@server
 
-        # Current folder for rsync --link-dest, even if rsyncing to remove server this is a / local style path
+        # Folders for rsync --link-dest, even if rsyncing to remove server these are / local style paths
         # not user@server.  Rsync is smart enough to know you mean the remote servers filesystem here.
-        current = self.path('current')
-        #dd(src, dest, current, snapshot)
+        link_dests = self.link_dests()
+        #dd(src, dest, link_dests, snapshot)
 
         # Backup new snapshot
-        log.bullet("Backing up files {} to {}".format(src, snapshot))
-        params = "--archive --relative --hard-links --delete --progress --partial --compress "
-        if self.rsync.verbose:
-            params += "--verbose "
+        log.bullet("Backing up files {} to {} (transport profile {})".format(' '.join(files), snapshot, self.transport.profile))
+        # Split the files into rsync.streams groups, each group is backed up by its own rsync.
+        # With one stream many files are backed up with a single rsync command
+        streams = self.rsync_streams(files)
+
+        params = ['--archive', '--relative', '--delete', '--partial'] + self.transport.rsync_args()
+        # Parallel streams would scribble their progress over each other on the console
+        progress = ['--progress'] if len(streams) == 1 else []
+        if getattr(self.rsync, 'stats', False):
+            # Machine readable output, parsed into transfer statistics with one aggregated progress line
+            params += ['--stats', '--itemize-changes', '--info=progress2']
+        elif self.rsync.verbose:
+            params += progress + ['--verbose']
         else:
-            params += "--quiet "
+            params += progress + ['--quiet']
 
-        ssh_string = ''
+        transport = []
         if self.src.location == 'ssh':
-            ssh_string = "-e \"ssh -p {} -i {} -o LogLevel=quiet\"".format(self.src.ssh.port, self.src.ssh.key)
+            transport = ['-e', self.ssh_command('src')]
         elif self.dest.location == 'ssh':
-            ssh_string = "-e \"ssh -p {} -i {} -o LogLevel=quiet\"".format(self.dest.ssh.port, self.dest.ssh.key)
+            transport = ['-e', self.ssh_command('dest')]
+
+        # Execute rsync, every stream shares the same --link-dest and snapshot folder
+        cmds = []
+        for stream in streams:
+            src = []
+            for file in stream:
+                if self.src.location == 'local':
+                    src.append(file)
+                elif self.src.location == 'ssh':
+                    src.append(self.src.ssh.user + "@" + self.src.ssh.host + ":" + file)
+            cmds.append(['rsync'] + transport + params + ['--exclude-from=' + exclude_file] + ['--link-dest=' + x for x in link_dests] + src + [snapshot])
+
+        if len(cmds) > 1:
+            log.bullet("Running {} parallel rsync streams".format(len(cmds)))
+            with ThreadPoolExecutor(max_workers=len(cmds)) as pool:
+                results = list(pool.map(self.runner.wrap(lambda x: self.rsync_run(x[1], 'rsync[{}/{}]'.format(x[0] + 1, len(cmds)), parallel=True)), enumerate(cmds)))
+        else:
+            results = [self.rsync_run(cmds[0], 'rsync')]
+
+        # Stats of every stream folded into one
+        if getattr(self.rsync, 'stats', False):
+            self.rsync_results = RsyncStats.combine([x.stats for x in results])
+
+        # The snapshot is only complete if every stream succeeded
+        self.files_complete = all(x.ok for x in results)
+        if not self.files_complete:
+            log.error("{} of {} rsync streams failed, snapshot {} is incomplete".format(len([x for x in results if not x.ok]), len(results), self.dest.snapshot))
+
+    def link_dests(self):
+        """Get the rsync --link-dest folders of the new snapshot, current first
+        rsync.linkDestHistory adds the last N complete snapshots of this server, rsync.linkDestCluster
+        the current snapshot of every sibling in the cluster on this destination (so identical files
+        are hard linked across servers).  Rsync links from the first folder holding an identical file.
+        """
+        current = self.path('current')
+        history = int(getattr(self.rsync, 'linkDestHistory', 0) or 0)
+        siblings = self.siblings if getattr(self.rsync, 'linkDestCluster', False) else []
+        if not history and not siblings: return [current]
+
+        # One DEST round trip: the snapshot names (from the snapshot index like prune, the snapshots folder is
+        # only listed if there is no index yet), then the resolved current link of this server and each sibling.
+        # Resolved so a sibling swapping its current during this rsync does not change the candidate
+        # (with cd and pwd -P, readlink -f is missing on older BSD/macOS).
+        links = [current] + [self.dest.path + '/' + x + '/current' for x in siblings]
+        names = ''
+        if history:
+            names = "if [ -f {0} ]; then cat {0}; else ls -1 {1} 2>/dev/null; fi; ".format(
+                shlex.quote(self.path('snapshots.index')), shlex.quote(self.path('snapshots'))
+            )
+        result = self.run_dest(
+            names + "for link in {}; do [ -d \"$link\" ] && printf '%s\\t%s\\n' \"$link\" \"$(cd \"$link\" && pwd -P)\"; done; true".format(
+                ' '.join(shlex.quote(x) for x in links)
+            ), skip_logging=True
+        )
+        if not self.check(result, 'Listing --link-dest candidates'): return [current]
+        names = []
+        resolved = {}
+        for line in result.stdout:
+            if '\t' in line:
+                link, target = line.split('\t', 1)
+                resolved[link] = target
+            elif line:
+                names.append(line)
+
+        # The index only holds complete snapshots, a listing also has partial and non snapshot folders.
+        # Either way they are parsed and sorted, the newest complete snapshots come first.
+        snapshots = [self.path('snapshots/' + x.name) for x in reversed(retention.parse(names)[0])]
+        candidates = [current]
+        for folder in snapshots[:history] + [resolved[x] for x in links[1:] if x in resolved]:
+            if folder not in candidates and folder != resolved.get(current): candidates.append(folder)
+
+        # Rsync accepts at most 20 --link-dest folders
+        candidates = candidates[:LINK_DEST_MAX]
+        log.bullet("Hard linking against {} --link-dest folders ({} own snapshots, {} cluster siblings)".format(
+            len(candidates), len([x for x in candidates[1:] if x in snapshots]), len([x for x in candidates[1:] if x not in snapshots])
+        ))
+        return candidates
+
+    def rsync_run(self, cmd, name, parallel=False):
+        """Run one rsync command (always executed local, where backup script is run)
+        parallel rsync streams log their output lines instead of writing to the console
+        """
+        log.bullet4(quote(cmd))
+        if getattr(self.rsync, 'stats', False):
+            result = self.rsync_stats(cmd, name)
+        elif parallel:
+            # Lines of each stream are logged under its name
+            errors = []
+
+            def stderr(line):
+                errors.append(line)
+                log.warning("{} {}".format(name, line))
+
+            result = self.runner.run(cmd, capture=False, on_stdout=lambda line: log.info("{} {}".format(name, line)), on_stderr=stderr)
+            result.stderr = errors[-100:]
+        else:
+            # Rsync progress goes straight to the console
+            result = self.runner.run(cmd, passthrough=True)
+        self.check(result, name)
+        return result
 
-        # Execute rsync
-        try:
-            cmd = "rsync {} {} --exclude-from={} --link-dest={} {} {}".format(ssh_string, params, self.rsync.exclude_file, current, src, snapshot)
+    def rsync_streams(self, files):
+        """Partition files into rsync.streams groups
+        rsync.split 'path' balances the number of paths per stream, 'size' balances the du size
+        estimate of each path (du runs on SRC first).  Nested paths always share a stream.
+        """
+        count = max(1, int(getattr(self.rsync, 'streams', 1) or 1))
+        if count == 1 or len(files) == 1: return [files]
+
+        # Nested paths (/home/ and /home/bob/) form one unit so two streams never write the same tree
+        units = []
+        for file in sorted(files, key=lambda x: len(x.rstrip('/'))):
+            root = file.rstrip('/') + '/'
+            for unit in units:
+                if root.startswith(unit[0].rstrip('/') + '/'):
+                    unit.append(file)
+                    break
+            else:
+                units.append([file])
+
+        sizes = {}
+        if getattr(self.rsync, 'split', 'path') == 'size':
+            sizes = self.src_sizes(files)
+
+        # Largest unit first onto the least loaded stream
+        streams = [[] for _ in range(min(count, len(units)))]
+        loads = [0] * len(streams)
+        for unit in sorted(units, key=lambda x: sum(sizes.get(file, 1) for file in x), reverse=True):
+            i = loads.index(min(loads))
+            streams[i] += unit
+            loads[i] += sum(sizes.get(file, 1) for file in unit)
+
+        # Keep the configured order inside each stream
+        streams = [[x for x in files if x in stream] for stream in streams]
+        for i, stream in enumerate(streams):
+            log.bullet("rsync stream {}: {}{}".format(i + 1, ' '.join(stream), ' (~{})'.format(human_bytes(loads[i])) if sizes else ''))
+        return streams
+
+    def src_sizes(self, files):
+        """Get {path: bytes} du size estimate of each path on SRC
+        """
+        sizes = {}
+        for line in self.execute(cmd=['du', '-sk', '--'] + files, output_lines=True, skip_logging=True):
+            size, _, path = line.partition('\t')
+            if size.isdigit(): sizes[path] = int(size) * 1024
+        return {file: sizes.get(file, sizes.get(file.rstrip('/'), 0)) for file in files}
+
+    def rsync_stats(self, cmd, name='rsync'):
+        """Run rsync with --stats/--itemize-changes/--info=progress2 output parsed as it streams
+        Per file lines are counted, not kept or logged.  result.stats holds the transfer statistics.
+        """
+        parser = RsyncStats(name, interval=self.meter_interval)
+        errors = []
 
-            # Always executed local (where backup script is run)
-            log.bullet4(cmd)
-            os.system(cmd)
+        def stderr(line):
+            errors.append(line)
+            log.warning(line)
 
-        except KeyboardInterrupt:
-            exit()
+        result = self.runner.run(cmd, capture=False, on_stdout=parser.feed, on_stderr=stderr)
+        result.stderr = errors[-100:]
+        result.stats = parser.to_dict()
+        log.bullet4(parser.summary())
+        return result
 
     def backup_mysql(self):
         """Backup mysql databases and tables
+        Databases are dumped mysql.parallel at a time (largest first) and a per database
+        result is returned (and kept in self.mysql_results).  Databases in perTable mode
+        are split into one dump per table, all tables sharing the same worker pool.
         """
         log.header4("Backing up MySQL databases")
 
@@ -193,27 +614,413 @@ class BackupServer:
 
         # Always local, the self.execute below will add proper SSH output as needed
         dest = self.dest.snapshot_path + '/mysqldump'
-        self.execute_dest("mkdir -p " + dest)
-
-        # Mysql Connection
-        mysql_cmd = self.mysql.mysqlCmd
-        dump_cmd = self.mysql.dumpCmd
-        host = self.mysql.host
-        port = self.mysql.port
-        user = self.mysql.user
-        password = self.mysql.password
+        self.execute_dest(['mkdir', '-p', dest])
+
+        # Get a proper array of {name, tables[]} dictionary
+        dbs = self.mysql_databases()
+        self.mysql_compression = self.compressor(getattr(self.mysql, 'compression', None))
+
+        # Binary log mode, every run copies the binary logs closed since the previous run, databases are only dumped every binlog.fullEvery days
+        copied = []
+        if self.binlog.enabled:
+            full, copied = self.backup_binlogs()
+            if not full:
+                self.mysql_results = []
+                return copied
+        parallel = max(1, int(getattr(self.mysql, 'parallel', 1) or 1))
+        sizes = self.mysql_sizes() if parallel > 1 and len(dbs) > 1 else {}
+
+        # Change detection, databases unchanged since their previous dump are hard linked instead of dumped
+        fingerprints = self.mysql_fingerprints(dbs, parallel)
+        previous = self.mysql_previous() if any(fingerprints.values()) else {}
+
+        # Build (size, dump job) list, whole databases are one job, perTable databases one job per table
+        jobs = []
+        per_table = {}
+        linked = []
+        for db in dbs:
+            split = db.get('perTable', getattr(self.mysql, 'perTable', False))
+            file = 'mysqldump/' + (db['name'] if split else self.mysql_filename(db['name'] + '.sql'))
+            last = previous.get(db['name'])
+            if fingerprints.get(db['name']) and last and (last['fingerprint'], last['file']) == (fingerprints[db['name']], file):
+                result = self.link_unchanged(db['name'], file, last['snapshot'])
+                if result:
+                    linked.append(result)
+                    continue
+            if split:
+                per_table[db['name']] = self.mysql_tables(db)
+                self.execute_dest(['mkdir', '-p', dest + '/' + db['name']])
+                jobs.append((0, partial(self.dump_schema, db['name'], dest + '/' + db['name'])))
+                for table in per_table[db['name']]:
+                    jobs.append((table.bytes, partial(self.dump_table, db['name'], table, dest + '/' + db['name'])))
+            else:
+                jobs.append((sizes.get(db['name'], 0), partial(self.dump_database, db, dest)))
+
+        # Start the longest dumps first so one large schema or table does not finish last on its own
+        if parallel > 1 and len(jobs) > 1:
+            jobs = sorted(jobs, key=lambda job: job[0], reverse=True)
+            log.bullet("Dumping {} MySQL databases ({} dumps), {} at a time, largest first".format(len(dbs), len(jobs), parallel))
+
+        # Backup databases and tables
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            dumps = list(pool.map(self.runner.wrap(lambda job: job[1]()), jobs))
+
+        # Fold per table dumps back into one result (and manifest) per database
+        results = linked + [x for x in dumps if x.database is None]
+        for name, tables in per_table.items():
+            results.append(self.mysql_manifest(name, tables, [x for x in dumps if x.database == name], dest + '/' + name))
+        for result in results:
+            result.fingerprint = fingerprints.get(result.name)
+
+        # Per database report
+        for result in results:
+            if result.ok:
+                log.bullet("MySQL database '{}' OK in {:.1f}s".format(result.name, result.duration))
+            else:
+                log.error("MySQL database '{}' FAILED in {:.1f}s ({})".format(result.name, result.duration, result.error))
+        self.mysql_results = results
+        return results + copied
+
+    def dump_database(self, db, dest):
+        """Dump one database (all or some tables) to dest/name.sql.gz
+        """
+        name = db['name']
+        tables = db['tables']
+        if tables == '*':
+            log.bullet("Backing up MySQL database '{}', ALL tables".format(name))
+            tables = []
+        else:
+            log.bullet("Backing up MySQL database '{}', ONLY {} tables".format(name, str(len(tables))))
+        return self.mysqldump(name, self.mysql_flags() + [name] + tables, dest + '/' + self.mysql_filename(name + ".sql"))
+
+    def dump_schema(self, database, dest):
+        """Dump the table structure, views and routines of a perTable database to dest/_schema.sql.gz
+        """
+        log.bullet("Backing up MySQL database '{}' schema".format(database))
+        result = self.mysqldump(database + '._schema', self.mysql_flags() + ['--no-data', database], dest + '/' + self.mysql_filename('_schema.sql'))
+        result.database = database
+        return result
+
+    def dump_table(self, database, table, dest):
+        """Dump one table of a perTable database to dest/table.sql.gz
+        """
+        log.bullet("Backing up MySQL table '{}.{}'".format(database, table.name))
+        # Logs are flushed once by the schema dump, not again for every table
+        flags = [x for x in self.mysql_flags() if x != '--flush-logs']
+        result = self.mysqldump(database + '.' + table.name, flags + ['--no-create-db', database, table.name], dest + '/' + self.mysql_filename(table.name + '.sql'))
+        result.database = database
+        result.table = table.name
+        return result
+
+    def mysqldump(self, name, args, outfile):
+        """Run mysqldump with args on SRC into outfile on DEST
+        """
+        cmd = [shlex.split(self.mysql.dumpCmd) + self.mysql_connection() + args]
+        return self.mysql_output(name, cmd, outfile, "mysqldump of '{}'".format(name))
+
+    def mysql_output(self, name, cmd, outfile, description):
+        """Stream the output of a SRC pipeline into outfile on DEST (compressed or chunk stored) and return its result
+        """
+        # Output is piped ON MySQL server to the compressor before being sent over SSH!  Do not use the --compress option, that is only between client and server (which is localhost anyhow usually)
+        if self.uses_store(self.mysql):
+            result = self.store_output(cmd, outfile, self.mysql_compression, skip_logging=True)
+        else:
+            if self.mysql_compression.argv(): cmd.append(self.mysql_compression.argv())
+            result = self.execute(cmd=cmd, outfile=outfile, skip_logging=True, dryrun=False, stream=True)
+        self.check(result, description)
+        return obj(
+            name=name,
+            database=None,
+            file=outfile,
+            ok=result.ok,
+            returncode=result.returncode,
+            duration=result.duration,
+            stats=result.stats,
+            error=None if result.ok else (result.stderr[-1] if result.stderr else 'exit code {}'.format(result.returncode)),
+        )
+
+    def mysql_filename(self, name):
+        """Dump filename, with the compression extension or as a chunk store recipe
+        """
+        if self.uses_store(self.mysql): return name + RECIPE_EXT
+        return self.mysql_compression.filename(name)
+
+    def mysql_flags(self):
+        """Get mysqldump flags as a list
+        """
+        # --quick takes Retrieve rows for a table from the server a row at a time instead of reading entire table in memory, good for large tables
+        # --single-transaction Issue a BEGIN SQL statement before dumping data from server.  Uses a consistent read and guarantees that data seen by muysqldump does nto change
+        # --flush-logs Flush MySQL server log files before starting dump
+        # --master-data Write the binary log file name and position to the output, good if this is part of a cluster
+
+        # Dump flags are optionaly even in defaults.  I only added because MariaDB 10.1 does NOT like flush-logs
+        flags = "--quick --single-transaction --flush-logs"
+        if hasattr(self.mysql, 'dumpFlags'):
+            flags = self.mysql.dumpFlags
+        flags = shlex.split(flags)
+
+        # Binary logs are replayed from the position written into each dump
+        if self.binlog.enabled and self.binlog.positionFlag:
+            position = shlex.split(self.binlog.positionFlag)
+            if not any(x.split('=')[0] == position[0].split('=')[0] for x in flags): flags += position
+        return flags
+
+    def mysql_tables(self, db):
+        """Get [obj(name, rows, bytes)] of every base table in a database (or only db['tables'])
+        Rows are the information_schema estimate, bytes are data plus index length
+        """
+        words = self.mysql_query(
+            "SELECT table_name, COALESCE(table_rows, 0), COALESCE(data_length + index_length, 0) FROM information_schema.tables "
+            "WHERE table_schema = '{}' AND table_type = 'BASE TABLE' ORDER BY table_name".format(db['name'].replace("'", "''"))
+        )
+        tables = []
+        for name, rows, size in zip(words[0::3], words[1::3], words[2::3]):
+            if db['tables'] != '*' and name not in db['tables']: continue
+            tables.append(obj(name=name, rows=int(rows), bytes=int(size)))
+        return tables
+
+    def mysql_manifest(self, database, tables, dumps, dest):
+        """Write dest/manifest.json for a perTable database and return its combined result
+        """
+        by_table = {x.table: x for x in dumps if hasattr(x, 'table')}
+        schema = [x for x in dumps if not hasattr(x, 'table')]
+        manifest = {
+            'database': database,
+            'snapshot': self.dest.snapshot,
+            'compression': 'store' if self.uses_store(self.mysql) else self.mysql_compression.codec,
+            'schema': {'file': self.mysql_filename('_schema.sql'), 'bytes': schema[0].stats['bytes'] if schema else None},
+            'tables': [],
+        }
+        for table in tables:
+            dump = by_table.get(table.name)
+            manifest['tables'].append({
+                'name': table.name,
+                'file': self.mysql_filename(table.name + '.sql'),
+                'rows': table.rows,
+                'dataBytes': table.bytes,
+                'bytes': dump.stats['bytes'] if dump else None,
+                'rawBytes': dump.stats['rawBytes'] if dump else None,
+                'ok': dump.ok if dump else False,
+                'duration': round(dump.duration, 3) if dump else None,
+            })
+        self.write_dest(dest + '/manifest.json', json.dumps(manifest, indent=2).encode())
+
+        failed = [x for x in dumps if not x.ok]
+        return obj(
+            name=database,
+            database=None,
+            file=dest,
+            ok=not failed,
+            returncode=failed[-1].returncode if failed else 0,
+            duration=sum(x.duration for x in dumps),
+            error=', '.join('{}: {}'.format(x.name, x.error) for x in failed) or None,
+            stats={
+                'bytes': sum(x.stats['bytes'] for x in dumps),
+                'rawBytes': None,
+                'ratio': None,
+                'duration': round(sum(x.duration for x in dumps), 3),
+                'throughput': None,
+            },
+            tables=manifest['tables'],
+        )
+
+    def backup_binlogs(self):
+        """Copy the binary logs closed since the previous run into the snapshot mysqlbinlog folder
+        Returns (full, results), full is True when the databases must also be dumped this run (every
+        binlog.fullEvery days, or when the chain of binary logs since the last full dump is broken).
+        """
+        log.bullet("Copying MySQL binary logs")
+        entries = self.read_catalog().snapshots(complete=True)
+        previous = next((x['binlog'] for x in entries if x.get('binlog')), None)
+        fulls = [x for x in entries if (x.get('binlog') or {}).get('full')]
+        every = int(self.binlog.fullEvery or 0)
+        age = (self.now_date - datetime.strptime(fulls[0]['snapshot'], "%Y-%m-%d_%H%M%S").date()).days if fulls else None
+        full = age is None or age >= every
+
+        # Close the active log so everything up to now is in closed logs, the new active log is copied next run
+        names = [line.split('\t')[0] for line in self.mysql_lines('FLUSH BINARY LOGS; SHOW BINARY LOGS') if line.strip()]
+        if not names:
+            log.error("MySQL binary logging is not enabled on {}, dumping all databases".format(self.src.server))
+            return True, []
+        copy = []
+        if not previous:
+            log.bullet("No binary logs backed up yet, starting with a full dump")
+            full = True
+        elif previous['next'] not in names:
+            log.error("MySQL binary log {} was purged before it was copied, dumping all databases".format(previous['next']))
+            full = True
+        else:
+            copy = [name for name in names[:-1] if binlog.sequence(name) >= binlog.sequence(previous['next'])]
+
+        results = []
+        if copy:
+            folder = os.path.dirname(self.mysql_query('SELECT @@log_bin_basename')[0])
+            dest = self.dest.snapshot_path + '/' + binlog.FOLDER
+            self.execute_dest(['mkdir', '-p', dest])
+            parallel = max(1, int(getattr(self.mysql, 'parallel', 1) or 1))
+            with ThreadPoolExecutor(max_workers=parallel) as pool:
+                results = list(pool.map(self.runner.wrap(lambda name: self.mysql_output(
+                    name, [shlex.split(self.binlog.readCmd) + [folder + '/' + name]], dest + '/' + self.mysql_filename(name), "Copying binary log " + name
+                )), copy))
+        failed = [x.name for x in results if not x.ok]
+
+        # A failed copy is copied again next run, with everything after it
+        self.binlog_record = {
+            'full': full,
+            'files': [{'name': x.name, 'file': binlog.FOLDER + '/' + os.path.basename(x.file), 'bytes': x.stats['bytes'] if x.stats else None} for x in results if x.ok],
+            'next': failed[0] if failed else names[-1],
+            'ok': not failed,
+        }
+        log.bullet("{} binary logs copied{}, {}".format(
+            len(results) - len(failed), ', {} FAILED'.format(len(failed)) if failed else '',
+            'full dump of all databases' if full else 'incremental run, next full dump in {} days'.format(every - age),
+        ))
+        return full, results
+
+    def mysql_fingerprints(self, dbs, parallel=1):
+        """Get {database: fingerprint} of databases with changeDetection, None when changes can not be detected
+        metadata hashes create/update times, row counts and sizes of every table from information_schema.
+        A table without update time (InnoDB before MySQL 5.7 or after a restart) makes its database
+        undetectable.  checksum hashes CHECKSUM TABLE of every table, reading all data on SRC but
+        writing and sending nothing.  Changes to views or routines alone are not seen by either.
+        """
+        modes = {}
+        for db in dbs:
+            mode = db.get('changeDetection', getattr(self.mysql, 'changeDetection', 'none')) or 'none'
+            if mode not in ('none', 'metadata', 'checksum'):
+                log.warning("Unknown MySQL changeDetection '{}' for database '{}', dumping it".format(mode, db['name']))
+                continue
+            if mode != 'none': modes[db['name']] = mode
+        fingerprints = {}
+        if 'metadata' in modes.values():
+            # MySQL 8 caches information_schema statistics for a day unless told otherwise
+            version = self.mysql_query('SELECT VERSION()')
+            expiry = ''
+            if version and 'mariadb' not in version[0].lower() and int(version[0].split('.')[0]) >= 8:
+                expiry = 'SET SESSION information_schema_stats_expiry = 0; '
+            words = self.mysql_query(
+                expiry + "SET SESSION group_concat_max_len = 16777216; "
+                "SELECT table_schema, MD5(GROUP_CONCAT(CONCAT_WS(',', table_name, engine, COALESCE(create_time, ''), "
+                "COALESCE(update_time, ''), COALESCE(table_rows, ''), COALESCE(data_length, ''), COALESCE(index_length, ''), "
+                "COALESCE(auto_increment, '')) ORDER BY table_name SEPARATOR ';')), SUM(update_time IS NULL) "
+                "FROM information_schema.tables WHERE table_type = 'BASE TABLE' GROUP BY table_schema"
+            )
+            for name, digest, unknown in zip(words[0::3], words[1::3], words[2::3]):
+                if modes.get(name) == 'metadata':
+                    fingerprints[name] = 'metadata:' + digest if unknown == '0' else None
+        checksum = [name for name in sorted(modes) if modes[name] == 'checksum']
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            fingerprints.update(zip(checksum, pool.map(self.runner.wrap(self.mysql_checksum), checksum)))
+        return fingerprints
+
+    def mysql_checksum(self, database):
+        """Get the checksum fingerprint of a database, None if a table has no checksum
+        """
+        tables = self.mysql_tables({'name': database, 'tables': '*'})
+        if not tables: return None
+        words = self.mysql_query('CHECKSUM TABLE ' + ', '.join(
+            '`{}`.`{}`'.format(database.replace('`', '``'), table.name.replace('`', '``')) for table in tables
+        ))
+        if not words or 'NULL' in words: return None
+        return 'checksum:' + hashlib.md5(' '.join(words).encode()).hexdigest()
+
+    def mysql_previous(self):
+        """Get {database: catalog record plus snapshot} of the newest dump of each database, if it has a fingerprint
+        """
+        previous = {}
+        for entry in self.read_catalog().snapshots(complete=True):
+            for item in entry.get('mysql') or []:
+                previous.setdefault(item['name'], dict(item, snapshot=entry['snapshot']))
+        return {name: item for name, item in previous.items() if item['ok'] and item.get('fingerprint') and item.get('file')}
+
+    def link_unchanged(self, name, file, snapshot):
+        """Hard link the dump (file or perTable folder) of an unchanged database from a previous snapshot
+        Returns the dump result, None if the link failed and the database must be dumped
+        """
+        log.bullet("MySQL database '{}' unchanged since snapshot {}, hard linking its dump".format(name, snapshot))
+        source = self.path('snapshots/{}/{}'.format(snapshot, file))
+        target = self.dest.snapshot_path + '/' + file
+        start = time.time()
+        if self.dest.location == 'local':
+            linked = self.link_local(source, target)
+        else:
+            # ln per file (cp -al is GNU only), folders first
+            result = self.run_dest(
+                'if [ -d {0} ]; then '
+                '(cd {0} && find . -type d) | while IFS= read -r d; do mkdir -p {1}/"$d" || exit 1; done && '
+                '(cd {0} && find . ! -type d) | while IFS= read -r f; do ln {0}/"$f" {1}/"$f" || exit 1; done; '
+                'else ln {0} {1}; fi && echo OK || {{ rm -rf -- {1}; echo FAIL; }}'.format(shlex.quote(source), shlex.quote(target)),
+                skip_logging=True
+            )
+            linked = result and result.words() == ['OK']
+        if not linked:
+            log.warning("Hard linking {} failed, dumping MySQL database '{}'".format(source, name))
+            return None
+        duration = time.time() - start
+        return obj(
+            name=name,
+            database=None,
+            file=target,
+            ok=True,
+            returncode=0,
+            duration=duration,
+            stats={'bytes': 0, 'rawBytes': None, 'ratio': None, 'duration': round(duration, 3), 'throughput': None},
+            error=None,
+            linked=snapshot,
+        )
+
+    def link_local(self, source, target):
+        """Hard link a file or a folder tree on a local DEST, True if every file was linked
+        """
+        try:
+            if not os.path.isdir(source):
+                os.link(source, target)
+                return True
+            for top, dirs, files in os.walk(source):
+                folder = os.path.normpath(os.path.join(target, os.path.relpath(top, source)))
+                os.makedirs(folder, exist_ok=True)
+                for file in files: os.link(os.path.join(top, file), os.path.join(folder, file))
+            return True
+        except OSError as e:
+            log.warning("Hard linking {} to {} failed ({})".format(source, target, e))
+            if os.path.isdir(target): shutil.rmtree(target, ignore_errors=True)
+            elif os.path.lexists(target): os.remove(target)
+            return False
+
+    def mysql_connection(self):
+        """Get mysql and mysqldump connection arguments
+        """
+        return [
+            '--user={}'.format(self.mysql.user),
+            '--password={}'.format(self.mysql.password),
+            '--host={}'.format(self.mysql.host),
+            '--port={}'.format(self.mysql.port),
+        ]
+
+    def mysql_query(self, sql):
+        """Run a query with mysqlCmd on SRC and return all output words (batch mode, no column names)
+        """
+        cmd = shlex.split(self.mysql.mysqlCmd) + self.mysql_connection() + ['-Bse', sql]
+        return self.execute(cmd=cmd, output_list=True, skip_logging=True)  # Skip logging as it has password
+
+    def mysql_lines(self, sql):
+        """Run a query with mysqlCmd on SRC and return its output lines (batch mode, tab separated columns)
+        """
+        cmd = shlex.split(self.mysql.mysqlCmd) + self.mysql_connection() + ['-Bse', sql]
+        return self.execute(cmd=cmd, output_lines=True, skip_logging=True)  # Skip logging as it has password
+
+    def mysql_databases(self):
+        """Convert mysql dbs string or array into proper array of {name, tables[]} dictionary
+        """
         dbs = self.mysql.dbs
         excludeDbs = self.mysql.excludeDbs
-
-        # Convert dbs string or array into proper array of {name, tables[]} dictionary
         if isinstance(dbs, str):
             if (dbs == '*'):
                 # Convert * into dictionary of all tables on system
-                cmd = mysql_cmd + " --user={} --password='{}' --host={} --port={} -Bse 'show databases'".format(user, password, host, port)
-                databases = self.execute(cmd=cmd, output_list=True, skip_logging=True)  # Skip logging as it has password
+                databases = self.mysql_query('show databases')
                 databases = set(databases) - set(excludeDbs)  # Also dedups, now a set not a list
                 dbs = []
-                for database in databases:
+                for database in sorted(databases):
                     dbs.append({'name': database, 'tables': '*'})
             else:
                 dbs = [{'name': dbs, 'tables': '*'}]
@@ -226,87 +1033,181 @@ class BackupServer:
             for db in dbs:
                 tmpDbs.append({'name': db, 'tables': '*'})
             dbs = tmpDbs
+        return dbs
 
-        # Backup databases and tables
-        for db in dbs:
-            name = db['name']
-            tables = db['tables']
-            if tables == '*':
-                log.bullet("Backing up MySQL database '{}', ALL tables".format(name))
-                tables = ''
-            else:
-                log.bullet("Backing up MySQL database '{}', ONLY {} tables".format(name, str(len(tables))))
-                tables = ' '.join(tables)
-
-            # Backup database and all or some tables
-            # --quick takes Retrieve rows for a table from the server a row at a time instead of reading entire table in memory, good for large tables
-            # --single-transaction Issue a BEGIN SQL statement before dumping data from server.  Uses a consistent read and guarantees that data seen by muysqldump does nto change
-            # --flush-logs Flush MySQL server log files before starting dump
-            # --master-data Write the binary log file name and position to the output, good if this is part of a cluster
+    def mysql_sizes(self):
+        """Get {database: bytes} data plus index size of every database from information_schema
+        """
+        words = self.mysql_query("SELECT table_schema, COALESCE(SUM(data_length + index_length), 0) FROM information_schema.tables GROUP BY table_schema")
+        sizes = {}
+        for name, size in zip(words[0::2], words[1::2]):
+            sizes[name] = int(size) if size.isdigit() else 0
+        return sizes
+
+    def uses_store(self, item):
+        """Check if an output (mysql or one script) is kept in the chunk store, items may override store.enabled
+        """
+        enabled = getattr(item, 'store', None)
+        if enabled is None: enabled = self.store_options.get('enabled', False)
+        return bool(enabled)
 
-            # Dump flags are optionaly even in defaults.  I only added because MariaDB 10.1 does NOT like flush-logs
-            flags = "--quick --single-transaction --flush-logs"
-            if hasattr(self.mysql, 'dumpFlags'):
-                flags = self.mysql.dumpFlags
+    def chunk_store(self):
+        """Get the chunk store of the destination (created once, shared by all outputs of this run)
+        """
+        with self._store_lock:
+            if not self._store:
+                root = self.store_options.get('path') or STORE_DIR
+                if not root.startswith('/'): root = self.dest.path + '/' + root
+                self._store = Store(
+                    root,
+                    ssh=self.ssh_args('dest') if self.dest.location == 'ssh' else None,
+                    chunk_size=int(self.store_options.get('chunkSize') or 1048576),
+                    level=int(self.store_options.get('level') or 6),
+                )
+            return self._store
+
+    def store_output(self, cmd, outfile, compression=None, skip_logging=False, timeout=None):
+        """Run cmd on SRC and keep its output in the DEST chunk store, outfile gets the recipe
+        From ssh sources the output is compressed on SRC for the wire and decompressed here before
+        chunking (chunks must be cut from the raw data to dedupe).  Returns the runner Result.
+        """
+        stages = self.stages(cmd)
+        if self.src.location == 'ssh':
+            wire = compression.argv() if compression else None
+            if wire: stages.append(wire)
+            stages = [self.ssh_args('src') + [self.remote_command(cmd if isinstance(cmd, str) and not wire else pipeline_string(stages), timeout)]]
+            if wire: stages.append(decompress_argv(compression.filename('output')))
+
+        name = os.path.basename(outfile)
+        if not skip_logging: log.bullet4("{} > store:{}".format(pipeline_string(stages), outfile))
+        writer = self.chunk_store().writer(outfile)
+        meter = Meter(name, interval=self.meter_interval)
+        result = self.runner.pipeline(stages, stdout=writer, on_stderr=log.warning, meters={len(stages) - 1: meter}, timeout=timeout)
+        if not writer.close(ok=result.ok) and result.ok:
+            result.returncode = 1
+            result.stderr.append(writer.error)
+
+        # bytes is what this output added to the store, rawBytes the output itself
+        result.stats = stats(meter)
+        result.stats.update(writer.stats())
+        result.stats.update(
+            bytes=writer.stored_bytes,
+            rawBytes=meter.bytes,
+            ratio=round(meter.bytes / writer.stored_bytes, 2) if writer.stored_bytes else None,
+        )
+        log.bullet4("{} {} in {:.1f}s ({}/s), {} of {} chunks new, {} stored".format(
+            name, human_bytes(meter.bytes), result.stats['duration'], human_bytes(result.stats['throughput']),
+            writer.new_chunks, len(writer.chunks), human_bytes(writer.stored_bytes),
+        ))
+        return result
 
-            # Output is piped ON MySQL server to gzip before being sent over SSH!  Do not use the --compress option, that is only between client and server (which is localhost anyhow usually)
-            cmd = dump_cmd + " --user={} --password='{}' --host={} --port={} {} {} {} | gzip".format(user, password, host, port, flags, name, tables)
-            self.execute(cmd=cmd, outfile=dest + '/' + name + ".sql.gz", skip_logging=True, dryrun=False)
+    def compressor(self, *overrides):
+        """Get the Compression for an item, server compression options merged with item overrides
+        Falls back (pigz/zstd/xz -> gzip) when the codec is not installed on SRC, where outputs are compressed
+        """
+        compression = Compression.from_options(self.compression, *overrides)
+        while compression.cmd and not self.src_has(compression.cmd):
+            fallback = compression.fallback()
+            if not fallback: break
+            log.notice("Compression '{}' not installed on SRC {}, falling back to '{}'".format(compression.codec, self.src.server, fallback.codec))
+            compression = fallback
+        return compression
+
+    def src_has(self, cmd):
+        """Check (once) if a command is installed on SRC
+        """
+        if cmd not in self.available:
+            self.available[cmd] = bool(self.execute(cmd='command -v ' + shlex.quote(cmd), output_list=True, skip_logging=True))
+        return self.available[cmd]
 
     def cleanup(self):
-        """Cleanup old snapshots
+        """Promote the new snapshot to its final name and symlink current to it
         """
         log.header4("Cleaning up system and symlinking current snapshot")
 
-        # Delete rsync exclude file
-        if os.path.exists(self.rsync.exclude_file): os.remove(self.rsync.exclude_file)
+        # Current is the --link-dest of the next run, so only a complete file backup is promoted and becomes current
+        if self.files_complete is False:
+            log.error("Snapshot {} is incomplete, it is resumed by the next run and current still points to the previous snapshot".format(self.dest.snapshot))
+            return
 
-        # Define backup directories
+        # Rename the snapshot to its final name, then atomically swap the current symlink to it (a new link
+        # renamed over the old one, so current never disappears or points to a half written snapshot)
+        # and record it in the DEST snapshot index (if there is no index yet prune builds one)
+        final = self.path('snapshots/' + self.dest.snapshot)
         current = self.path('current')
-        snapshots = self.path('snapshots')
-
-        # Symlink latest snapshot to current link
-        # Only difference is on remote, the $() is escaped
+        tmp = self.path('.current.tmp')
+        index = self.path('snapshots.index')
+        log.bullet("Promoting snapshot {} and pointing current to it".format(self.dest.snapshot))
         if self.dest.location == 'local':
-            cmd = "ln -snf $(ls -1d {}/* | tail -n1) {}".format(snapshots, current)
+            # In python, mv -T is GNU only and BSD/macOS mv follows a symlink to a folder
+            ok = self.promote_local(final, current, tmp, index)
         else:
-            cmd = "ln -snf \\$(ls -1d {}/* | tail -n1) {}".format(snapshots, current)
-        self.execute_dest(cmd)
+            # GNU mv on ssh destinations, the final name is checked first so mv never moves into a folder
+            result = self.run_dest(
+                "[ ! -e {1} ] && mv -T {0} {1} && rm -f {2} && ln -sfn {1} {3} && mv -Tf {3} {4} && {{ [ ! -f {5} ] || echo {6} >> {5}; }}".format(
+                    shlex.quote(self.dest.staging_path), shlex.quote(final), shlex.quote(self.path('partial')),
+                    shlex.quote(tmp), shlex.quote(current), shlex.quote(index), shlex.quote(self.dest.snapshot)
+                )
+            )
+            ok = self.check(result, 'Promoting snapshot ' + self.dest.snapshot)
+        if ok:
+            self.dest.snapshot_path = final
+            self.promoted = True
+
+    def promote_local(self, final, current, tmp, index):
+        """Rename the snapshot on a local DEST and replace current by a new symlink in one rename
+        """
+        log.bullet4("rename {} {}, symlink {} -> {}".format(self.dest.staging_path, final, current, final))
+        try:
+            if os.path.lexists(final): raise OSError("{} already exists".format(final))
+            os.rename(self.dest.staging_path, final)
+            for path in (self.path('partial'), tmp):
+                if os.path.lexists(path): os.remove(path)
+            os.symlink(final, tmp)
+            os.replace(tmp, current)
+            if os.path.isfile(index):
+                with open(index, 'a') as f: f.write(self.dest.snapshot + '\n')
+        except OSError as e:
+            log.error("Promoting snapshot {} failed ({})".format(self.dest.snapshot, e))
+            return False
+        return True
+
+    def promoted_path(self, path):
+        """Path of a file written into the staging folder, under the final snapshot name once promoted
+        """
+        if not path or not path.startswith(self.dest.staging_path + '/'): return path
+        return self.dest.snapshot_path + path[len(self.dest.staging_path):]
 
-        # Prune old snapshots according to daily, weekly, monthly and yearly prune variables
-        self.prune_snapshots()
+    def snapshot_size(self):
+        """Disk bytes used by the new snapshot on DEST
+        du counts hard linked files once, so files unchanged since current are not counted
+        """
+        current = self.path('current')
+        result = self.run_dest("du -sk {}/ {} 2>/dev/null; true".format(shlex.quote(current), shlex.quote(self.dest.snapshot_path)))
+        for line in result.stdout if result else []:
+            size, _, path = line.partition('\t')
+            if path.rstrip('/') == self.dest.snapshot_path and size.isdigit():
+                log.bullet("Snapshot {} uses {}".format(self.dest.snapshot, human_bytes(int(size) * 1024)))
+                return int(size) * 1024
+        return None
+
+    def estimate_snapshot_size(self):
+        """Estimate the bytes the new snapshot adds on DEST without walking it (report.snapshotSize off)
+        Files rsync transferred (only known with rsync.stats) plus the bytes of every dump and output
+        """
+        counted = [self.rsync_results['transferredFileSize']] if self.rsync_results else []
+        results = self.mysql_results + self.script_results.get('pre', []) + self.script_results.get('post', [])
+        counted += [x.stats['bytes'] for x in results if x.stats]
+        counted = [x for x in counted if x is not None]
+        if not counted: return
+        self.report.snapshot_bytes = sum(counted)
+        self.report.snapshot_estimated = True
 
     def prune_snapshots(self):
         """Prune old snapshots according to daily, weekly, monthly and yearly prune variables
         """
         log.header4("Pruning Snapshots (keepDaily:{}, keepWeekly:{}, keepMonthly:{}, keepYearly:{})".format(self.prune.keepDaily, self.prune.keepWeekly, self.prune.keepMonthly, self.prune.keepYearly))
 
-        # Define snapshot date parser helper
-        def dates(snapshot):
-            # Snapshot date and snapshot time, and weekday
-            # Get snapshot dates (sd=date, st=time, wd=weekday 0-6)
-
-            # Snapshot date - datetime.date(2018, 1, 1)
-            sd = date(int(snapshot[0:4]), int(snapshot[5:7]), int(snapshot[8:10]))
-
-            # Snapshot time - 8152 (thats 08152 as int)
-            st = int(snapshot[11:-1])
-
-            # Snapshot day of week - 0=Sunday, 6=Saturday
-            wd = int(sd.strftime("%w"))
-
-            # Last day of the snapshots week (Saturday)
-            ldw = sd + timedelta(days=6-wd)
-
-            # Last day of the snapshots month
-            ldm = date(sd.year, sd.month, calendar.monthrange(sd.year, sd.month)[1])
-
-            # Last day of the snapshots year
-            ldy = date(sd.year, 12, calendar.monthrange(sd.year, 12)[1])
-
-            # Return all dates
-            return (sd, st, wd, ldw, ldm, ldy)
-
         # Snapshot folder and start date
         snapshot_path = self.path('snapshots')
 
@@ -328,131 +1229,259 @@ class BackupServer:
         #     snapshot = snapshot_path + '/' + start.strftime("%Y-%m-%d_020101")
         #     if not os.path.exists(snapshot): os.mkdir(snapshot)
 
-        # Get all snapshot folders (always on destination)
-        snapshots = sorted(self.execute_dest("/bin/ls " + snapshot_path))
+        # Get all snapshots from the DEST snapshot index, a listing of the snapshot folder builds it the first time
+        snapshots = self.snapshot_index()
+        if snapshots is None:
+            log.bullet("No snapshot index, listing {}".format(snapshot_path))
+            snapshots = self.execute_dest(['/bin/ls', snapshot_path])
         if len(snapshots) == 0: return
 
-        ######################################################################## Yearly
-        keep_yearly = []
-        for i, snapshot in enumerate(snapshots):
-            # Get snapshot dates (sd=date, st=time, wd=weekday 0-6, ldw=date of next sunday, ldm=date of last of month, ldy=date of last of year)
-            sd, st, wd, ldw, ldm, ldy = dates(snapshot)
-            if sd == ldy:
-                # Snapshot is the last date of the year
-                keep_yearly.append(snapshot)
-        keep_yearly = keep_yearly[-self.prune.keepYearly:]
-        snapshots = [x for x in snapshots if x not in keep_yearly]
-        if len(snapshots) == 0: return
+        # Plan keep and delete sets in a single pass (see retention.plan for the rules)
+        plan = retention.plan(snapshots, self.now_date, self.prune.keepDaily, self.prune.keepWeekly, self.prune.keepMonthly, self.prune.keepYearly)
+        log.bullet("Keeping {} daily, {} weekly, {} monthly, {} yearly snapshots, deleting {}".format(
+            len(plan.keep_daily), len(plan.keep_weekly), len(plan.keep_monthly), len(plan.keep_yearly), len(plan.delete)
+        ))
+
+        # Delete all other snapshot folders besides those kept
+        deleted = self.delete_snapshots([snapshot_path + '/' + x for x in plan.delete])
+
+        # Record deleted snapshots in the catalog, then index every snapshot still on disk
+        # (snapshots that failed to delete stay in the index)
+        if deleted: self.append_dest(self.path(catalog.CATALOG), catalog.dumps(catalog.deleted(sorted(x.rsplit('/', 1)[-1] for x in deleted))).encode())
+        self.write_snapshot_index([x for x in retention.parse(snapshots)[0] if snapshot_path + '/' + x.name not in deleted])
+
+    def archive_snapshots(self):
+        """Convert snapshots older than archive.olderThan days into one seekable archive each
+        The snapshot folder keeps its name, so retention prunes archived and live snapshots alike.
+        Archiving walks the snapshot files, so it runs where they are: in process for local
+        destinations, through archive.remoteCmd (serverbackups archive) on ssh destinations.
+        """
+        options = self.archive_options
+        log.header4("Archiving snapshots older than {} days".format(options['olderThan']))
+        trash = self.path(reaper.TRASH) if getattr(self.prune, 'background', False) else None
 
-        ######################################################################## Monthly
-        keep_monthly = []
-        for i, snapshot in enumerate(snapshots):
-            # Get snapshot dates (sd=date, st=time, wd=weekday 0-6, ldw=date of next sunday, ldm=date of last of month, ldy=date of last of year)
-            sd, st, wd, ldw, ldm, ldy = dates(snapshot)
-            if sd == ldm:
-                # Snapshot is the last date of the month
-                keep_monthly.append(snapshot)
-        keep_monthly = keep_monthly[-self.prune.keepMonthly:]
-        snapshots = [x for x in snapshots if x not in keep_monthly]
-        if len(snapshots) == 0: return
+        if self.dest.location == 'ssh':
+            if not options['remoteCmd']:
+                log.notice("No archive.remoteCmd, run serverbackups archive {} on {}".format(self.path(), self.dest.server))
+                return
+            self.execute_dest("{} {} --older-than {} --level {} --member-size {}{}".format(
+                options['remoteCmd'], shlex.quote(self.path()), int(options['olderThan']), int(options['level']),
+                int(options['memberSize']), ' --background' if trash else ''
+            ))
+        else:
+            def on_archived(name, stats):
+                log.bullet("Archived snapshot {}, {} files {} in {}".format(name, stats.files, human_bytes(stats.bytes), human_bytes(stats.archive_bytes)))
+            results = archive.archive_server(
+                self.path(), options['olderThan'], self.now_date, int(options['level']), int(options['memberSize']), trash, on_archived=on_archived
+            )
+            if not results: log.bullet("No snapshots to archive")
 
-        ######################################################################## Weekly
-        keep_weekly = []
-        for i, snapshot in enumerate(snapshots):
-            # Get snapshot dates (sd=date, st=time, wd=weekday 0-6, ldw=date of next sunday, ldm=date of last of month, ldy=date of last of year)
-            sd, st, wd, ldw, ldm, ldy = dates(snapshot)
-            if sd == ldw:
-                # Snapshot is the last date of the month
-                keep_weekly.append(snapshot)
-        keep_weekly = keep_weekly[-self.prune.keepWeekly:]
-        snapshots = [x for x in snapshots if x not in keep_weekly]
-        if len(snapshots) == 0: return
+            # Replaced live trees were moved to the trash, the reaper deletes them (remoteCmd starts its own)
+            if results and trash: self.start_reaper()
 
-        ######################################################################## Daily
-        # Keeps multiple of the same day back to keepDaily
-        keep_daily = []
-        for i, snapshot in enumerate(snapshots):
-            # Get snapshot dates (sd=date, st=time, wd=weekday 0-6, ldw=date of next sunday, ldm=date of last of month, ldy=date of last of year)
-            sd, st, wd, ldw, ldm, ldy = dates(snapshot)
-            days_back = self.now_date - timedelta(days=self.prune.keepDaily)
-            if sd > days_back:
-                keep_daily.append(snapshot)
-        snapshots = [x for x in snapshots if x not in keep_daily]
-        if len(snapshots) == 0: return
+    def snapshot_index(self):
+        """Get snapshot names from the DEST snapshots.index file, None if there is no index
+        """
+        words = self.execute_dest("cat {} 2>/dev/null || true".format(shlex.quote(self.path('snapshots.index'))), skip_logging=True)
+        return words or None
+
+    def write_snapshot_index(self, snapshots):
+        """Atomically replace the DEST snapshots.index file with these snapshots
+        """
+        index = self.path('snapshots.index')
+        self.write_dest(index + '.tmp', ''.join(x.name + '\n' for x in snapshots).encode())
+        self.execute_dest(['mv', '-f', index + '.tmp', index], skip_logging=True)
+
+    def delete_snapshots(self, paths):
+        """Delete snapshot folders on DEST in batched passes instead of one command per snapshot
+        prune.deleteBatch snapshots are removed per DEST command (0=all at once) with up to
+        prune.deleteParallel rm processes running on DEST at the same time.  With prune.background
+        they are only renamed into the trash folder and a detached reaper deletes them (see reaper.py).
+        Returns the set of deleted (or trashed) paths
+        """
+        background = getattr(self.prune, 'background', False)
+        deleted = set()
+        if paths:
+            batch = int(getattr(self.prune, 'deleteBatch', 0) or 0) or len(paths)
+            parallel = max(1, int(getattr(self.prune, 'deleteParallel', 1) or 1))
+            if background:
+                # A rename is instant whatever the number of inodes, the trash is on the same filesystem
+                log.bullet("Moving {} old snapshots to {}".format(len(paths), self.path(reaper.TRASH)))
+                script = "mkdir -p {} && xargs -0 -n 1 sh -c 'if mv -- \"$1\" \"$0/${{1##*/}}\"; then echo \"OK $1\"; else echo \"FAIL $1\"; fi' {}".format(
+                    shlex.quote(self.path(reaper.TRASH)), shlex.quote(self.path(reaper.TRASH))
+                )
+            else:
+                log.bullet("Deleting {} old snapshots (batch={}, parallel={})".format(len(paths), batch, parallel))
+                # Paths are sent NUL separated on stdin, xargs fans them out to rm and reports each result
+                script = "xargs -0 -n 1 -P {} sh -c 'if /bin/rm -rf -- \"$1\"; then echo \"OK $1\"; else echo \"FAIL $1\"; fi' _".format(parallel)
+            deleted = self.delete_batches(paths, batch, script, 'Moved old snapshot {} to trash' if background else 'Deleted old snapshot {}')
+
+        # Started on every prune, so a reaper that was killed (or trash left by one) is resumed
+        if background: self.start_reaper()
+        return deleted
+
+    def start_reaper(self):
+        """Start a detached reaper deleting the DEST trash folder (see reaper.py)
+        """
+        log.bullet("Starting background reaper of {}".format(self.path(reaper.TRASH)))
+        self.execute_dest(reaper.detached(self.path(reaper.TRASH), getattr(self.prune, 'reaperRate', 0), getattr(self.prune, 'reaperNice', True)), skip_logging=True)
 
-        # Now we have a perfect set of snapshots to keep
-        # dump('KEEP DAILY', keep_daily)
-        # dump('KEEP WEEKLY', keep_weekly)
-        # dump('KEEP MONTHLY', keep_monthly)
-        # dump('KEEP YEARLY', keep_yearly)
-
-        # Delete all other snapshot folders besides those in keep_*
-        # Have to get a fresh list of actual files and subtract daily, weekly, monthly, yearly
-        # Cannot simply use snapshots as is not, because we removed all files of the same day
-        oldsnapshots = sorted(self.execute_dest("/bin/ls " + snapshot_path))
-        oldsnapshots = [x for x in oldsnapshots if x not in keep_daily]
-        oldsnapshots = [x for x in oldsnapshots if x not in keep_weekly]
-        oldsnapshots = [x for x in oldsnapshots if x not in keep_monthly]
-        oldsnapshots = [x for x in oldsnapshots if x not in keep_yearly]
-        for oldsnapshot in oldsnapshots:
-            fullpath = snapshot_path + '/' + oldsnapshot
-            log.bullet("Deleting old snapshot {}".format(fullpath))
-            self.execute_dest("/bin/rm -rf '{}'".format(fullpath))
-
-    def execute(self, cmd, outfile=None, output_list=False, skip_logging=False, dryrun=False):
+    def delete_batches(self, paths, batch, script, message):
+        """Run a DEST delete script over paths in batches, it reports OK or FAIL per path
+        Returns the set of paths reported OK
+        """
+        deleted = set()
+        for i in range(0, len(paths), batch):
+            chunk = paths[i:i + batch]
+            result = self.run_dest(script, input=b'\0'.join(path.encode() for path in chunk))
+            reported = {}
+            for line in result.stdout:
+                status, _, path = line.partition(' ')
+                reported[path] = status
+            for path in chunk:
+                status = reported.get(path)
+                if status == 'OK':
+                    deleted.add(path)
+                    log.bullet(message.format(path))
+                elif status == 'FAIL':
+                    log.error("Failed deleting old snapshot {}".format(path))
+                else:
+                    log.error("Old snapshot {} not deleted, no result from DEST".format(path))
+            self.check(result, 'Snapshot delete batch')
+        return deleted
+
+    def execute(self, cmd, outfile=None, output_list=False, skip_logging=False, dryrun=False, timeout=None, stream=False, output_lines=False):
         """Execute command local or remote with optional output saved to snapshot folder
         local->local = script=local, output=local
         local->remote = script=local, output=remote
         remote->local = script=remote, output=local
+        cmd is a shell string (user scripts), an argv list or a pipeline (list of argv lists)
+        With stream=True the outfile data is piped through python and counted, throughput is
+        logged as it goes and result.stats holds bytes, compression ratio and duration
+        Returns a list of output words if output_list, output lines if output_lines, else the runner Result
         """
         # Get src and dest location types (local or ssh)
         src = self.src.location
         dest = self.dest.location
-        outfile_cmd = ''
+        stages = self.stages(cmd)
+
+        if src == 'ssh':
+            # Execute script remotely, output comes back over ssh
+            # ssh toor@linstore 'cat /etc/hosts'
+            stages = [self.ssh_args('src') + [self.remote_command(pipeline_string(stages) if not isinstance(cmd, str) else cmd, timeout)]]
+
+        meters = {}
+        output_meter = raw_meter = None
+        if outfile and stream:
+            # Count what the last producing stage writes, and what goes into it if that stage is a
+            # local compressor (remote pipelines only show us the compressed bytes)
+            name = os.path.basename(str(outfile))
+            output_meter = meters[len(stages) - 1] = Meter(name, interval=self.meter_interval)
+            if len(stages) > 1: raw_meter = meters[len(stages) - 2] = Meter(name + ' (raw)', report=False)
+        if outfile and dest == 'ssh':
+            # Save output remotely
+            # cat /etc/hosts | ssh toor@linstore 'cat > /snapshot/dir/hosts'
+            stages.append(self.ssh_args('dest') + ['cat > ' + shlex.quote(str(outfile))])
+
+        display = pipeline_string(stages)
+        if outfile and dest == 'local': display += ' > ' + str(outfile)
+        if dryrun: display = 'DRYRUN: ' + display
+        if not skip_logging: log.bullet4(display)
+        if dryrun: return [] if output_list or output_lines else None
 
-        # local->local = script=local, output=local
-        if src == 'local' and dest == 'local':
-            # Execute script locally, save output locally
+        if outfile and dest == 'local':
+            # Execute script, save output locally
             # cat /etc/hosts > /snapshot/dir/hosts
-            if outfile: outfile_cmd = cmd + " > " + str(outfile)
-        elif src == 'local' and dest == 'ssh':
-            # Execute script locally, save output remotely
-            # cat /etc/hosts | ssh toor@linstore 'cat > /snapshot/dir/hosts'
-            if outfile: outfile_cmd = cmd + " | " + self.ssh_string('dest') + "'cat > " + str(outfile) + "'"
-        elif src == 'ssh' and dest == 'local':
-            # Execute script remotely, save output locally
-            #ssh toor@linstore cat /etc/hosts > /snapshot/dir/hosts
-            cmd = self.ssh_string('src') + " \"" + cmd + "\""
-            if outfile: outfile_cmd = cmd + " >  " + str(outfile)
-
-        if dryrun:
-            cmd = 'DRYRUN: ' + cmd
-            outfile_cmd = 'DRYRUN: ' + outfile_cmd
-
-        if outfile is None and output_list is False:
-            # Execute the command, no output
-            if not skip_logging: log.bullet4(cmd)
-            if not dryrun: os.system(cmd)
+            with open(str(outfile), 'wb') as f:
+                result = self.runner.pipeline(stages, stdout=f, timeout=timeout, on_stderr=log.warning, meters=meters)
+        elif outfile:
+            result = self.runner.pipeline(stages, timeout=timeout, on_stderr=log.warning, meters=meters)
+        elif output_list or output_lines:
+            # Execute the command and capture output to python list
+            result = self.runner.pipeline(stages, timeout=timeout)
         else:
-            if outfile:
-                # Execute the command and > output to outfile
-                if not skip_logging: log.bullet4(outfile_cmd)
-                if not dryrun: os.system(outfile_cmd)
-            elif output_list:
-                # Execute the command and capture output to python list
-                if not skip_logging: log.bullet4(cmd)
-                if not dryrun: return subprocess.run(cmd, shell=True, stdout=subprocess.PIPE).stdout.decode('utf-8').split()
-                return []
-
-    def execute_dest(self, cmd, skip_logging=False, dryrun=False):
-        """Execute command without output on DEST
+            # Execute the command, output straight to the console
+            result = self.runner.pipeline(stages, passthrough=True, timeout=timeout)
+
+        if output_list: return result.words()
+        if output_lines: return result.stdout
+        if output_meter:
+            result.stats = stats(output_meter, raw_meter)
+            log.bullet4("{} {} in {:.1f}s ({}/s){}".format(
+                os.path.basename(str(outfile)), human_bytes(result.stats['bytes']), result.stats['duration'], human_bytes(result.stats['throughput']),
+                ", ratio {}".format(result.stats['ratio']) if result.stats['ratio'] else ''
+            ))
+        return result
+
+    def remote_command(self, cmd, timeout=None):
+        """Shell string to run on SRC over ssh, stopped by timeout(1) on SRC after timeout seconds
+        Killing the local ssh client does not stop the remote command (no tty over the shared ssh
+        connection).  Without timeout(1) on SRC the remote command keeps running after a timeout.
+        """
+        if not timeout: return cmd
+        return 'if command -v timeout >/dev/null 2>&1; then exec timeout -k 5 {0:g} sh -c {1}; else exec sh -c {1}; fi'.format(
+            timeout, shlex.quote(cmd)
+        )
+
+    def execute_dest(self, cmd, skip_logging=False, dryrun=False, timeout=None):
+        """Execute command on DEST and capture output to a python list of words
+        cmd is an argv list or a shell string
+        """
+        result = self.run_dest(cmd, skip_logging=skip_logging, dryrun=dryrun, timeout=timeout)
+        if result:
+            self.check(result, 'DEST command')
+            return result.words()
+
+    def run_dest(self, cmd, input=None, skip_logging=False, dryrun=False, timeout=None):
+        """Run command on DEST and return the runner Result (None on dryrun)
+        cmd is an argv list or a shell string, input is optional bytes for its stdin
         """
         if self.dest.location == 'ssh':
-            cmd = self.ssh_string('dest') + " \"" + cmd + "\""
+            argv = self.ssh_args('dest') + [cmd if isinstance(cmd, str) else quote(cmd)]
+        else:
+            argv = ['sh', '-c', cmd] if isinstance(cmd, str) else cmd
+
+        if not skip_logging: log.bullet4(quote(argv) if self.dest.location == 'ssh' or not isinstance(cmd, str) else cmd)
+        if dryrun: return None
+        return self.runner.run(argv, input=input, timeout=timeout)
+
+    def write_dest(self, path, data):
+        """Write bytes to a file on DEST
+        """
+        if self.dest.location == 'local':
+            with open(path, 'wb') as f: f.write(data)
+            return True
+        result = self.run_dest('cat > ' + shlex.quote(path), input=data, skip_logging=True)
+        return self.check(result, 'Writing DEST file ' + path)
+
+    def append_dest(self, path, data):
+        """Append bytes to a file on DEST
+        """
+        if self.dest.location == 'local':
+            with open(path, 'ab') as f: f.write(data)
+            return True
+        result = self.run_dest('cat >> ' + shlex.quote(path), input=data, skip_logging=True)
+        return self.check(result, 'Appending DEST file ' + path)
+
+    def stages(self, cmd):
+        """Normalize a shell string, argv list or pipeline into a list of argv stages
+        """
+        if isinstance(cmd, str): return [['sh', '-c', cmd]]
+        if cmd and isinstance(cmd[0], (list, tuple)): return [list(stage) for stage in cmd]
+        return [list(cmd)]
 
-        # Execute the command and capture output to python list
-        if not skip_logging: log.bullet4(cmd)
-        if not dryrun: return subprocess.run(cmd, shell=True, stdout=subprocess.PIPE).stdout.decode('utf-8').split()
+    def check(self, result, name):
+        """Log a failed runner result, its exit status is otherwise kept in self.runner.results
+        """
+        if result is None or result.ok: return True
+        if result.timed_out:
+            log.error("{} timed out after {:.1f}s".format(name, result.duration))
+        elif result.cancelled:
+            log.error("{} cancelled".format(name))
+        else:
+            log.error("{} failed with exit code {}".format(name, result.returncode))
+            for line in result.stderr[-5:]: log.error("  " + line)
+        return False
 
     def path(self, path=None):
         """Get the DEST server backup path (without snapshot or current, just server backup root)
@@ -461,22 +1490,24 @@ class BackupServer:
         if path: return result + '/' + path
         return result
 
+    def ssh_args(self, location):
+        """Get an ssh argv list (up to and including user@host) for src or dest
+        """
+        ssh = self.src.ssh if location == 'src' else self.dest.ssh
+        key = os.path.expanduser(ssh.key)
+        cipher = self.transport.ssh_args()
+        multiplex = []
+        if getattr(ssh, 'multiplex', True):
+            # Reuse one persistent master connection per (user, host, port, key, cipher)
+            multiplex = self.ssh_pool.options(ssh.user, ssh.host, ssh.port, key, cipher)
+        return ['ssh', '-p', str(ssh.port), '-i', key, '-o', 'LogLevel=quiet'] + cipher + multiplex + [ssh.user + '@' + ssh.host]
+
+    def ssh_command(self, location):
+        """Get an ssh transport string (without user@host) for rsync -e
+        """
+        return quote(self.ssh_args(location)[:-1])
+
     def ssh_string(self, location):
         """Get an ssh connection string for src or dest
         """
-        if location == 'src':
-            return ("ssh"
-                + " -p " + str(self.src.ssh.port)
-                + " -i " + self.src.ssh.key
-                + " -o LogLevel=quiet "
-                + self.src.ssh.user + "@" + self.src.ssh.host
-                + " "
-            )
-        elif location == 'dest':
-            return ("ssh"
-                + " -p " + str(self.dest.ssh.port)
-                + " -i " + self.dest.ssh.key
-                + " -o LogLevel=quiet "
-                + self.dest.ssh.user + "@" + self.dest.ssh.host
-                + " "
-            )
+        return quote(self.ssh_args(location)) + ' '
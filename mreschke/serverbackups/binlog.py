@@ -0,0 +1,147 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from types import SimpleNamespace as obj
+
+from .catalog import CATALOG, Catalog
+from .compression import decompress_argv
+from .store import RECIPE_EXT, restore as restore_recipe
+
+# Binary log options (backup.mysql.binlog), servers may override single keys
+DEFAULTS = {
+    'enabled': False,
+    'fullEvery': 7,
+    'readCmd': 'cat',
+    'positionFlag': '--master-data=2',
+}
+
+# Folder of the binary logs copied into each snapshot
+FOLDER = 'mysqlbinlog'
+
+# Binary log coordinates written at the top of a dump by mysqldump --master-data (or --source-data)
+POSITION = re.compile(r"CHANGE (?:MASTER|REPLICATION SOURCE) TO (?:MASTER|SOURCE)_LOG_FILE='([^']+)', (?:MASTER|SOURCE)_LOG_POS=(\d+)")
+
+
+def options(binlog=None):
+    """Binary log options merged with the defaults
+    """
+    return {**DEFAULTS, **(binlog or {})}
+
+
+def sequence(name):
+    """Sequence number of a binary log file (mysql-bin.000123 is 123)
+    """
+    return int(name.rsplit('.', 1)[-1])
+
+
+class _Enough(Exception):
+    pass
+
+
+class _Head:
+    """Sink keeping only the first bytes written to it"""
+
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        if len(self.data) >= self.size: raise _Enough()
+        return len(data)
+
+
+def copy(file, out):
+    """Write the original content of a backup output (compressed, recipe or plain) to a binary file object
+    """
+    if file.endswith(RECIPE_EXT):
+        restore_recipe(file, out)
+        return
+    argv = decompress_argv(file)
+    if not argv:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''): out.write(chunk)
+        return
+    proc = subprocess.Popen(argv + [file], stdout=subprocess.PIPE)
+    try:
+        for chunk in iter(lambda: proc.stdout.read(65536), b''): out.write(chunk)
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None: proc.kill()
+        proc.wait()
+
+
+def position(dump):
+    """Get the (binlog file, position) a dump was taken at, from the first MiB of the dump
+    """
+    head = _Head(1048576)
+    try:
+        copy(dump, head)
+    except _Enough:
+        pass
+    match = POSITION.search(head.data.decode('utf-8', 'replace'))
+    if not match: return None
+    return match.group(1), int(match.group(2))
+
+
+def restore_plan(path, database, until=None):
+    """Pick the newest full dump of a database finished before until and the binary logs after it
+    path is the server folder on the backup server, until a local 'YYYY-MM-DD HH:MM:SS' (None for
+    everything backed up).  Returns obj(snapshot, dump, position, files=[(name, path)]) or raises OSError.
+    """
+    with open(os.path.join(path, CATALOG)) as f:
+        entries = sorted(Catalog(f).snapshots(complete=True), key=lambda x: x['snapshot'])
+    limit = time.mktime(time.strptime(until, '%Y-%m-%d %H:%M:%S')) if until else None
+
+    full = dump = None
+    for entry in entries:
+        if not (entry.get('binlog') or {}).get('full'): continue
+        if limit is not None and (entry['finished'] or limit + 1) > limit: continue
+        item = [x for x in entry.get('mysql') or [] if x['name'] == database and x['ok']]
+        if item: full, dump = entry, item[0]
+    if not full: raise OSError("No full dump of database '{}' in binary log mode{}".format(database, ' finished before ' + until if until else ''))
+
+    file = os.path.join(path, 'snapshots', full['snapshot'], dump['file'])
+    if os.path.isdir(file): raise OSError("{} is a perTable dump, binary logs can only be replayed onto whole database dumps".format(file))
+    coordinates = position(file)
+    if not coordinates: raise OSError("No binary log position in {}, was it dumped with binlog.positionFlag?".format(file))
+
+    # Binary logs of every snapshot (a dump hard linked by change detection may be older than its
+    # snapshot) up to the first snapshot started after until, that one holds the logs covering it
+    files = {}
+    for entry in entries:
+        for item in (entry.get('binlog') or {}).get('files', []):
+            if sequence(item['name']) >= sequence(coordinates[0]):
+                files.setdefault(item['name'], os.path.join(path, 'snapshots', entry['snapshot'], item['file']))
+        if limit is not None and entry['started'] > limit and entry['snapshot'] > full['snapshot']: break
+    names = sorted(files, key=sequence)
+    if names and names[0] != coordinates[0]:
+        raise OSError("Binary log {} of dump {} is not backed up".format(coordinates[0], file))
+    for previous, name in zip(names, names[1:]):
+        if sequence(name) != sequence(previous) + 1:
+            raise OSError("Binary logs after {} are missing (snapshot pruned or log purged before it was copied)".format(previous))
+    return obj(snapshot=full['snapshot'], dump=file, position=coordinates, files=[(name, files[name]) for name in names])
+
+
+def restore(plan, database, out, until=None, binlog_cmd='mysqlbinlog'):
+    """Write the full dump then the binary log events of database after its position (up to until) to out
+    out must be a real file (stdout), mysqlbinlog writes to it directly
+    """
+    copy(plan.dump, out)
+    out.flush()
+    if not plan.files: return 0
+    folder = tempfile.mkdtemp(prefix='sb-binlog-')
+    try:
+        # mysqlbinlog needs the raw log files, restore them next to each other under their own names
+        paths = []
+        for name, file in plan.files:
+            paths.append(os.path.join(folder, name))
+            with open(paths[-1], 'wb') as f: copy(file, f)
+        argv = [binlog_cmd, '--database=' + database, '--start-position={}'.format(plan.position[1])]
+        if until: argv.append('--stop-datetime=' + until)
+        return subprocess.call(argv + paths, stdout=out)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
@@ -0,0 +1,107 @@
+import json
+import time
+
+# Catalog file in each server backup folder on DEST, one JSON record per line, only ever appended to
+CATALOG = 'catalog.jsonl'
+
+
+def entry(report):
+    """Catalog record of one snapshot from its BackupServer run Report
+    """
+    data = report.to_dict()
+    details = data['details'] or {}
+    rsync = details.get('rsync') or {}
+    return {
+        'event': 'snapshot',
+        'snapshot': data['snapshot'],
+        'server': data['server'],
+        'cluster': data['cluster'],
+        'status': data['status'],
+        'complete': details.get('complete'),
+        'started': data['started'],
+        'finished': data['finished'],
+        'duration': data['duration'],
+        'phases': {phase['name']: phase['duration'] for phase in data['phases']},
+        'failedPhases': [phase['name'] for phase in data['phases'] if not phase['ok']],
+        'bytes': data['bytes'],
+        'snapshotBytes': data['snapshotBytes'],
+        'files': rsync.get('files'),
+        'transferredFiles': rsync.get('transferredFiles'),
+        'totalFileSize': rsync.get('totalFileSize'),
+        'mysql': [{
+            'name': x['name'], 'ok': x['ok'], 'bytes': x['bytes'],
+            'file': x.get('file'), 'fingerprint': x.get('fingerprint'), 'linked': x.get('linked'),
+        } for x in details.get('mysql', [])],
+        'binlog': details.get('binlog'),
+        'scripts': [{'name': x['name'], 'type': x['type'], 'ok': x['ok'], 'output': x.get('output'), 'bytes': x['bytes']} for x in details.get('scripts', [])],
+    }
+
+
+def deleted(names):
+    """Catalog record of snapshots removed by prune (or resumed under a new name)
+    """
+    return {'event': 'deleted', 'snapshots': list(names), 'time': round(time.time(), 3)}
+
+
+def dumps(record):
+    """One catalog line
+    """
+    return json.dumps(record, separators=(',', ':'), default=str) + '\n'
+
+
+class Catalog:
+    """Snapshot catalog of one server, replayed from its append-only catalog lines
+
+    Later records of the same snapshot replace earlier ones and deleted records drop
+    snapshots, so queries only see snapshots still on disk without walking them.
+    """
+
+    def __init__(self, lines=None):
+        self.entries = {}
+        self.errors = 0
+        for line in lines or []:
+            self.add(line)
+
+    def add(self, line):
+        """Replay one catalog line (str or already parsed record)
+        """
+        if isinstance(line, str):
+            if not line.strip(): return
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn last line (backup killed mid write) is skipped
+                self.errors += 1
+                return
+        else:
+            record = line
+        if record.get('event') == 'snapshot':
+            self.entries[record['snapshot']] = record
+        elif record.get('event') == 'deleted':
+            for name in record.get('snapshots', []): self.entries.pop(name, None)
+
+    def snapshots(self, status=None, since=None, until=None, sort=None, limit=None, complete=False):
+        """Snapshots (newest first, or largest first by a sort key) filtered by status and YYYY-MM-DD name range
+        With complete only snapshots promoted to their final name (not left as .partial by a failed run)
+        """
+        entries = [x for x in self.entries.values()
+                   if (not status or x['status'] == status)
+                   and (not complete or x.get('complete', True) is not False)
+                   and (not since or x['snapshot'] >= since)
+                   and (not until or x['snapshot'][:len(until)] <= until)]
+        if sort:
+            entries.sort(key=lambda x: x.get(sort) or 0, reverse=True)
+        else:
+            entries.sort(key=lambda x: x['snapshot'], reverse=True)
+        return entries[:limit] if limit else entries
+
+    def last_good(self):
+        """Newest snapshot whose backup succeeded, None if there is none
+        """
+        good = self.snapshots(status='ok', limit=1)
+        return good[0] if good else None
+
+    def largest(self, since=None, limit=10, key='snapshotBytes'):
+        """Largest snapshots (by disk used, or another byte key) since a YYYY-MM-DD prefix
+        """
+        return self.snapshots(since=since, sort=key, limit=limit)
@@ -30,7 +30,12 @@ def handle():
 @click.option('--servers', is_flag=True, help="Run entire config.yml only, no custom code")
 @click.option('--server', help="Run just one server from config.yml")
 @click.option('--cluster', help="Run all servers in a cluster from config.yml")
-def run(all, custom, servers, server, cluster):
+@click.option('--workers', type=int, default=1, show_default=True, help="Number of servers to backup in parallel")
+@click.option('--max-per-destination', type=int, help="Max parallel servers writing to the same destination")
+@click.option('--max-per-source', type=int, help="Max parallel servers reading from the same source")
+@click.option('--report-json', help="Write a JSON run report of every server to this file")
+@click.option('--report-prometheus', help="Write run metrics to this Prometheus textfile (node_exporter textfile collector)")
+def run(all, custom, servers, server, cluster, workers, max_per_destination, max_per_source, report_json, report_prometheus):
     """Run backups"""
 
 
@@ -40,7 +45,7 @@ def start(backups):
         log.error('Missing run option, see --help')
         exit(1)
 
-    if not any(x in ['--all', '--servers', '--server', '--cluster'] for x in sys.argv):
+    if not any(x.split('=')[0] in ['--all', '--servers', '--server', '--cluster'] for x in sys.argv):
         if 'run' in sys.argv and '--custom' not in sys.argv and '--help' not in sys.argv and '-h' not in sys.argv:
             log.error('Missing run option, see --help')
             exit(1)
@@ -51,28 +56,48 @@ def start(backups):
     log.header3("Running server backups")
     log.separator()
 
+    # Parallel scheduling and report options
+    run_options = {
+        'workers': int(option('--workers') or 1),
+        'max_per_destination': int(option('--max-per-destination') or 0) or None,
+        'max_per_source': int(option('--max-per-source') or 0) or None,
+        'report_json': option('--report-json'),
+        'report_prometheus': option('--report-prometheus'),
+    }
+    if run_options['workers'] > 1:
+        log.bullet("Running up to {} servers in parallel".format(run_options['workers']))
+
     # Run a single server
-    if '--server' in sys.argv:
-        server = sys.argv[sys.argv.index("--server") + 1]
+    if option('--server'):
+        server = option('--server')
         log.bullet("Running single server '{}'".format(server))
-        backups.run(server=server)
+        return backups.run(server=server, **run_options)
 
     # Run all servers in a single cluster
-    elif '--cluster' in sys.argv:
-        cluster = sys.argv[sys.argv.index("--cluster") + 1]
+    elif option('--cluster'):
+        cluster = option('--cluster')
         log.bullet("Running servers in cluster '{}'".format(cluster))
-        backups.run(cluster=cluster)
+        return backups.run(cluster=cluster, **run_options)
 
     else:
         log.bullet("Running all servers defined in config")
-        backups.run()
+        return backups.run(**run_options)
+
+
+def option(name):
+    """Get a --name value or --name=value from the command line, None if not present
+    """
+    for i, arg in enumerate(sys.argv):
+        if arg == name and i + 1 < len(sys.argv): return sys.argv[i + 1]
+        if arg.startswith(name + '='): return arg[len(name) + 1:]
+    return None
 
 
 # def backupserversOLD(config_path='/etc/mreschke/serverbackups', servers=None, defaults=None):
 #     """Run the main BackupServer class from the server config.yml and config.d files
 #     """
 #     # Only run with proper cli flags
-#     if not any(x in ['--all', '--servers', '--server', '--cluster'] for x in sys.argv): return
+#     if not any(x.split('=')[0] in ['--all', '--servers', '--server', '--cluster'] for x in sys.argv): return
 
 #     log.blank()
 #     log.separator()
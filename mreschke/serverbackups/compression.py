@@ -0,0 +1,88 @@
+import os
+
+# Supported codecs.  threads is the flag used to set compression threads (None if single threaded),
+# fallback is the codec used when this one is not installed where the output is produced
+CODECS = {
+    'gzip': {'cmd': 'gzip', 'ext': '.gz', 'threads': None, 'fallback': None},
+    'pigz': {'cmd': 'pigz', 'ext': '.gz', 'threads': '-p{}', 'fallback': 'gzip'},
+    'zstd': {'cmd': 'zstd', 'ext': '.zst', 'threads': '-T{}', 'fallback': 'gzip'},
+    'xz': {'cmd': 'xz', 'ext': '.xz', 'threads': '-T{}', 'fallback': 'gzip'},
+    'none': {'cmd': None, 'ext': '', 'threads': None, 'fallback': None},
+}
+
+# Decompress commands by file extension, used by restore tooling
+DECOMPRESS = {
+    '.gz': ['gzip', '-dc'],
+    '.zst': ['zstd', '-dcq'],
+    '.xz': ['xz', '-dc'],
+}
+
+
+class Compression:
+    """A compression setting (codec plus level plus threads) for dump and script outputs
+
+    Settings come from the server compression options and may be overridden per
+    item (mysql or a single script) with the same keys.
+    """
+
+    def __init__(self, codec='gzip', level=None, threads=0):
+        if codec not in CODECS:
+            raise ValueError("Unknown compression codec '{}', use one of {}".format(codec, ', '.join(sorted(CODECS))))
+        self.codec = codec
+        self.level = level
+        self.threads = threads or 0
+
+    @classmethod
+    def from_options(cls, *options):
+        """Build from one or more option dictionaries, later dictionaries win
+        """
+        merged = {}
+        for option in options:
+            if option: merged.update(option)
+        return cls(merged.get('codec') or 'gzip', merged.get('level'), merged.get('threads'))
+
+    @property
+    def ext(self):
+        """Output file extension of this codec (empty for none)
+        """
+        return CODECS[self.codec]['ext']
+
+    @property
+    def cmd(self):
+        """Executable name of this codec (None for none)
+        """
+        return CODECS[self.codec]['cmd']
+
+    def fallback(self):
+        """The codec to use when this one is not installed, None if there is no fallback
+        """
+        codec = CODECS[self.codec]['fallback']
+        if not codec: return None
+        return Compression(codec, self.level, self.threads)
+
+    def argv(self):
+        """Compress stdin to stdout argv, None for no compression
+        """
+        if not self.cmd: return None
+        argv = [self.cmd, '-c']
+        if self.codec == 'zstd': argv.append('-q')
+        if self.level is not None: argv.append('-{}'.format(self.level))
+        flag = CODECS[self.codec]['threads']
+        # zstd and xz take 0 as all cores, pigz uses all cores by default
+        if flag and (self.threads or self.codec != 'pigz'): argv.append(flag.format(self.threads))
+        return argv
+
+    def filename(self, name):
+        """Output filename with this codec's extension (not added twice)
+        """
+        if not self.ext or name.endswith(self.ext): return name
+        return name + self.ext
+
+    def __repr__(self):
+        return "<Compression {} level={} threads={}>".format(self.codec, self.level, self.threads)
+
+
+def decompress_argv(filename):
+    """Decompress-to-stdout argv for a backup output file based on its extension, None if not compressed
+    """
+    return DECOMPRESS.get(os.path.splitext(filename)[1])
@@ -0,0 +1,90 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import SimpleNamespace as obj
+
+from . import log
+
+
+class Graph:
+    """Dependency graph of blocking steps run concurrently in a thread pool
+
+    Steps are plain callables (they run their commands through the Runner) executed
+    in worker threads, with the log prefix of the caller.  A step starts as soon as
+    every step it comes after is done, at most workers steps run at once.  A failed
+    step skips every step depending on it while independent steps still finish,
+    then its exception is raised.
+    On Ctrl-C (only ever raised in the thread calling run) on_interrupt() is called
+    to stop the running steps, pending steps never start and KeyboardInterrupt is raised.
+    """
+
+    def __init__(self, workers=None, on_interrupt=None):
+        self.workers = workers
+        self.on_interrupt = on_interrupt
+        self.steps = {}
+
+    def add(self, name, func, after=()):
+        """Add a step running func() after the named steps
+        """
+        if name in self.steps: raise ValueError("Step '{}' added twice".format(name))
+        self.steps[name] = obj(name=name, func=func, after=list(after))
+        return self
+
+    def order(self):
+        """Step names in dependency order (raises ValueError on unknown steps or cycles)
+        """
+        order = []
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == 'done': return
+            if state.get(name) == 'visiting': raise ValueError("Step dependency cycle {}".format(' -> '.join(path + [name])))
+            if name not in self.steps: raise ValueError("Step '{}' depends on unknown step '{}'".format(path[-1], name))
+            state[name] = 'visiting'
+            for after in self.steps[name].after: visit(after, path + [name])
+            state[name] = 'done'
+            order.append(name)
+
+        for name in self.steps: visit(name, [])
+        return order
+
+    def run(self):
+        """Run every step and return {name: ok, failed or skipped}
+        The exception of the first failed step (in dependency order) is raised once all runnable steps are done.
+        """
+        order = self.order()
+        if not order: return {}
+        status = {}
+        errors = {}
+        waiting = list(order)
+        running = {}
+        pool = ThreadPoolExecutor(max_workers=self.workers or len(order))
+        try:
+            while waiting or running:
+                # Dependency order, so a skipped step is known before the steps after it are looked at
+                for name in list(waiting):
+                    after = self.steps[name].after
+                    if any(x not in status for x in after): continue
+                    waiting.remove(name)
+                    if any(status[x] != 'ok' for x in after):
+                        status[name] = 'skipped'
+                        continue
+                    running[pool.submit(log.bind(self.steps[name].func))] = name
+                if not running: continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        status[name] = 'ok'
+                    except Exception as e:
+                        status[name] = 'failed'
+                        errors[name] = e
+        except KeyboardInterrupt:
+            # Worker threads cannot be interrupted, the running steps are stopped through on_interrupt
+            if self.on_interrupt: self.on_interrupt()
+            for future in running: future.cancel()
+            raise
+        finally:
+            pool.shutdown(wait=True)
+        for name in order:
+            if name in errors: raise errors[name]
+        return status
@@ -82,6 +82,258 @@ def show_defaults():
     with open(template, 'r') as f:
         print(f.read())
 
+@cli.command('cat')
+@click.argument('file')
+@click.option('--store', help="Chunk store folder of a .recipe (default the .store folder above it)")
+def cat(file, store):
+    """Decompress a dump or script output to stdout based on its extension (.gz .zst .xz .recipe)
+
+    \b
+    serverbackups cat /mnt/backups/myserver/current/mysqldump/db1.sql.zst | mysql db1
+    """
+    import subprocess
+    from .compression import decompress_argv
+    from .store import RECIPE_EXT, restore
+    if file.endswith(RECIPE_EXT):
+        # Reassemble an output from the chunk store
+        try:
+            restore(file, click.get_binary_stream('stdout'), store)
+        except OSError as e:
+            exit(str(e))
+        return
+    argv = decompress_argv(file)
+    if not argv:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''): click.get_binary_stream('stdout').write(chunk)
+        return
+    exit(subprocess.call(argv + [file]))
+
+
+@cli.command('mysql-restore')
+@click.argument('path')
+@click.argument('database')
+@click.option('--until', help="Replay binary logs up to this local time, 'YYYY-MM-DD HH:MM:SS' (default everything backed up)")
+@click.option('--binlog-cmd', default='mysqlbinlog', show_default=True, help="mysqlbinlog command")
+@click.option('--plan', is_flag=True, help="Only show the dump and binary logs that would be replayed")
+def mysql_restore(path, database, until, binlog_cmd, plan):
+    """Write SQL restoring a database to a point in time (MySQL binlog mode, run on the backup server)
+
+    \b
+    PATH is the server folder, the newest full dump finished before --until is
+    followed by the binary log events of DATABASE after its position
+    serverbackups mysql-restore /mnt/backups/db1.example.com shop --until '2026-10-18 11:59:00' | mysql shop
+    """
+    import sys
+    from .binlog import restore, restore_plan
+    try:
+        replay = restore_plan(path, database, until)
+    except (OSError, ValueError) as e:
+        exit(str(e))
+    if plan:
+        click.secho("Full dump {} at {} position {}".format(replay.dump, *replay.position), fg='green')
+        for name, file in replay.files: click.echo(file)
+        return
+    exit(restore(replay, database, sys.stdout.buffer, until, binlog_cmd))
+
+
+@cli.command('store-gc')
+@click.argument('path')
+@click.option('--store', help="Chunk store folder (default PATH/.store)")
+@click.option('--grace', default=24, show_default=True, help="Keep unreferenced chunks younger than this many hours")
+@click.option('--dry-run', is_flag=True, help="Only count what would be deleted")
+def store_gc(path, store, grace, dry_run):
+    """Delete chunk store chunks no snapshot references anymore (run on the backup server)
+
+    \b
+    PATH is the destination path holding the server folders
+    serverbackups store-gc /mnt/backups
+
+    Refuses to run while a backup uses the store.  Backups writing the
+    store over ssh without flock on the backup server are not detected,
+    never run store-gc while those run.
+    """
+    from .store import gc
+    from .utils import human_bytes
+    try:
+        referenced, deleted, freed = gc(path, store, grace * 3600, dry_run)
+    except OSError as e:
+        exit(str(e))
+    click.secho("{} chunks referenced, {}{} unreferenced chunks deleted ({})".format(
+        referenced, 'DRYRUN ' if dry_run else '', deleted, human_bytes(freed)
+    ), fg='green')
+
+
+@cli.command('reap')
+@click.argument('path')
+@click.option('--rate', default=0, show_default=True, help="Delete about this many files per second (0=unlimited)")
+@click.option('--no-nice', is_flag=True, help="Delete at normal cpu and io priority")
+def reap(path, rate, no_nice):
+    """Delete snapshots pruned into trash folders (run on the backup server)
+
+    \b
+    PATH is a server folder or the destination path holding the server folders
+    Resumes the work of a killed background reaper, a reaper already running is left alone
+    serverbackups reap /mnt/backups --rate 5000
+    """
+    from .reaper import reap, trashes
+    found = trashes(path)
+    if not found: exit("No trash folder in {}".format(path))
+    failed = 0
+    for trash in found:
+        click.secho("Reaping {}".format(trash), fg='green')
+        if reap(trash, rate, not no_nice) != 0: failed += 1
+    if failed: exit("{} trash folders not completely deleted".format(failed))
+
+
+@cli.command('archive')
+@click.argument('path')
+@click.option('--older-than', default=180, show_default=True, help="Archive snapshots older than this many days")
+@click.option('--level', default=6, show_default=True, help="gzip level")
+@click.option('--member-size', default=4194304, show_default=True, help="Start a new gzip member every this many bytes")
+@click.option('--background', is_flag=True, help="Move replaced snapshot trees to the trash and reap them in the background")
+@click.option('--dry-run', is_flag=True, help="Only list the snapshots that would be archived")
+def archive(path, older_than, level, member_size, background, dry_run):
+    """Convert old snapshots into one seekable archive each (run on the backup server)
+
+    \b
+    PATH is a server folder or the destination path holding the server folders
+    serverbackups archive /mnt/backups --older-than 365
+    """
+    import subprocess
+    from glob import glob
+    from .archive import archive_server
+    from .reaper import TRASH, detached
+    from .utils import human_bytes
+
+    def archived(name, stats):
+        click.echo("Archived {} {}, {} files {} in {}".format(server, name, stats.files, human_bytes(stats.bytes), human_bytes(stats.archive_bytes)))
+
+    servers = [path] if os.path.isdir(os.path.join(path, 'snapshots')) else sorted(x for x in glob(os.path.join(path, '*')) if os.path.isdir(os.path.join(x, 'snapshots')))
+    if not servers: exit("No server folders in {}".format(path))
+    for server in servers:
+        trash = os.path.join(server, TRASH) if background else None
+        results = archive_server(server, older_than, level=level, member_size=member_size, trash=trash, dryrun=dry_run, on_archived=archived)
+        if dry_run:
+            for name in results: click.echo("DRYRUN archive {} {}".format(server, name))
+        if results and trash and not dry_run: subprocess.call(['sh', '-c', detached(trash)])
+
+
+@cli.command('extract')
+@click.argument('snapshot')
+@click.argument('file', required=False)
+@click.option('-l', '--list', 'list_files', is_flag=True, help="List the archived files instead")
+def extract(snapshot, file, list_files):
+    """Write one file of an archived snapshot to stdout
+
+    \b
+    serverbackups extract /mnt/backups/myserver/snapshots/2020-01-31_010101 etc/hosts
+    serverbackups extract /mnt/backups/myserver/snapshots/2020-01-31_010101 --list
+    """
+    import sys
+    from .archive import entries, extract as extract_file, is_archived
+    if not is_archived(snapshot): exit("{} is not an archived snapshot".format(snapshot))
+    if list_files:
+        for entry in entries(snapshot):
+            click.echo("{} {:>12} {}{}".format(entry['type'], entry['size'], entry['path'], ' -> ' + entry['link'] if entry.get('link') else ''))
+        return
+    if not file: exit("Missing FILE, or use --list")
+    try:
+        extract_file(snapshot, file, sys.stdout.buffer)
+    except OSError as e:
+        exit(str(e))
+
+
+@cli.command('benchmark-retention')
+@click.option('-c', '--count', default=100000, show_default=True, help="Number of synthetic hourly snapshots")
+def benchmark_retention(count):
+    """Benchmark the snapshot prune planner
+    """
+    from .retention import benchmark
+    plan, seconds = benchmark(count)
+    click.secho("Planned {} snapshots in {:.3f}s ({:,.0f} snapshots/s)".format(count, seconds, count / max(seconds, 1e-9)), fg='green')
+    click.echo("Keep yearly={} monthly={} weekly={} daily={}, delete={}".format(
+        len(plan.keep_yearly), len(plan.keep_monthly), len(plan.keep_weekly), len(plan.keep_daily), len(plan.delete)
+    ))
+
+
+@cli.command('benchmark-transport')
+@click.argument('source')
+@click.argument('destination', required=False)
+@click.option('--profile', multiple=True, help="Profile to benchmark (repeatable, default all)")
+@click.option('-p', '--port', default=22, show_default=True, help="SSH port of a user@host:/path destination")
+@click.option('-i', '--key', default='~/.ssh/id_rsa', show_default=True, help="SSH key of a user@host:/path destination")
+@click.option('-r', '--runs', default=1, show_default=True, help="Copies per profile")
+def benchmark_transport(source, destination, profile, port, key, runs):
+    """Copy a sample tree with each rsync transport profile and compare
+
+    \b
+    DESTINATION is a local folder or user@host:/path (default a local temp folder)
+    serverbackups benchmark-transport /var/www/sample root@backupbox:/tmp --profile lan --profile wan
+    """
+    from .transport import benchmark
+    from .utils import human_bytes
+    click.echo("{:<8} {:>4} {:>9} {:>9} {:>11} {:>11} {:>12}  {}".format('profile', 'run', 'seconds', 'files', 'size', 'sent', 'throughput', 'args'))
+    for row in benchmark(source, destination, profile or None, port, key, runs):
+        if not row['ok']:
+            click.secho("{:<8} {:>4} FAILED {}".format(row['profile'], row['run'], row['error']), fg='red')
+            continue
+        click.echo("{:<8} {:>4} {:>9.2f} {:>9} {:>11} {:>11} {:>12}  {}".format(
+            row['profile'], row['run'], row['seconds'], row['files'] or 0, human_bytes(row['totalFileSize'] or 0),
+            human_bytes(row['sentBytes'] or 0), human_bytes(row['throughput'] or 0) + '/s', row['args'],
+        ))
+
+
+@cli.command('catalog')
+@click.argument('location')
+@click.option('--last-good', is_flag=True, help="Only the newest successful snapshot")
+@click.option('--largest', is_flag=True, help="Largest snapshots (disk used) first")
+@click.option('--status', help="Only snapshots with this status (ok, failed)")
+@click.option('--since', help="Only snapshots since a YYYY-MM-DD (or YYYY-MM) prefix")
+@click.option('-n', '--limit', type=int, help="Max snapshots to show")
+@click.option('-p', '--port', default=22, show_default=True, help="SSH port of a user@host:/path location")
+@click.option('-i', '--key', default='~/.ssh/id_rsa', show_default=True, help="SSH key of a user@host:/path location")
+@click.option('--json', 'as_json', is_flag=True, help="Output catalog records as JSON lines")
+def catalog(location, last_good, largest, status, since, limit, port, key, as_json):
+    """Query the snapshot catalog of one server backup folder
+
+    \b
+    LOCATION is the server backup folder, local or user@host:/path
+    serverbackups catalog /mnt/backups/myserver.example.com --last-good
+    serverbackups catalog root@backupbox:/mnt/backups/web1 --largest --since 2026-10
+    """
+    import json
+    from .catalog import CATALOG, Catalog
+    from .runner import Runner, quote
+    from .utils import human_bytes
+
+    path = location.rstrip('/') + '/' + CATALOG
+    if ':' in location and not location.startswith('/'):
+        login, _, path = path.partition(':')
+        argv = ['ssh', '-p', str(port), '-i', os.path.expanduser(key), '-o', 'LogLevel=quiet', login, quote(['cat', path])]
+    else:
+        argv = ['cat', path]
+    result = Runner().run(argv)
+    if not result.ok: exit("Unable to read catalog {} ({})".format(location, result.stderr[-1] if result.stderr else result.returncode))
+
+    data = Catalog(result.stdout)
+    if last_good:
+        entries = [x for x in [data.last_good()] if x]
+    elif largest:
+        entries = data.largest(since=since, limit=limit or 10)
+    else:
+        entries = data.snapshots(status=status, since=since, limit=limit)
+
+    for entry in entries:
+        if as_json:
+            click.echo(json.dumps(entry))
+            continue
+        click.secho("{} {:<7} {:>8.1f}s {:>11} used {:>11} sent {:>10} files  mysql={} scripts={}".format(
+            entry['snapshot'], entry['status'], entry['duration'] or 0, human_bytes(entry['snapshotBytes'] or 0),
+            human_bytes(entry['bytes'] or 0), entry['files'] if entry['files'] is not None else '-',
+            len(entry['mysql']), len(entry['scripts']),
+        ), fg='green' if entry['status'] == 'ok' else 'red')
+
+
 def tt():
     print('tt here')
 
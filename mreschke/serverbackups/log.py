@@ -2,6 +2,7 @@ import logging
 import logging.config
 import re
 import sys
+import threading
 from logging import Formatter
 
 from colored import attr, bg, fg
@@ -44,23 +45,51 @@ def init(config={}):
         if config['console']['colors']:
             ch.setFormatter(ColoredFormatter(config['console']['format']))
         else:
-            ch.setFormatter(logging.Formatter(
+            ch.setFormatter(PrefixFormatter(
                 fmt=config['console']['format'],
                 datefmt='%Y-%m-%d %H:%M:%S'
             ))
+        ch.addFilter(PrefixFilter())
         logger.addHandler(ch)
 
     # New File Handler
     if config['file']['enabled']:
         fh = logging.FileHandler(filename=config['file']['file'], mode='a')
         fh.setLevel(config['file']['level'])
-        fh.setFormatter(logging.Formatter(
+        fh.setFormatter(PrefixFormatter(
             fmt=config['file']['format'],
             datefmt='%Y-%m-%d %H:%M:%S'
         ))
+        fh.addFilter(PrefixFilter())
         logger.addHandler(fh)
 
 
+# Per thread [prefix] of every logged line, servers backed up in parallel log with their name
+_context = threading.local()
+
+
+def prefix(name):
+    """Prefix every line this thread logs from now on with [name] (None for none), returns the previous prefix
+    """
+    previous = getattr(_context, 'prefix', None)
+    _context.prefix = name
+    return previous
+
+
+def bind(func):
+    """Get func wrapped to log with the prefix of the current thread (for worker threads it starts)
+    """
+    name = getattr(_context, 'prefix', None)
+
+    def bound(*args, **kwargs):
+        previous = prefix(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            prefix(previous)
+    return bound
+
+
 def debug(message):
     logging.debug(message)
 
@@ -133,6 +162,22 @@ def line():
     logging.info('-' * 80)
 
 
+class PrefixFilter(logging.Filter):
+    """Add the prefix of the logging thread to each record (record.prefix)"""
+
+    def filter(self, record):
+        record.prefix = getattr(_context, 'prefix', None)
+        return True
+
+
+class PrefixFormatter(Formatter):
+    """Plain formatter putting [prefix] in front of the message"""
+
+    def formatMessage(self, record):
+        if getattr(record, 'prefix', None): record.message = '[{}] {}'.format(record.prefix, record.message)
+        return Formatter.formatMessage(self, record)
+
+
 class ColoredFormatter(Formatter):
 
     def __init__(self, patern):
@@ -225,4 +270,8 @@ class ColoredFormatter(Formatter):
         elif (level == 'CRITICAL'):
             message = ('{0}{1}{2}{3}').format(fg('white'), bg('red'), message, attr(0))
 
+        # Server of a parallel run
+        if getattr(record, 'prefix', None):
+            message = ('{0}[{1}]{2} ').format(fg('cyan'), record.prefix, attr(0)) + message
+
         return message
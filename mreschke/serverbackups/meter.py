@@ -0,0 +1,56 @@
+import threading
+import time
+
+from . import log
+from .utils import human_bytes
+
+
+class Meter:
+    """Byte accounting for one stream piped through python
+
+    The Runner feeds every chunk through update(), the meter logs throughput every
+    interval seconds and keeps totals for the caller once the stream is done.
+    """
+
+    def __init__(self, name, interval=10, report=True):
+        self.name = name
+        self.interval = interval
+        self.report = report
+        self.bytes = 0
+        self.started = self._reported = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def update(self, count):
+        with self._lock:
+            now = time.time()
+            self.bytes += count
+            if self.report and self.interval and now - self._reported >= self.interval:
+                self._reported = now
+                log.bullet4("{} {} at {}/s".format(self.name, human_bytes(self.bytes), human_bytes(self.throughput)))
+
+    def done(self):
+        with self._lock:
+            self.finished = time.time()
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        """Bytes per second
+        """
+        return self.bytes / self.duration if self.duration > 0 else 0.0
+
+
+def stats(output, raw=None):
+    """Stream statistics of an output meter (and optional meter of the data before compression)
+    """
+    return {
+        'bytes': output.bytes,
+        'rawBytes': raw.bytes if raw else None,
+        'ratio': round(raw.bytes / output.bytes, 2) if raw and output.bytes else None,
+        'duration': round(output.duration, 3),
+        'throughput': round(output.throughput, 1),
+    }
@@ -0,0 +1,53 @@
+import os
+import shlex
+import subprocess
+from glob import glob
+
+# Trash folder in each server backup folder on DEST, pruned snapshots are renamed into it
+TRASH = '.trash'
+
+
+def script(trash, rate=0, nice=True):
+    """Shell script deleting everything in a trash folder, runs on the box holding the trash (sh only)
+
+    One reaper per trash folder at a time (flock on <trash>/.reaper.lock, a second one exits).
+    With nice the deletes run at the lowest cpu and idle io priority, rate limits them to about
+    rate files and folders per second (0=unlimited).  Killed half way the next reaper simply
+    continues with whatever is left in the trash, snapshots trashed meanwhile are picked up too.
+    """
+    low = 'low="nice -n 19"; command -v ionice >/dev/null 2>&1 && low="ionice -c 3 $low"; ' if nice else 'low=; '
+    if int(rate or 0) > 0:
+        # Children before their folder (find -depth), so every rm -d removes a file or an emptied folder
+        delete = ('$low find "$d" -depth -print0 | $low xargs -0 -r -n {} sh -c \'rm -df -- "$@"; sleep 1\' _; '
+                  '[ ! -e "$d" ] || exit 1').format(int(rate))
+    else:
+        delete = '$low rm -rf -- "$d" || exit 1'
+    return (
+        'cd {} 2>/dev/null || exit 0; '
+        'exec 9>>.reaper.lock; '
+        'if command -v flock >/dev/null 2>&1; then flock -n 9 || {{ echo "Reaper of $PWD already running"; exit 0; }}; fi; '
+        '{}'
+        'while :; do '
+        'found=; '
+        'for d in *; do [ -e "$d" ] || continue; found=1; {}; echo "Reaped $PWD/$d"; done; '
+        '[ -n "$found" ] || break; '
+        'done'
+    ).format(shlex.quote(trash), low, delete)
+
+
+def detached(trash, rate=0, nice=True):
+    """Shell command starting a reaper in the background, it keeps running after the command (or ssh) returns
+    """
+    return "nohup sh -c {} >/dev/null 2>&1 </dev/null &".format(shlex.quote(script(trash, rate, nice)))
+
+
+def trashes(path):
+    """Trash folders of a server folder or of every server of a destination path
+    """
+    return sorted(x for x in [os.path.join(path, TRASH)] + glob(os.path.join(path, '*', TRASH)) if os.path.isdir(x))
+
+
+def reap(trash, rate=0, nice=True):
+    """Run a reaper on a local trash folder in the foreground, returns its exit code
+    """
+    return subprocess.call(['sh', '-c', script(trash, rate, nice)])
@@ -0,0 +1,167 @@
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+
+class Phase:
+    """Timing and outcome of one phase of a server backup (prepare, files, mysql...)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.duration = 0.0
+        self.commands = 0
+        self.exit_codes = []
+        self.bytes = None
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None and not any(self.exit_codes)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'ok': self.ok,
+            'started': round(self.started, 3),
+            'duration': round(self.duration, 3),
+            'commands': self.commands,
+            'exitCodes': self.exit_codes,
+            'bytes': self.bytes,
+            'error': self.error,
+        }
+
+
+class Report:
+    """Structured result of one BackupServer run, exportable as JSON or Prometheus textfile"""
+
+    def __init__(self, server, cluster=None, snapshot=None, source=None, destination=None):
+        self.server = server
+        self.cluster = cluster
+        self.snapshot = snapshot
+        self.source = source
+        self.destination = destination
+        self.status = 'running'
+        self.started = time.time()
+        self.finished = None
+        self.phases = []
+        self.snapshot_bytes = None
+        self.snapshot_estimated = False
+        self.details = {}
+
+    @contextmanager
+    def phase(self, name, runner=None):
+        """Time a phase, every runner command started inside it counts toward its exit codes
+        Commands are found by the runner tag of the phase, so phases may run concurrently
+        """
+        phase = Phase(name)
+        self.phases.append(phase)
+        previous = runner.tag(name) if runner else None
+        try:
+            yield phase
+        except Exception as e:
+            phase.error = str(e) or e.__class__.__name__
+            raise
+        finally:
+            phase.duration = time.time() - phase.started
+            if runner:
+                runner.tag(previous)
+                results = runner.tagged(name)
+                phase.commands = len(results)
+                phase.exit_codes = [x.returncode for x in results]
+
+    def finish(self, status=None):
+        self.finished = time.time()
+        if status:
+            self.status = status
+        else:
+            self.status = 'ok' if all(phase.ok for phase in self.phases) else 'failed'
+        return self
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def bytes(self):
+        """Bytes transferred by every phase that reports bytes
+        """
+        counted = [phase.bytes for phase in self.phases if phase.bytes is not None]
+        return sum(counted) if counted else None
+
+    def to_dict(self):
+        return {
+            'server': self.server,
+            'cluster': self.cluster,
+            'snapshot': self.snapshot,
+            'source': self.source,
+            'destination': self.destination,
+            'status': self.status,
+            'started': round(self.started, 3),
+            'finished': round(self.finished, 3) if self.finished else None,
+            'duration': round(self.duration, 3),
+            'bytes': self.bytes,
+            'snapshotBytes': self.snapshot_bytes,
+            'snapshotBytesEstimated': self.snapshot_estimated,
+            'phases': [phase.to_dict() for phase in self.phases],
+            'details': self.details,
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, default=str)
+
+
+def to_json(reports):
+    """JSON document of many server reports
+    """
+    return json.dumps([report.to_dict() for report in reports], indent=2, default=str)
+
+
+def to_prometheus(reports):
+    """Prometheus textfile collector format of many server reports
+    """
+    metrics = [
+        ('serverbackups_run_success', 'gauge', '1 if the last backup of a server succeeded'),
+        ('serverbackups_run_duration_seconds', 'gauge', 'Wall time of the last backup of a server'),
+        ('serverbackups_run_finished_timestamp_seconds', 'gauge', 'Unix time the last backup of a server finished'),
+        ('serverbackups_run_bytes', 'gauge', 'Bytes transferred by the last backup of a server'),
+        ('serverbackups_snapshot_bytes', 'gauge', 'Size of the last snapshot of a server (estimated unless report.snapshotSize is on)'),
+        ('serverbackups_phase_duration_seconds', 'gauge', 'Wall time of each backup phase'),
+        ('serverbackups_phase_failures', 'gauge', 'Failed commands in each backup phase'),
+        ('serverbackups_phase_bytes', 'gauge', 'Bytes transferred by each backup phase'),
+    ]
+    samples = {name: [] for name, _, _ in metrics}
+    for report in reports:
+        labels = {'server': report.server, 'cluster': report.cluster or ''}
+        samples['serverbackups_run_success'].append((labels, 1 if report.status == 'ok' else 0))
+        samples['serverbackups_run_duration_seconds'].append((labels, report.duration))
+        samples['serverbackups_run_finished_timestamp_seconds'].append((labels, report.finished or 0))
+        if report.bytes is not None: samples['serverbackups_run_bytes'].append((labels, report.bytes))
+        if report.snapshot_bytes is not None: samples['serverbackups_snapshot_bytes'].append((labels, report.snapshot_bytes))
+        for phase in report.phases:
+            phase_labels = dict(labels, phase=phase.name)
+            samples['serverbackups_phase_duration_seconds'].append((phase_labels, phase.duration))
+            samples['serverbackups_phase_failures'].append((phase_labels, len([x for x in phase.exit_codes if x]) + (1 if phase.error else 0)))
+            if phase.bytes is not None: samples['serverbackups_phase_bytes'].append((phase_labels, phase.bytes))
+
+    lines = []
+    for name, type, help in metrics:
+        if not samples[name]: continue
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, type))
+        for labels, value in samples[name]:
+            label = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in sorted(labels.items()))
+            lines.append('{}{{{}}} {}'.format(name, label, round(value, 3) if isinstance(value, float) else value))
+    return '\n'.join(lines) + '\n'
+
+
+def write(path, content):
+    """Atomically write a report file (the prometheus textfile collector may read it at any time)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+    with os.fdopen(fd, 'w') as f: f.write(content)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, path)
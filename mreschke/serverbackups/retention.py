@@ -0,0 +1,88 @@
+import calendar
+import re
+import time
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+# Snapshot folder names are YYYY-MM-DD_HHMMSS
+SNAPSHOT_PATTERN = re.compile(r'^(\d{4})-(\d{2})-(\d{2})_(\d{6})$')
+
+# A snapshot name parsed once into its date
+Snapshot = namedtuple('Snapshot', ['name', 'date'])
+
+# Keep and delete sets for one prune run, every list is sorted oldest first
+Plan = namedtuple('Plan', ['keep_yearly', 'keep_monthly', 'keep_weekly', 'keep_daily', 'delete', 'ignored'])
+
+
+def parse(names):
+    """Parse snapshot names once into Snapshot records, sorted oldest first
+    Returns (snapshots, ignored) where ignored are names that are not snapshots
+    """
+    snapshots = []
+    ignored = []
+    for name in sorted(set(names)):
+        match = SNAPSHOT_PATTERN.match(name)
+        if not match:
+            ignored.append(name)
+            continue
+        try:
+            snapshots.append(Snapshot(name, date(int(match.group(1)), int(match.group(2)), int(match.group(3)))))
+        except ValueError:
+            ignored.append(name)
+    return snapshots, ignored
+
+
+def plan(names, today, keep_daily, keep_weekly, keep_monthly, keep_yearly):
+    """Plan which snapshots to keep and delete in a single pass over the names
+
+    Keep the last keep_yearly snapshots taken on 12/31, then of the rest the last
+    keep_monthly taken on the last day of a month, then of the rest the last
+    keep_weekly taken on a Saturday, then of the rest every snapshot newer than
+    keep_daily days.  Everything else is deleted.  Names that are not snapshots
+    are never deleted.
+    """
+    snapshots, ignored = parse(names)
+    daily_cutoff = today - timedelta(days=keep_daily)
+
+    # Bucket every snapshot by the last day of its year, month and week in one pass.
+    # Many snapshots share a day (hourly runs) so the calendar math is done once per day.
+    yearly, monthly, weekly, daily = [], [], [], []
+    days = {}
+    for snapshot in snapshots:
+        flags = days.get(snapshot.date)
+        if flags is None:
+            sd = snapshot.date
+            last_of_month = calendar.monthrange(sd.year, sd.month)[1]
+            flags = days[sd] = (
+                sd.month == 12 and sd.day == 31,  # Last day of the year
+                sd.day == last_of_month,          # Last day of the month
+                sd.isoweekday() == 6,             # Last day of the week (Saturday)
+                sd > daily_cutoff,                # Inside the daily window
+            )
+        if flags[0]: yearly.append(snapshot.name)
+        if flags[1]: monthly.append(snapshot.name)
+        if flags[2]: weekly.append(snapshot.name)
+        if flags[3]: daily.append(snapshot.name)
+
+    # Each pass only considers snapshots not already kept by a previous pass
+    keep_yearly = yearly[-keep_yearly:]
+    kept = set(keep_yearly)
+    keep_monthly = [x for x in monthly if x not in kept][-keep_monthly:]
+    kept.update(keep_monthly)
+    keep_weekly = [x for x in weekly if x not in kept][-keep_weekly:]
+    kept.update(keep_weekly)
+    keep_daily = [x for x in daily if x not in kept]
+    kept.update(keep_daily)
+
+    delete = [x.name for x in snapshots if x.name not in kept]
+    return Plan(keep_yearly, keep_monthly, keep_weekly, keep_daily, delete, ignored)
+
+
+def benchmark(count=100000, keep_daily=30, keep_weekly=24, keep_monthly=60, keep_yearly=10):
+    """Time a plan over count synthetic hourly snapshot names, returns (plan, seconds)
+    """
+    now = datetime(2030, 1, 1, 0, 15, 27)
+    names = [(now - timedelta(hours=i)).strftime("%Y-%m-%d_%H%M%S") for i in range(count)]
+    start = time.time()
+    result = plan(names, now.date(), keep_daily, keep_weekly, keep_monthly, keep_yearly)
+    return result, time.time() - start
@@ -0,0 +1,152 @@
+import re
+import time
+
+from . import log
+from .utils import human_bytes
+
+# rsync --info=progress2 line, one total for the whole transfer
+#      1,234,567  45%   12.34MB/s    0:00:10 (xfr#12, to-chk=100/2000)
+PROGRESS = re.compile(r'^\s*([\d,.]+)\s+(\d+)%\s+(\S+/s)\s+(\d+:\d\d:\d\d)(?:\s+\(xfr#(\d+), (?:ir|to)-chk=(\d+)/(\d+)\))?')
+
+# rsync --itemize-changes line, YXcstpoguax followed by the path
+#   >f+++++++++ etc/hosts
+ITEMIZE = re.compile(r'^([<>ch.])([fdLDS])([^ ]{9}) (.*)$')
+
+# rsync --stats summary lines, {key: (regex, type)}.  Old rsync (before 3.1) prints numbers
+# without thousands separators and says "Number of files transferred"
+STATS = {
+    'files': (r'^Number of files: ([\d,]+)', int),
+    'createdFiles': (r'^Number of created files: ([\d,]+)', int),
+    'deletedFiles': (r'^Number of deleted files: ([\d,]+)', int),
+    'transferredFiles': (r'^Number of (?:regular )?files transferred: ([\d,]+)', int),
+    'totalFileSize': (r'^Total file size: ([\d,]+) bytes', int),
+    'transferredFileSize': (r'^Total transferred file size: ([\d,]+) bytes', int),
+    'literalBytes': (r'^Literal data: ([\d,]+) bytes', int),
+    'matchedBytes': (r'^Matched data: ([\d,]+) bytes', int),
+    'fileListSize': (r'^File list size: ([\d,]+)', int),
+    'fileListGenerationTime': (r'^File list generation time: ([\d,.]+) seconds', float),
+    'fileListTransferTime': (r'^File list transfer time: ([\d,.]+) seconds', float),
+    'sentBytes': (r'^Total bytes sent: ([\d,]+)', int),
+    'receivedBytes': (r'^Total bytes received: ([\d,]+)', int),
+    'speedup': (r'^total size is [\d,]+\s+speedup is ([\d,.]+)', float),
+}
+STATS = {key: (re.compile(pattern), type) for key, (pattern, type) in STATS.items()}
+
+
+class RsyncStats:
+    """Incremental parser of rsync --stats, --itemize-changes and --info=progress2 output
+
+    Feed every stdout line of rsync to feed().  Itemized changes are counted (not
+    logged), progress lines are folded into one aggregated progress line logged every
+    interval seconds and the --stats summary is parsed at the end of the run.
+    """
+
+    def __init__(self, name='rsync', interval=10, report=True):
+        self.name = name
+        self.interval = interval
+        self.report = report
+        self.started = self._reported = time.time()
+        self.stats = {key: None for key in STATS}
+        self.itemized = {'transferred': 0, 'created': 0, 'deleted': 0, 'hardlinked': 0, 'changed': 0}
+        self.progress = None
+        self.lines = 0
+
+    def feed(self, line):
+        """Parse one line of rsync output
+        """
+        self.lines += 1
+        if line.startswith('*deleting'):
+            self.itemized['deleted'] += 1
+            return
+        match = ITEMIZE.match(line)
+        if match:
+            self.itemize(*match.groups())
+            return
+        match = PROGRESS.match(line)
+        if match:
+            self.progress = {
+                'bytes': int(self.number(match.group(1)).split('.')[0]),
+                'percent': int(match.group(2)),
+                'rate': match.group(3),
+                'elapsed': match.group(4),
+                'transferred': int(match.group(5)) if match.group(5) else None,
+                'remaining': int(match.group(6)) if match.group(6) else None,
+                'total': int(match.group(7)) if match.group(7) else None,
+            }
+            self.log_progress()
+            return
+        for key, (pattern, type) in STATS.items():
+            match = pattern.match(line)
+            if match:
+                self.stats[key] = type(self.number(match.group(1)))
+                return
+
+    def itemize(self, update, kind, attributes, path):
+        """Count one itemized change (update type, file type, attribute flags, path)
+        """
+        if update in '<>':
+            self.itemized['transferred'] += 1
+        elif update == 'h':
+            self.itemized['hardlinked'] += 1
+        elif attributes.startswith('+'):
+            self.itemized['created'] += 1
+        else:
+            self.itemized['changed'] += 1
+
+    def log_progress(self, force=False):
+        """Log the aggregated progress line every interval seconds
+        """
+        if not self.report or not self.progress: return
+        now = time.time()
+        if not force and (not self.interval or now - self._reported < self.interval): return
+        self._reported = now
+        progress = self.progress
+        checked = ''
+        if progress['total']:
+            checked = ", {:,}/{:,} files checked".format(progress['total'] - progress['remaining'], progress['total'])
+        log.bullet4("{} {}% {} at {} ({:,} files transferred{}, {} elapsed)".format(
+            self.name, progress['percent'], human_bytes(progress['bytes']), progress['rate'],
+            self.itemized['transferred'], checked, progress['elapsed'],
+        ))
+
+    def number(self, value):
+        return value.replace(',', '')
+
+    def to_dict(self):
+        """Transfer statistics of the run, None for anything rsync did not report
+        """
+        return dict(
+            self.stats,
+            duration=round(time.time() - self.started, 3),
+            itemized=dict(self.itemized),
+        )
+
+    def summary(self):
+        """One line summary of the run for the log
+        """
+        stats = self.stats
+        if stats['files'] is None: return "{} {:,} files transferred".format(self.name, self.itemized['transferred'])
+        return "{} {:,} files scanned, {:,} transferred, {:,} created, {:,} deleted, {} literal, {} matched, speedup {}".format(
+            self.name, stats['files'], stats['transferredFiles'] or 0,
+            self.itemized['created'] if stats['createdFiles'] is None else stats['createdFiles'],
+            self.itemized['deleted'] if stats['deletedFiles'] is None else stats['deletedFiles'],
+            human_bytes(stats['literalBytes'] or 0), human_bytes(stats['matchedBytes'] or 0), stats['speedup'],
+        )
+
+    @staticmethod
+    def combine(stats):
+        """Fold the to_dict() statistics of parallel rsync streams into one
+        """
+        stats = [x for x in stats if x]
+        if not stats: return None
+        if len(stats) == 1: return stats[0]
+        combined = {}
+        for key in list(STATS) + ['duration']:
+            values = [x[key] for x in stats if x.get(key) is not None]
+            combined[key] = sum(values) if values else None
+        combined['duration'] = max(x['duration'] for x in stats)
+        combined['itemized'] = {key: sum(x['itemized'][key] for x in stats) for key in stats[0]['itemized']}
+        sent = (combined['sentBytes'] or 0) + (combined['receivedBytes'] or 0)
+        combined['speedup'] = round(combined['totalFileSize'] / sent, 2) if combined['totalFileSize'] and sent else None
+        combined['streams'] = len(stats)
+        return combined
@@ -0,0 +1,295 @@
+import os
+import re
+import shlex
+import signal
+import subprocess
+import threading
+import time
+
+from . import log
+
+
+def quote(argv):
+    """Get a shell safe string from an argv list, used for logging and remote ssh commands
+    """
+    return ' '.join(shlex.quote(str(arg)) for arg in argv)
+
+
+def pipeline_string(stages):
+    """Get a shell safe string from a pipeline of argv lists (cmd1 | cmd2 | ...)
+    """
+    return ' | '.join(quote(stage) for stage in stages)
+
+
+class Result:
+    """Outcome of one command or pipeline run through the Runner"""
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.returncode = None
+        self.returncodes = []
+        self.stdout = []
+        self.stderr = []
+        self.started = time.time()
+        self.duration = 0.0
+        self.timed_out = False
+        self.cancelled = False
+        self.stats = None
+        self.tag = None
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out and not self.cancelled
+
+    def words(self):
+        """All stdout split on whitespace, same as the old subprocess .stdout.decode().split()
+        """
+        return ' '.join(self.stdout).split()
+
+    def __repr__(self):
+        return "<Result rc={} {:.2f}s {}>".format(self.returncode, self.duration, self.argv)
+
+
+class Runner:
+    """Managed subprocess execution
+
+    Commands are argv lists (or pipelines of argv lists) executed without a local
+    shell.  Stdout and stderr are streamed line by line to optional callbacks,
+    exit status and wall time are recorded for every call, and calls support a
+    timeout and cancellation.  A Runner is thread safe so callers can run many
+    commands concurrently.  Results are tagged with the tag of the thread that ran
+    them (see tag() and wrap()), so concurrent callers can find their own results.
+    """
+
+    def __init__(self):
+        self.results = []
+        self._lock = threading.Lock()
+        self._procs = set()
+        self._cancelled = threading.Event()
+        self._local = threading.local()
+
+    def tag(self, tag):
+        """Tag every result of commands started by this thread from now on, returns the previous tag
+        """
+        previous = getattr(self._local, 'tag', None)
+        self._local.tag = tag
+        return previous
+
+    def wrap(self, func):
+        """Get func wrapped to run with the current thread tag and log prefix (for worker threads started by a tagged caller)
+        """
+        tag = getattr(self._local, 'tag', None)
+
+        def tagged(*args, **kwargs):
+            previous = self.tag(tag)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.tag(previous)
+        return log.bind(tagged)
+
+    def tagged(self, tag):
+        """Results of every command run under a tag
+        """
+        with self._lock:
+            return [x for x in self.results if x.tag == tag]
+
+    def run(self, argv, **kwargs):
+        """Run a single argv command, see pipeline() for options
+        """
+        return self.pipeline([argv], **kwargs)
+
+    def pipeline(self, stages, input=None, stdout=None, passthrough=False, capture=True,
+                 on_stdout=None, on_stderr=None, timeout=None, meters=None):
+        """Run argv stages connected stdout -> stdin (cmd1 | cmd2 | ...)
+        input       bytes written to the first stage stdin
+        stdout      file object receiving the last stage stdout instead of python
+        passthrough inherit this process stdout/stderr (console output as-is)
+        capture     keep stdout/stderr lines on the Result
+        on_stdout   callback(line) for each stdout line of the last stage
+        on_stderr   callback(line) for each stderr line of any stage
+        timeout     seconds before every stage is killed (with every process it started)
+        meters      {stage index: Meter}, that stage stdout is piped through python and counted
+                    (the last stage can only be metered into a stdout file)
+        """
+        meters = meters or {}
+        result = Result(stages[0] if len(stages) == 1 else stages)
+        if self._cancelled.is_set():
+            result.cancelled = True
+            return self._finish(result)
+
+        procs = []
+        pumps = []
+        try:
+            for i, argv in enumerate(stages):
+                last = i == len(stages) - 1
+                if i == 0:
+                    stdin = subprocess.PIPE if input is not None else subprocess.DEVNULL
+                elif i - 1 in meters:
+                    stdin = subprocess.PIPE
+                else:
+                    stdin = procs[-1].stdout
+                if last and stdout is not None and i in meters:
+                    out = subprocess.PIPE
+                elif last and stdout is not None:
+                    out = stdout
+                elif last and passthrough:
+                    out = None
+                else:
+                    out = subprocess.PIPE
+                # Each stage leads its own process group, so a timeout or cancel also kills what it
+                # started (sh -c children), which would otherwise keep the pipes open
+                proc = subprocess.Popen(
+                    [str(arg) for arg in argv], stdin=stdin, stdout=out,
+                    stderr=None if passthrough else subprocess.PIPE, start_new_session=True,
+                )
+                if i > 0 and i - 1 in meters:
+                    # Count the previous stage output on its way into this stage
+                    pumps.append(self._meter(procs[-1].stdout, proc.stdin, meters[i - 1], close=True))
+                elif i > 0:
+                    # Parent must let go of the previous stage stdout so SIGPIPE propagates
+                    procs[-1].stdout.close()
+                procs.append(proc)
+                self._track(proc)
+                if proc.stderr:
+                    pumps.append(self._pump(proc.stderr, result.stderr if capture else None, on_stderr))
+        except OSError as e:
+            # Command not found or not executable
+            for proc in procs: self._kill(proc)
+            result.returncode = 127
+            result.stderr.append(str(e))
+            if on_stderr: on_stderr(str(e))
+            return self._finish(result, procs)
+
+        last = procs[-1]
+        if last.stdout and len(procs) - 1 in meters and stdout is not None:
+            pumps.append(self._meter(last.stdout, stdout, meters[len(procs) - 1], close=False))
+        elif last.stdout and last.stdout is not stdout:
+            pumps.append(self._pump(last.stdout, result.stdout if capture else None, on_stdout))
+        if input is not None:
+            pumps.append(self._feed(procs[0].stdin, input))
+
+        # Wait for every stage, last first, then for the pipes to drain, all within the timeout.
+        # Processes a stage left behind may hold a pipe open after the stage exited.
+        deadline = time.time() + timeout if timeout is not None else None
+        try:
+            for proc in reversed(procs): proc.wait(timeout=self._remaining(deadline))
+            for pump in pumps:
+                pump.join(self._remaining(deadline))
+                if pump.is_alive(): raise subprocess.TimeoutExpired(result.argv, timeout)
+        except subprocess.TimeoutExpired:
+            result.timed_out = True
+            for proc in procs: self._kill(proc)
+        for proc in procs: proc.wait()
+        for pump in pumps: pump.join()
+
+        if self._cancelled.is_set(): result.cancelled = True
+        return self._finish(result, procs)
+
+    def cancel(self):
+        """Kill every running command and refuse to start new ones
+        """
+        self._cancelled.set()
+        with self._lock:
+            for proc in self._procs: self._kill(proc)
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _finish(self, result, procs=None):
+        procs = procs or []
+        result.tag = getattr(self._local, 'tag', None)
+        result.duration = time.time() - result.started
+        result.returncodes = [proc.returncode for proc in procs]
+        if procs:
+            # Like bash pipefail, the rightmost failing stage wins
+            failed = [rc for rc in result.returncodes if rc != 0]
+            result.returncode = failed[-1] if failed else 0
+        elif result.returncode is None:
+            result.returncode = -1
+        with self._lock:
+            for proc in procs: self._procs.discard(proc)
+            self.results.append(result)
+        return result
+
+    def _track(self, proc):
+        with self._lock:
+            self._procs.add(proc)
+            if self._cancelled.is_set(): self._kill(proc)
+
+    @staticmethod
+    def _kill(proc):
+        """Kill the process group of a stage (the stage and every process it started)
+        """
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            # Group already gone, the stage itself may still need reaping
+            if proc.poll() is None: proc.kill()
+
+    @staticmethod
+    def _remaining(deadline):
+        """Seconds left until deadline (None waits forever)
+        """
+        return None if deadline is None else max(0.0, deadline - time.time())
+
+    def _pump(self, pipe, lines, callback):
+        """Read a pipe in a thread, splitting lines on \\n or \\r (rsync progress uses \\r)
+        """
+        def pump():
+            buffer = b''
+            for chunk in iter(lambda: pipe.read1(65536) if hasattr(pipe, 'read1') else pipe.read(65536), b''):
+                parts = re.split(b'[\r\n]', buffer + chunk)
+                buffer = parts.pop()
+                for part in parts: self._line(part, lines, callback)
+            if buffer: self._line(buffer, lines, callback)
+            pipe.close()
+        thread = threading.Thread(target=log.bind(pump), daemon=True)
+        thread.start()
+        return thread
+
+    def _line(self, raw, lines, callback):
+        if not raw: return
+        line = raw.decode('utf-8', 'replace')
+        if lines is not None: lines.append(line)
+        if callback: callback(line)
+
+    def _meter(self, source, sink, meter, close):
+        """Copy a pipe into a sink (next stage stdin or output file) in a thread, counting bytes
+        """
+        def copy():
+            fd = source.fileno()
+            try:
+                for chunk in iter(lambda: os.read(fd, 1048576), b''):
+                    meter.update(len(chunk))
+                    sink.write(chunk)
+            except (BrokenPipeError, ValueError):
+                # Downstream stage died, closing our source lets SIGPIPE reach upstream
+                pass
+            finally:
+                meter.done()
+                source.close()
+                if close:
+                    try:
+                        sink.close()
+                    except BrokenPipeError:
+                        pass
+        thread = threading.Thread(target=log.bind(copy), daemon=True)
+        thread.start()
+        return thread
+
+    def _feed(self, pipe, data):
+        def feed():
+            try:
+                pipe.write(data)
+            except BrokenPipeError:
+                pass
+            finally:
+                try:
+                    pipe.close()
+                except BrokenPipeError:
+                    pass
+        thread = threading.Thread(target=log.bind(feed), daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,153 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import log
+
+
+class Scheduler:
+    """Run many server backups on a bounded pool of workers
+
+    Each job is a (server, options) pair run as its own BackupServer.  Besides the
+    overall worker count, jobs can be capped per destination (so one backup box
+    is not hit by 20 rsyncs at once) and per source server.
+    """
+
+    def __init__(self, workers=1, max_per_destination=None, max_per_source=None):
+        self.workers = max(1, int(workers or 1))
+        self.max_per_destination = max_per_destination
+        self.max_per_source = max_per_source
+
+        # Running job counts keyed by destination and source, guarded by a condition
+        self._cond = threading.Condition()
+        self._running = 0
+        self._destinations = {}
+
+        # Backups of the running jobs, cancelled on Ctrl-C (see cancel)
+        self._backups = set()
+        self._cancelled = False
+        self._sources = {}
+
+    def run(self, jobs, factory):
+        """Run all jobs and return a list of per server summaries (in job order)
+        factory(server, options) must return an object with .run() and .cancel() methods, the run return
+        value (a BackupServer Report) is kept in each summary as 'result'
+        """
+        pending = list(enumerate(jobs))
+        results = [None] * len(pending)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                while pending:
+                    with self._cond:
+                        job = self._next(pending)
+                        while job is None:
+                            self._cond.wait()
+                            job = self._next(pending)
+                        pending.remove(job)
+                        self._acquire(job[1])
+                    index, (server, options) = job
+                    pool.submit(self._work, index, server, options, factory, results)
+                pool.shutdown(wait=True)
+            except KeyboardInterrupt:
+                # Ctrl-C only reaches this thread, the servers running in the workers are cancelled
+                self.cancel()
+                raise
+
+        self.summary(results)
+        return results
+
+    def cancel(self):
+        """Kill the running commands of every running backup, backups started later are cancelled at once
+        """
+        with self._cond:
+            self._cancelled = True
+            for backup in self._backups: backup.cancel()
+
+    def summary(self, results):
+        """Log a combined summary once every worker is done
+        """
+        log.blank()
+        log.separator()
+        log.header3("Backup summary ({} servers, {} workers)".format(len(results), self.workers))
+        log.separator()
+        for result in results:
+            message = "{} {} in {:.1f}s".format(result['server'], result['status'].upper(), result['duration'])
+            if result['error']: message += " ({})".format(result['error'])
+            if result['status'] == 'failed':
+                log.error(message)
+            else:
+                log.bullet(message)
+
+    def _work(self, index, server, options, factory, results):
+        # Lines of servers running side by side are told apart by a [server] prefix
+        previous = log.prefix(server) if self.workers > 1 else None
+        start = time.time()
+        result = {'server': server, 'status': 'ok', 'duration': 0.0, 'error': None, 'result': None}
+        backup = None
+        try:
+            if not options['enabled']: result['status'] = 'disabled'
+            backup = factory(server, options)
+            with self._cond:
+                if self._cancelled: backup.cancel()
+                self._backups.add(backup)
+            result['result'] = backup.run()
+            # Failed commands inside a run do not raise, the run report has them
+            failed = [x.name for x in getattr(result['result'], 'phases', []) if not x.ok]
+            if failed:
+                result['status'] = 'failed'
+                result['error'] = "failed phases {}".format(', '.join(failed))
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+            result['result'] = getattr(backup, 'report', None)
+            log.exception("Backup of server {} failed".format(server))
+        finally:
+            result['duration'] = time.time() - start
+            results[index] = result
+            with self._cond:
+                self._backups.discard(backup)
+                self._release(options)
+                self._cond.notify_all()
+            if self.workers > 1: log.prefix(previous)
+
+    def _next(self, pending):
+        """First pending job that fits inside every concurrency cap, or None
+        """
+        if self._running >= self.workers: return None
+        for job in pending:
+            options = job[1][1]
+            if self._fits(self._destinations, self.destination_key(options), self.max_per_destination) \
+                    and self._fits(self._sources, self.source_key(options), self.max_per_source):
+                return job
+        return None
+
+    def _fits(self, counts, key, limit):
+        return not limit or counts.get(key, 0) < limit
+
+    def _acquire(self, job):
+        options = job[1]
+        self._running += 1
+        for counts, key in ((self._destinations, self.destination_key(options)), (self._sources, self.source_key(options))):
+            counts[key] = counts.get(key, 0) + 1
+
+    def _release(self, options):
+        self._running -= 1
+        for counts, key in ((self._destinations, self.destination_key(options)), (self._sources, self.source_key(options))):
+            counts[key] -= 1
+
+    @staticmethod
+    def destination_key(options):
+        """Destination box a server backs up to, local destinations share one key
+        """
+        dest = options['destination']
+        if dest['location'] == 'ssh': return 'ssh://{}:{}'.format(dest['ssh']['host'], dest['ssh']['port'])
+        return 'local'
+
+    @staticmethod
+    def source_key(options):
+        """Source box a server is backed up from, local sources share one key
+        """
+        src = options['source']
+        if src['location'] == 'ssh': return 'ssh://{}:{}'.format(src['ssh']['host'], src['ssh']['port'])
+        return 'local'
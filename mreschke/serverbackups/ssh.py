@@ -0,0 +1,78 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from . import log
+
+
+class SshPool:
+    """Persistent ssh ControlMaster connections keyed by (user, host, port, key)
+
+    The first command to a host opens one master connection, every later ssh
+    command (and rsync -e transport) for the same (user, host, port, key) rides
+    on that master instead of paying a new TCP and SSH handshake.  A pool can be
+    shared by many BackupServer instances, call close() when done with it.
+    """
+
+    def __init__(self, persist=300):
+        # Masters exit on their own after persist idle seconds, even if close() is never called
+        self.persist = persist
+        self.dir = None
+        self.masters = {}
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def options(self, user, host, port, key, args=()):
+        """Get ssh -o options that reuse (opening if needed) the master for this connection
+        args are extra ssh arguments (like a -c cipher) the master is opened with
+        """
+        control_path = self.connect(user, host, port, key, args)
+        if not control_path: return []
+        return ['-o', 'ControlMaster=no', '-o', 'ControlPath=' + control_path]
+
+    def connect(self, user, host, port, key, args=()):
+        """Open the master connection for (user, host, port, key, args) once, return its control socket path
+        """
+        ident = (user, host, str(port), key) + tuple(args)
+        with self._lock:
+            if not self.dir: self.dir = tempfile.mkdtemp(prefix='sb-ssh-')
+            lock = self._locks.setdefault(ident, threading.Lock())
+
+        # One lock per connection so masters to different hosts open concurrently
+        with lock:
+            if ident in self.masters: return self.masters[ident]
+
+            # Socket paths are limited to ~100 chars, so use a short hash of the connection
+            control_path = os.path.join(self.dir, hashlib.sha1('|'.join(ident).encode()).hexdigest()[:12])
+            argv = [
+                'ssh', '-M', '-N', '-f',
+                '-o', 'ControlPath=' + control_path,
+                '-o', 'ControlPersist={}'.format(self.persist),
+                '-o', 'LogLevel=quiet',
+                '-p', str(port), '-i', key,
+            ] + list(args) + [user + '@' + host]
+            log.bullet4("Opening ssh master connection to {}@{}:{}".format(user, host, port))
+            if subprocess.call(argv, stdin=subprocess.DEVNULL) != 0:
+                # Commands still work without a master, ssh simply connects directly
+                log.warning("Unable to open ssh master connection to {}@{}:{}, using direct connections".format(user, host, port))
+                control_path = None
+            self.masters[ident] = control_path
+            return control_path
+
+    def close(self):
+        """Exit every master connection and remove the control socket directory
+        """
+        with self._lock:
+            for (user, host, port, key, *args), control_path in list(self.masters.items()):
+                if not control_path: continue
+                subprocess.call(
+                    ['ssh', '-O', 'exit', '-o', 'ControlPath=' + control_path, '-o', 'LogLevel=quiet', '-p', port, user + '@' + host],
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                )
+            self.masters = {}
+            self._locks = {}
+            if self.dir: shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
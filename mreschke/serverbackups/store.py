@@ -0,0 +1,373 @@
+import fcntl
+import hashlib
+import io
+import json
+import os
+import subprocess
+import tarfile
+import threading
+import time
+import zlib
+from glob import glob
+
+from . import log
+from .archive import entries, is_archived, read
+from .runner import quote
+
+# Output files kept in the store are replaced by a recipe (list of chunks) with this extension
+RECIPE_EXT = '.recipe'
+
+# Default store folder, relative to the destination path so every server on a destination shares it
+STORE_DIR = '.store'
+
+
+class Store:
+    """Content addressed chunk store shared by every server backing up to one destination
+
+    Generated outputs (mysqldumps, script outputs) are cut into content defined
+    chunks at line boundaries, so an unchanged region of a dump produces the same
+    chunks every night and is stored only once, across snapshots and servers.
+    Chunks are kept zlib compressed in <root>/chunks/ab/<sha256>, <root>/index lists
+    every stored chunk so new chunks are found without touching the chunk folders.
+    For ssh destinations new chunks are streamed as one tar per output over ssh.
+
+    A chunk is only known (reusable by other outputs) once its upload is confirmed,
+    an output reusing a chunk another output is still uploading waits for it before
+    its recipe is written.  While loaded the store holds a shared lock on <root>/lock,
+    gc takes it exclusively so it never runs while backups use the store.
+    """
+
+    def __init__(self, root, ssh=None, chunk_size=1048576, level=6):
+        # ssh is the ssh argv (up to and including user@host) of a remote store, None for local
+        self.root = root.rstrip('/')
+        self.ssh = ssh
+        self.chunk_size = chunk_size
+        self.level = level
+        self.known = None
+        self.pending = set()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._holder = None
+
+    def load(self):
+        """Lock the store (shared) and load the chunk index once
+        """
+        with self._lock:
+            if self.known is not None: return self.known
+            index = self.root + '/index'
+            if self.ssh:
+                script = "mkdir -p {0}/chunks && cat {0}/index 2>/dev/null || true".format(quote([self.root]))
+                proc = subprocess.run(self.ssh + [script], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if proc.returncode != 0: raise OSError("Unable to read chunk index {} ({})".format(index, proc.stderr.decode().strip()))
+                data = proc.stdout.decode()
+            else:
+                os.makedirs(self.root + '/chunks', exist_ok=True)
+                data = open(index).read() if os.path.exists(index) else ''
+            self._hold()
+            self.known = set(line for line in data.split('\n') if len(line) == 64)
+            return self.known
+
+    def _hold(self):
+        """Take the shared store lock, held until close()
+        """
+        lock = self.root + '/lock'
+        if not self.ssh:
+            self._holder = open(lock, 'a')
+            fcntl.flock(self._holder, fcntl.LOCK_SH)
+            return
+        # Remote stores are locked by an ssh flock holding the lock until its stdin is closed
+        script = "exec flock -s {} sh -c 'echo locked; exec cat >/dev/null'".format(quote([lock]))
+        self._holder = subprocess.Popen(self.ssh + [script], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if self._holder.stdout.readline().strip() != b'locked':
+            self.close()
+            log.warning("Unable to lock chunk store {} (no flock on the destination?), do not run store-gc during backups".format(lock))
+
+    def close(self):
+        """Release the store lock
+        """
+        holder, self._holder = self._holder, None
+        if not holder: return
+        if self.ssh:
+            holder.stdin.close()
+            holder.wait()
+        else:
+            holder.close()
+
+    def writer(self, recipe):
+        """Get a ChunkWriter storing one output whose recipe is written to the recipe path
+        """
+        self.load()
+        return ChunkWriter(self, recipe)
+
+    def claim(self, digest):
+        """Get 'new' if this chunk must be uploaded by the caller (claimed only once), 'pending'
+        if another output is uploading it, 'stored' if it is already stored
+        """
+        with self._lock:
+            if digest in self.known: return 'stored'
+            if digest in self.pending: return 'pending'
+            self.pending.add(digest)
+            return 'new'
+
+    def confirm(self, digests):
+        """Mark claimed chunks as stored, their upload succeeded
+        """
+        with self._cond:
+            self.pending.difference_update(digests)
+            self.known.update(digests)
+            self._cond.notify_all()
+
+    def release(self, digests):
+        """Forget chunks claimed by an upload that failed, another output may upload them again
+        """
+        with self._cond:
+            self.pending.difference_update(x for x in digests if x not in self.known)
+            self._cond.notify_all()
+
+    def wait(self, digests):
+        """Wait until chunks other outputs are uploading are confirmed or released
+        Returns True if every chunk is stored
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: not any(x in self.pending for x in digests))
+            return all(x in self.known for x in digests)
+
+    def chunk_path(self, digest):
+        return '{}/chunks/{}/{}'.format(self.root, digest[:2], digest)
+
+
+class ChunkWriter:
+    """File like sink (write/close) cutting one output stream into stored chunks
+
+    A chunk ends at a newline once it is at least chunk_size/4 long and the crc of
+    its last line falls under a threshold proportional to the line length (so
+    chunks average about chunk_size whatever the line lengths).  Data without
+    newlines is cut every chunk_size*4 bytes.
+    """
+
+    def __init__(self, store, recipe):
+        self.store = store
+        self.recipe = recipe
+        self.min = store.chunk_size // 4
+        self.max = store.chunk_size * 4
+        self.buffer = bytearray()
+        self.scan = 0
+        self.chunks = []
+        self.bytes = 0
+        self.new_chunks = 0
+        self.new_bytes = 0
+        self.stored_bytes = 0
+        self.hash = hashlib.sha256()
+        self.error = None
+        self._claimed = []
+        self._waiting = set()
+        self._upload = None
+        self._tar = None
+
+    def write(self, data):
+        if self.error: raise ValueError(self.error)
+        try:
+            self.buffer += data
+            self.bytes += len(data)
+            self.hash.update(data)
+            self._cut()
+        except Exception as e:
+            self.error = str(e) or e.__class__.__name__
+            raise ValueError(self.error)
+        return len(data)
+
+    def _cut(self):
+        buffer = self.buffer
+        start = 0  # Start of the chunk being built
+        line = self.scan  # Start of the first line not yet looked at
+        while True:
+            newline = buffer.find(b'\n', line)
+            if newline == -1 or newline + 1 - start > self.max:
+                # No newline inside max bytes (very long lines or binary data), cut at max
+                if len(buffer) - start < self.max: break
+                self._chunk(bytes(buffer[start:start + self.max]))
+                start += self.max
+                line = max(line, start)
+                continue
+            end = newline + 1
+            size = end - start
+            if size >= self.min and zlib.crc32(buffer[line:end]) < min(1.0, (end - line) / self.store.chunk_size) * 0xFFFFFFFF:
+                self._chunk(bytes(buffer[start:end]))
+                start = end
+            line = end
+        del buffer[:start]
+        self.scan = line - start
+
+    def _chunk(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        self.chunks.append([digest, len(data)])
+        state = self.store.claim(digest)
+        if state == 'pending': self._waiting.add(digest)
+        if state != 'new': return
+        self._claimed.append(digest)
+        compressed = zlib.compress(data, self.store.level)
+        self.new_chunks += 1
+        self.new_bytes += len(data)
+        self.stored_bytes += len(compressed)
+        self._put(digest, compressed)
+
+    def _put(self, digest, compressed):
+        """Save one new chunk, straight to disk or into the tar stream of a remote store
+        """
+        if not self.store.ssh:
+            path = self.store.chunk_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'wb') as f: f.write(compressed)
+            os.rename(tmp, path)
+            self.store.confirm([digest])
+            return
+        if not self._upload:
+            script = "mkdir -p {0} && tar -x -C {0}".format(quote([self.store.root + '/chunks']))
+            self._upload = subprocess.Popen(self.store.ssh + [script], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+            self._tar = tarfile.open(fileobj=self._upload.stdin, mode='w|')
+        info = tarfile.TarInfo('{}/{}'.format(digest[:2], digest))
+        info.size = len(compressed)
+        info.mtime = time.time()
+        self._tar.addfile(info, io.BytesIO(compressed))
+
+    def close(self, ok=True):
+        """Store the remaining data, finish the upload and write the recipe (only if ok)
+        Returns True if the output is completely stored
+        """
+        try:
+            if self.buffer and not self.error: self._chunk(bytes(self.buffer))
+            self.buffer = bytearray()
+            if self._upload:
+                self._tar.close()
+                self._upload.stdin.close()
+                stderr = self._upload.stderr.read().decode().strip()
+                if self._upload.wait() != 0: raise OSError("Chunk upload failed ({})".format(stderr))
+        except Exception as e:
+            self.error = self.error or str(e) or e.__class__.__name__
+        if self.error or not ok:
+            # Chunks of a failed output may be missing or partial, upload them again next time
+            self.store.release(self._claimed)
+            if self.error: log.error("Storing {} failed ({})".format(self.recipe, self.error))
+            return False
+
+        # Every chunk of this output must be stored before its recipe points to it, its own uploads
+        # are complete now, chunks reused from outputs still uploading them are waited for
+        self.store.confirm(self._claimed)
+        if not self.store.wait(self._waiting):
+            self.error = "chunks shared with another output failed to upload"
+            log.error("Storing {} failed ({})".format(self.recipe, self.error))
+            return False
+
+        recipe = json.dumps({
+            'version': 1,
+            'bytes': self.bytes,
+            'sha256': self.hash.hexdigest(),
+            'chunks': self.chunks,
+        }, separators=(',', ':')).encode()
+        index = ''.join(digest + '\n' for digest in self._claimed).encode()
+        try:
+            # Uploaded chunks are indexed first, a recipe only ever points to stored chunks
+            if index: self._save(self.store.root + '/index', index, append=True)
+            self._save(self.recipe, recipe)
+        except OSError as e:
+            self.error = str(e)
+            log.error("Storing {} failed ({})".format(self.recipe, self.error))
+            return False
+        return True
+
+    def _save(self, path, data, append=False):
+        """Write (or append) a small file in the store or snapshot folder
+        """
+        if not self.store.ssh:
+            with open(path, 'ab' if append else 'wb') as f: f.write(data)
+            return
+        script = "cat {} {}".format('>>' if append else '>', quote([path]))
+        proc = subprocess.run(self.store.ssh + [script], input=data, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if proc.returncode != 0: raise OSError("Writing {} failed ({})".format(path, proc.stderr.decode().strip()))
+
+    def stats(self):
+        """Dedupe statistics of this output
+        """
+        return {
+            'chunks': len(self.chunks),
+            'newChunks': self.new_chunks,
+            'newBytes': self.new_bytes,
+            'storedBytes': self.stored_bytes,
+            'dedupe': round(1 - self.new_bytes / self.bytes, 3) if self.bytes else None,
+        }
+
+
+def find_store(path):
+    """Find the store folder above a recipe (the destination path holding .store)
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    while True:
+        if os.path.isdir(os.path.join(folder, STORE_DIR)): return os.path.join(folder, STORE_DIR)
+        parent = os.path.dirname(folder)
+        if parent == folder: return None
+        folder = parent
+
+
+def restore(recipe, out, root=None):
+    """Write the original output of a recipe to a binary file object, verifying its sha256
+    """
+    root = root or find_store(recipe)
+    if not root: raise OSError("No {} folder found above {}".format(STORE_DIR, recipe))
+    with open(recipe) as f: data = json.load(f)
+    hash = hashlib.sha256()
+    for digest, size in data['chunks']:
+        with open('{}/chunks/{}/{}'.format(root, digest[:2], digest), 'rb') as f:
+            chunk = zlib.decompress(f.read())
+        if len(chunk) != size: raise OSError("Chunk {} is {} bytes, expected {}".format(digest, len(chunk), size))
+        hash.update(chunk)
+        out.write(chunk)
+    if hash.hexdigest() != data['sha256']: raise OSError("Restored {} does not match its sha256".format(recipe))
+
+
+def gc(path, root=None, grace=86400, dryrun=False):
+    """Delete chunks no recipe of any snapshot references anymore, run on the backup box itself
+    path is the destination path (server folders plus .store).  Chunks newer than grace seconds
+    are kept.  Backups reuse old unreferenced chunks too, so gc takes the store lock exclusively
+    and raises OSError while a backup uses the store.  Returns (referenced, deleted, bytes freed).
+    """
+    root = root or os.path.join(path, STORE_DIR)
+    with open(os.path.join(root, 'lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise OSError("Chunk store {} is in use by a running backup, run store-gc later".format(root))
+        return _gc(path, root, grace, dryrun)
+
+
+def _gc(path, root, grace, dryrun):
+    referenced = set()
+    patterns = ['*' + RECIPE_EXT, 'mysqldump/*' + RECIPE_EXT, 'mysqldump/*/*' + RECIPE_EXT, 'mysqlbinlog/*' + RECIPE_EXT]
+    for snapshot in glob(os.path.join(path, '*', 'snapshots', '*')):
+        if is_archived(snapshot):
+            # Recipes of archived snapshots are read from their archive
+            for entry in entries(snapshot):
+                if entry['type'] == 'f' and entry['path'].endswith(RECIPE_EXT):
+                    referenced.update(digest for digest, _ in json.loads(read(snapshot, entry['path']))['chunks'])
+            continue
+        for pattern in patterns:
+            for recipe in glob(os.path.join(snapshot, pattern)):
+                with open(recipe) as f: referenced.update(digest for digest, _ in json.load(f)['chunks'])
+
+    deleted = freed = 0
+    now = time.time()
+    keep = []
+    for chunk in glob(os.path.join(root, 'chunks', '*', '*')):
+        digest = os.path.basename(chunk)
+        if digest in referenced: keep.append(digest); continue
+        stat = os.stat(chunk)
+        if now - stat.st_mtime < grace: keep.append(digest); continue
+        deleted += 1
+        freed += stat.st_size
+        if not dryrun: os.remove(chunk)
+
+    if not dryrun:
+        tmp = os.path.join(root, 'index.tmp')
+        with open(tmp, 'w') as f: f.write(''.join(digest + '\n' for digest in keep))
+        os.rename(tmp, os.path.join(root, 'index'))
+    return len(referenced), deleted, freed
@@ -28,6 +28,10 @@ defaults = {
     # Rsync options
     'rsync': {
         'verbose': True,
+        'profile': 'default',
+        'stats': False,
+        'streams': 1,
+        'split': 'path',
     },
 
     # Source server connection details
@@ -39,6 +43,7 @@ defaults = {
             'port': 22,
             'user': 'root',
             'key': '~/.ssh/id_rsa',
+            'multiplex': True,  # Reuse one persistent ssh master connection
         },
     },
 
@@ -52,6 +57,7 @@ defaults = {
             'port': 22,
             'user': 'root',
             'key': '~/.ssh/id_rsa',
+            'multiplex': True,  # Reuse one persistent ssh master connection
         },
     },
 
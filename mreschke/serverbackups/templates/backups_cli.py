@@ -32,6 +32,10 @@ defaults = {
     # Rsync options
     'rsync': {
         'verbose': True,
+        'profile': 'default',
+        'stats': False,
+        'streams': 1,
+        'split': 'path',
     },
 
     # Source server connection details
@@ -43,6 +47,7 @@ defaults = {
             'port': 22,
             'user': 'root',
             'key': '~/.ssh/id_rsa',
+            'multiplex': True,  # Reuse one persistent ssh master connection
         },
     },
 
@@ -56,6 +61,7 @@ defaults = {
             'port': 22,
             'user': 'root',
             'key': '~/.ssh/id_rsa',
+            'multiplex': True,  # Reuse one persistent ssh master connection
         },
     },
 
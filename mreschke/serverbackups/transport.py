@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import time
+
+from .rsyncstats import RsyncStats
+from .runner import Runner, quote
+
+# Already compressed suffixes never worth recompressing (rsync's builtin list plus modern formats).
+# Setting --skip-compress replaces rsync's builtin list so it is repeated here.
+SKIP_COMPRESS = [
+    '3g2', '3gp', '7z', 'aac', 'ace', 'apk', 'avi', 'bz2', 'deb', 'dmg', 'ear', 'f4v', 'flac', 'flv', 'gpg', 'gz',
+    'heic', 'iso', 'jar', 'jpeg', 'jpg', 'lrz', 'lz', 'lz4', 'lzma', 'lzo', 'm1a', 'm1v', 'm2a', 'm2ts', 'm2v',
+    'm4a', 'm4b', 'm4p', 'm4r', 'm4v', 'mka', 'mkv', 'mov', 'mp1', 'mp2', 'mp3', 'mp4', 'mpa', 'mpeg', 'mpg',
+    'mpv', 'mts', 'odb', 'odf', 'odg', 'odi', 'odm', 'odp', 'ods', 'odt', 'oga', 'ogg', 'ogm', 'ogv', 'ogx',
+    'opus', 'otg', 'oth', 'otp', 'ots', 'ott', 'oxt', 'png', 'qt', 'rar', 'rpm', 'rz', 'rzip', 'spx', 'squashfs',
+    'sxc', 'sxd', 'sxg', 'sxm', 'sxw', 'sz', 'tbz', 'tbz2', 'tgz', 'tlz', 'ts', 'txz', 'tzo', 'vob', 'war', 'webm',
+    'webp', 'xz', 'z', 'zip', 'zst',
+]
+
+# Link profiles, every key may also be overridden in the server rsync options
+#   compress       None (off), zlib (--compress) or a --compress-choice algorithm (zstd, lz4, zlibx, rsync 3.2+)
+#   compressLevel  --compress-level, None for the algorithm default
+#   skipCompress   suffixes sent without compression, None for rsync's builtin list
+#   checksum       --checksum-choice (xxh128, xxh3, md5, rsync 3.2+), None for the rsync default
+#   cipher         ssh cipher for every ssh connection to SRC and DEST, None for the ssh default
+#   hardLinks      --hard-links, preserves hard links on the source but is very expensive in memory on large trees
+#   wholeFile      --whole-file, skip the delta algorithm (faster when the network is faster than the disks)
+PROFILES = {
+    # The historical settings
+    'default': {'compress': 'zlib', 'compressLevel': None, 'skipCompress': None, 'checksum': None, 'cipher': None, 'hardLinks': True, 'wholeFile': False},
+    # Same box or local mounts, nothing to gain from compression or deltas
+    'local': {'compress': None, 'compressLevel': None, 'skipCompress': None, 'checksum': None, 'cipher': None, 'hardLinks': True, 'wholeFile': True},
+    # Gigabit and faster, compression costs more CPU than it saves, AES-GCM uses AES-NI
+    'lan': {'compress': None, 'compressLevel': None, 'skipCompress': None, 'checksum': None, 'cipher': 'aes128-gcm@openssh.com', 'hardLinks': True, 'wholeFile': False},
+    # Slow or metered links, cheap strong compression of what is not already compressed
+    'wan': {'compress': 'zstd', 'compressLevel': 3, 'skipCompress': SKIP_COMPRESS, 'checksum': None, 'cipher': 'chacha20-poly1305@openssh.com', 'hardLinks': True, 'wholeFile': False},
+}
+
+
+class Transport:
+    """rsync and ssh transport tuning for one server, a link profile plus per server overrides"""
+
+    def __init__(self, profile='default', **overrides):
+        if profile not in PROFILES:
+            raise ValueError("Unknown rsync transport profile '{}', use one of {}".format(profile, ', '.join(sorted(PROFILES))))
+        self.profile = profile
+        settings = dict(PROFILES[profile])
+        settings.update({key: value for key, value in overrides.items() if key in settings})
+        self.compress = settings['compress'] if settings['compress'] not in ('none', False) else None
+        self.compress_level = settings['compressLevel']
+        self.skip_compress = settings['skipCompress']
+        self.checksum = settings['checksum']
+        self.cipher = settings['cipher']
+        self.hard_links = settings['hardLinks']
+        self.whole_file = settings['wholeFile']
+
+    @classmethod
+    def from_options(cls, rsync):
+        """Build from the server rsync options (profile plus any profile key as override)
+        """
+        rsync = dict(rsync or {})
+        return cls(rsync.pop('profile', None) or 'default', **rsync)
+
+    def rsync_args(self):
+        """rsync arguments of this transport
+        """
+        args = []
+        if self.hard_links: args.append('--hard-links')
+        if self.whole_file: args.append('--whole-file')
+        if self.compress:
+            args.append('--compress')
+            if self.compress != 'zlib': args.append('--compress-choice=' + self.compress)
+            if self.compress_level is not None: args.append('--compress-level={}'.format(self.compress_level))
+            if self.skip_compress: args.append('--skip-compress=' + '/'.join(self.skip_compress))
+        if self.checksum: args.append('--checksum-choice=' + self.checksum)
+        return args
+
+    def ssh_args(self):
+        """ssh arguments of this transport (placed before user@host)
+        """
+        return ['-c', self.cipher] if self.cipher else []
+
+    def describe(self):
+        """Short one line description of the rsync and ssh arguments (skip list summarized)
+        """
+        args = [x if not x.startswith('--skip-compress=') else '--skip-compress=({} suffixes)'.format(len(self.skip_compress)) for x in self.rsync_args()]
+        return ' '.join(args + self.ssh_args())
+
+    def __repr__(self):
+        return "<Transport {} {}>".format(self.profile, self.describe())
+
+
+def benchmark(source, destination=None, profiles=None, port=22, key='~/.ssh/id_rsa', runs=1):
+    """Copy a sample tree with every profile and return one row of numbers per profile
+
+    destination is a local folder or user@host:/path (default a local temp folder).
+    Every run copies into a fresh subfolder which is removed afterwards, so each
+    number is a full (not incremental) copy of the sample tree.
+    """
+    runner = Runner()
+    remote = destination and ':' in destination and not destination.startswith('/')
+    if remote:
+        login, _, root = destination.partition(':')
+        ssh = ['ssh', '-p', str(port), '-i', os.path.expanduser(key), '-o', 'LogLevel=quiet']
+    else:
+        root = destination or tempfile.mkdtemp(prefix='sb-transport-')
+
+    rows = []
+    for profile in profiles or sorted(PROFILES):
+        transport = Transport(profile)
+        for run in range(runs):
+            target = '{}/sb-transport-{}-{}-{}'.format(root.rstrip('/'), os.getpid(), profile, run)
+            cmd = ['rsync', '--archive', '--delete', '--stats'] + transport.rsync_args()
+            if remote:
+                cmd += ['-e', quote(ssh + transport.ssh_args())]
+            cmd += [source.rstrip('/') + '/', (login + ':' + target) if remote else target]
+
+            parser = RsyncStats(profile, report=False)
+            start = time.time()
+            result = runner.run(cmd, on_stdout=parser.feed)
+            seconds = time.time() - start
+
+            # Remove the copy before the next run
+            if remote:
+                runner.run(ssh + [login, quote(['rm', '-rf', '--', target])])
+            else:
+                shutil.rmtree(target, ignore_errors=True)
+
+            stats = parser.to_dict()
+            rows.append({
+                'profile': profile,
+                'run': run + 1,
+                'ok': result.ok,
+                'error': None if result.ok else (result.stderr[-1] if result.stderr else 'exit code {}'.format(result.returncode)),
+                'seconds': round(seconds, 3),
+                'files': stats['files'],
+                'totalFileSize': stats['totalFileSize'],
+                'sentBytes': stats['sentBytes'],
+                'throughput': round(stats['totalFileSize'] / seconds, 1) if stats['totalFileSize'] and seconds else None,
+                'args': transport.describe(),
+            })
+
+    if not destination: shutil.rmtree(root, ignore_errors=True)
+    return rows
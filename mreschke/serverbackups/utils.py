@@ -12,3 +12,11 @@ def dd(*args):
     for arg in args:
         cpprint(arg)
     exit()
+
+
+def human_bytes(size):
+    """Format a byte count as a short human readable string (1.5 GiB)"""
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if abs(size) < 1024 or unit == 'TiB':
+            return "{:.1f} {}".format(size, unit) if unit != 'B' else "{} B".format(int(size))
+        size /= 1024.0
@@ -0,0 +1,75 @@
+import fcntl
+import os
+import shutil
+import tempfile
+from glob import glob
+
+from . import log
+
+
+class Workspace:
+    """Private temp folder of one server backup run (exclude list, file lists, spool files)
+
+    Every run gets its own folder, so servers backing up at the same time, in one
+    process or from separate cron jobs, never share a file.  A lock file per server
+    (flock, released by the kernel if the process dies) keeps two runs of the same
+    server from running at once.  Folders left behind by killed runs of the server
+    are removed by the next run holding its lock.
+    """
+
+    def __init__(self, server, root=None):
+        self.server = server
+        self.root = root or tempfile.gettempdir()
+        self.prefix = 'serverbackups-{}-'.format(server.replace('/', '_'))
+        self.folder = None
+        self._lock = None
+
+    def open(self):
+        """Lock the server and create the workspace folder, raises RuntimeError if the server is already running
+        """
+        if self.folder: return self
+        lock = open(os.path.join(self.root, self.prefix[:-1] + '.lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            raise RuntimeError("Another backup of server {} is running (lock {})".format(self.server, lock.name))
+        self._lock = lock
+
+        # Holding the lock, any other workspace of this server belongs to a dead run
+        for stale in glob(os.path.join(self.root, self.prefix + '*.run')):
+            # mkdtemp names have no dash, server x must not touch the workspaces of server x-y
+            if '-' in os.path.basename(stale)[len(self.prefix):]: continue
+            log.notice("Removing workspace {} of an interrupted run".format(stale))
+            shutil.rmtree(stale, ignore_errors=True)
+        self.folder = tempfile.mkdtemp(prefix=self.prefix, suffix='.run', dir=self.root)
+        return self
+
+    def path(self, name):
+        """Path of a file in the workspace
+        """
+        if not self.folder: raise RuntimeError("Workspace of server {} is not open".format(self.server))
+        return os.path.join(self.folder, name)
+
+    def write(self, name, data):
+        """Write a text file into the workspace and return its path
+        """
+        path = self.path(name)
+        with open(path, 'w') as f: f.write(data)
+        return path
+
+    def close(self):
+        """Remove the workspace folder and release the server lock
+        """
+        if self.folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.folder = None
+        if self._lock:
+            self._lock.close()
+            self._lock = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,78 @@
+import os
+import random
+import tarfile
+from datetime import date
+
+import pytest
+
+from mreschke.serverbackups import archive
+
+
+def snapshot(path):
+    random.seed(1)
+    files = {
+        'etc/hosts': b'127.0.0.1 localhost\n',
+        'etc/empty': b'',
+        'var/lib/db.bin': bytes(random.getrandbits(8) for _ in range(300000)),
+        'var/log/big.log': b''.join(b'line %d\n' % i for i in range(100000)),
+        'home/a b/notes.txt': b'spaces in names\n',
+    }
+    for name, data in files.items():
+        os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+        with open(os.path.join(path, name), 'wb') as f: f.write(data)
+    os.link(os.path.join(path, 'etc/hosts'), os.path.join(path, 'etc/hosts.link'))
+    os.symlink('hosts', os.path.join(path, 'etc/hosts.sym'))
+    os.makedirs(os.path.join(path, 'tmp/empty'))
+    return files
+
+
+def test_build_and_extract_round_trip(tmp_path):
+    live = str(tmp_path / 'live')
+    files = snapshot(live)
+    # Small members, so files start in many different gzip members
+    stats = archive.build(live, str(tmp_path / 'archived'), member_size=65536)
+    assert stats.files == len(list(archive.entries(str(tmp_path / 'archived'))))
+    # The hard link is stored once
+    assert stats.bytes == sum(len(x) for x in files.values())
+
+    archived = str(tmp_path / 'archived')
+    for name, data in files.items():
+        assert archive.read(archived, name) == data
+    assert archive.read(archived, '/etc/hosts.link') == files['etc/hosts']
+    with pytest.raises(OSError):
+        archive.read(archived, 'etc/hosts.sym')
+
+    # The members form one gzip stream, tar reads the whole archive
+    with tarfile.open(os.path.join(archived, archive.ARCHIVE), 'r:gz') as tar:
+        tar.extractall(str(tmp_path / 'extracted'), **({'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}))
+    for name, data in files.items():
+        with open(str(tmp_path / 'extracted' / name), 'rb') as f: assert f.read() == data
+    assert os.readlink(str(tmp_path / 'extracted' / 'etc/hosts.sym')) == 'hosts'
+    assert os.path.isdir(str(tmp_path / 'extracted' / 'tmp/empty'))
+
+
+def test_archive_server_swaps_old_snapshots_and_keeps_current(tmp_path):
+    snapshots = tmp_path / 'snapshots'
+    for name in ('2020-01-01_000000', '2020-01-02_000000', '2020-03-01_000000'):
+        snapshot(str(snapshots / name))
+    os.symlink(str(snapshots / '2020-01-02_000000'), str(tmp_path / 'current'))
+    results = archive.archive_server(str(tmp_path), 30, today=date(2020, 3, 2), member_size=65536)
+    assert list(results) == ['2020-01-01_000000']
+    assert sorted(os.listdir(str(snapshots / '2020-01-01_000000'))) == sorted([archive.ARCHIVE, archive.INDEX])
+    assert not archive.is_archived(str(snapshots / '2020-01-02_000000'))
+    assert sorted(os.listdir(str(snapshots))) == ['2020-01-01_000000', '2020-01-02_000000', '2020-03-01_000000']
+    assert archive.read(str(snapshots / '2020-01-01_000000'), 'etc/hosts') == b'127.0.0.1 localhost\n'
+
+
+def test_recover_rolls_back_or_finishes_a_killed_conversion(tmp_path):
+    # Killed while building: the live snapshot is untouched, the half built archive goes
+    building = tmp_path / 'snapshots'
+    snapshot(str(building / '2020-01-01_000000'))
+    archive.build(str(building / '2020-01-01_000000'), str(building / ('2020-01-01_000000' + archive.BUILDING)))
+    # Killed between the two renames: the archive is complete, the live tree is discarded
+    snapshot(str(building / ('2020-01-02_000000' + archive.LIVE)))
+    archive.build(str(building / ('2020-01-02_000000' + archive.LIVE)), str(building / ('2020-01-02_000000' + archive.BUILDING)))
+    archive.recover(str(building))
+    assert sorted(os.listdir(str(building))) == ['2020-01-01_000000', '2020-01-02_000000']
+    assert not archive.is_archived(str(building / '2020-01-01_000000'))
+    assert archive.is_archived(str(building / '2020-01-02_000000'))
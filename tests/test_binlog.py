@@ -0,0 +1,76 @@
+import json
+import os
+import time
+
+import pytest
+
+from mreschke.serverbackups import binlog
+from mreschke.serverbackups.catalog import CATALOG
+
+HEAD = "-- CHANGE MASTER TO MASTER_LOG_FILE='mysql-bin.{:06d}', MASTER_LOG_POS={};\n"
+
+
+def snapshot(path, name, started, full=None, logs=()):
+    """Write one snapshot folder and return its catalog record"""
+    folder = os.path.join(path, 'snapshots', name)
+    os.makedirs(os.path.join(folder, binlog.FOLDER))
+    mysql = []
+    if full:
+        os.makedirs(os.path.join(folder, 'mysqldump'))
+        with open(os.path.join(folder, 'mysqldump', 'db.sql'), 'w') as f: f.write(HEAD.format(*full))
+        mysql.append({'name': 'db', 'ok': True, 'file': 'mysqldump/db.sql'})
+    files = []
+    for log in logs:
+        files.append({'name': 'mysql-bin.{:06d}'.format(log), 'file': '{}/mysql-bin.{:06d}'.format(binlog.FOLDER, log)})
+        with open(os.path.join(folder, files[-1]['file']), 'w') as f: f.write('log')
+    return {
+        'event': 'snapshot', 'snapshot': name, 'status': 'ok', 'complete': True, 'started': started,
+        'finished': started + 60, 'mysql': mysql, 'binlog': {'full': bool(full), 'files': files},
+    }
+
+
+def catalog(path, records):
+    with open(os.path.join(str(path), CATALOG), 'w') as f:
+        for record in records: f.write(json.dumps(record) + '\n')
+
+
+def day(n):
+    # Local time like until, noon of 2020-01-01 plus n days
+    return time.mktime(time.strptime('2020-01-01 12:00:00', '%Y-%m-%d %H:%M:%S')) + n * 86400
+
+
+def test_plan_picks_the_newest_full_dump_and_the_logs_after_it(tmp_path):
+    path = str(tmp_path)
+    catalog(path, [
+        snapshot(path, '2020-01-01_120000', day(0), full=(3, 4), logs=[2, 3]),
+        snapshot(path, '2020-01-02_120000', day(1), logs=[3, 4]),
+        snapshot(path, '2020-01-03_120000', day(2), full=(5, 120), logs=[4, 5]),
+        snapshot(path, '2020-01-04_120000', day(3), logs=[6]),
+        snapshot(path, '2020-01-05_120000', day(4), logs=[7]),
+    ])
+    plan = binlog.restore_plan(path, 'db')
+    assert plan.snapshot == '2020-01-03_120000'
+    assert plan.dump == os.path.join(path, 'snapshots', '2020-01-03_120000', 'mysqldump', 'db.sql')
+    assert plan.position == ('mysql-bin.000005', 120)
+    assert [x[0] for x in plan.files] == ['mysql-bin.000005', 'mysql-bin.000006', 'mysql-bin.000007']
+    assert plan.files[0][1] == os.path.join(path, 'snapshots', '2020-01-03_120000', binlog.FOLDER, 'mysql-bin.000005')
+
+    # Up to a time before the second full dump finished, logs stop at the first snapshot started after it
+    plan = binlog.restore_plan(path, 'db', until='2020-01-02 18:00:00')
+    assert plan.snapshot == '2020-01-01_120000'
+    assert plan.position == ('mysql-bin.000003', 4)
+    assert [x[0] for x in plan.files] == ['mysql-bin.000003', 'mysql-bin.000004', 'mysql-bin.000005']
+
+
+def test_plan_refuses_gaps_and_missing_dumps(tmp_path):
+    path = str(tmp_path)
+    catalog(path, [
+        snapshot(path, '2020-01-01_120000', day(0), full=(3, 4), logs=[3]),
+        snapshot(path, '2020-01-03_120000', day(2), logs=[5]),
+    ])
+    with pytest.raises(OSError, match='missing'):
+        binlog.restore_plan(path, 'db')
+    with pytest.raises(OSError, match='No full dump'):
+        binlog.restore_plan(path, 'other')
+    with pytest.raises(OSError, match='No full dump'):
+        binlog.restore_plan(path, 'db', until='2019-12-31 00:00:00')
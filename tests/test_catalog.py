@@ -0,0 +1,37 @@
+from mreschke.serverbackups import catalog
+from mreschke.serverbackups.catalog import Catalog
+
+
+def record(snapshot, status='ok', complete=True, snapshot_bytes=0):
+    return {'event': 'snapshot', 'snapshot': snapshot, 'status': status, 'complete': complete, 'snapshotBytes': snapshot_bytes}
+
+
+def test_replay_keeps_the_last_record_and_drops_deleted_snapshots():
+    lines = [
+        catalog.dumps(record('2020-01-01_000000', snapshot_bytes=10)),
+        catalog.dumps(record('2020-01-02_000000', status='failed', complete=False)),
+        catalog.dumps(record('2020-01-03_000000', snapshot_bytes=30)),
+        catalog.dumps(catalog.deleted(['2020-01-02_000000'])),
+        catalog.dumps(record('2020-01-04_000000', status='failed', complete=False)),
+        # Rerun of a snapshot replaces its first record
+        catalog.dumps(record('2020-01-01_000000', snapshot_bytes=50)),
+        '\n',
+        # Torn last line of a killed backup
+        '{"event":"snapshot","snap',
+    ]
+    replayed = Catalog(lines)
+    assert replayed.errors == 1
+    assert [x['snapshot'] for x in replayed.snapshots()] == ['2020-01-04_000000', '2020-01-03_000000', '2020-01-01_000000']
+    assert [x['snapshot'] for x in replayed.snapshots(complete=True)] == ['2020-01-03_000000', '2020-01-01_000000']
+    assert replayed.last_good()['snapshot'] == '2020-01-03_000000'
+    assert [x['snapshotBytes'] for x in replayed.largest()] == [50, 30, 0]
+
+
+def test_snapshot_filters():
+    replayed = Catalog(record('2020-0{}-15_000000'.format(i), status='ok' if i % 2 else 'failed') for i in range(1, 6))
+    assert [x['snapshot'] for x in replayed.snapshots(status='failed')] == ['2020-04-15_000000', '2020-02-15_000000']
+    assert [x['snapshot'] for x in replayed.snapshots(since='2020-02', until='2020-04')] == [
+        '2020-04-15_000000', '2020-03-15_000000', '2020-02-15_000000',
+    ]
+    assert [x['snapshot'] for x in replayed.snapshots(limit=2)] == ['2020-05-15_000000', '2020-04-15_000000']
+    assert Catalog().last_good() is None
@@ -0,0 +1,43 @@
+import pytest
+
+from mreschke.serverbackups.compression import Compression, decompress_argv
+
+
+@pytest.mark.parametrize('codec, level, threads, argv', [
+    ('gzip', None, 0, ['gzip', '-c']),
+    ('gzip', 9, 4, ['gzip', '-c', '-9']),
+    ('pigz', None, 0, ['pigz', '-c']),
+    ('pigz', 6, 4, ['pigz', '-c', '-6', '-p4']),
+    ('zstd', None, 0, ['zstd', '-c', '-q', '-T0']),
+    ('zstd', 19, 2, ['zstd', '-c', '-q', '-19', '-T2']),
+    ('xz', 3, 0, ['xz', '-c', '-3', '-T0']),
+    ('none', 9, 4, None),
+])
+def test_argv(codec, level, threads, argv):
+    assert Compression(codec, level, threads).argv() == argv
+
+
+def test_fallback_keeps_level_and_threads():
+    fallback = Compression('zstd', 3, 8).fallback()
+    assert (fallback.codec, fallback.level, fallback.threads) == ('gzip', 3, 8)
+    assert fallback.argv() == ['gzip', '-c', '-3']
+    assert Compression('pigz').fallback().codec == 'gzip'
+    assert Compression('gzip').fallback() is None
+    assert Compression('none').fallback() is None
+
+
+def test_filename_adds_the_extension_once():
+    assert Compression('zstd').filename('db.sql') == 'db.sql.zst'
+    assert Compression('zstd').filename('db.sql.zst') == 'db.sql.zst'
+    assert Compression('pigz').filename('db.sql') == 'db.sql.gz'
+    assert Compression('none').filename('db.sql') == 'db.sql'
+    assert decompress_argv('db.sql.zst') == ['zstd', '-dcq']
+    assert decompress_argv('db.sql') is None
+
+
+def test_from_options_later_options_win():
+    compression = Compression.from_options({'codec': 'zstd', 'level': 3, 'threads': 4}, None, {'level': 9})
+    assert (compression.codec, compression.level, compression.threads) == ('zstd', 9, 4)
+    assert Compression.from_options({}).codec == 'gzip'
+    with pytest.raises(ValueError):
+        Compression.from_options({'codec': 'lz4'})
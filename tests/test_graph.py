@@ -0,0 +1,44 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from mreschke.serverbackups.graph import Graph
+from mreschke.serverbackups.runner import Runner
+
+
+def test_steps_run_after_their_dependencies():
+    done = []
+    graph = Graph()
+    graph.add('b', lambda: done.append('b'), ['a'])
+    graph.add('a', lambda: done.append('a'))
+    assert graph.run() == {'a': 'ok', 'b': 'ok'}
+    assert done == ['a', 'b']
+
+
+def test_failed_step_skips_its_dependents():
+    def fail():
+        raise ValueError('boom')
+
+    graph = Graph()
+    graph.add('a', fail)
+    graph.add('b', lambda: None, ['a'])
+    with pytest.raises(ValueError):
+        graph.run()
+
+
+def test_ctrl_c_stops_running_steps_and_skips_pending_ones():
+    runner = Runner()
+    done = []
+    graph = Graph(on_interrupt=runner.cancel)
+    graph.add('rsync', lambda: runner.run(['sh', '-c', 'sleep 5; echo done']))
+    graph.add('after', lambda: done.append('after'), ['rsync'])
+    threading.Timer(0.5, os.kill, [os.getpid(), signal.SIGINT]).start()
+    start = time.time()
+    with pytest.raises(KeyboardInterrupt):
+        graph.run()
+    assert time.time() - start < 2
+    assert runner.results[0].cancelled
+    assert done == []
@@ -0,0 +1,52 @@
+import calendar
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from mreschke.serverbackups import retention
+
+
+def old_keep(names, today, keep_daily, keep_weekly, keep_monthly, keep_yearly):
+    """The keep lists of the prune code the planner replaced, one pass per rule"""
+    def sd(name):
+        return date(int(name[0:4]), int(name[5:7]), int(name[8:10]))
+
+    snapshots = sorted(names)
+    keep = {}
+    rules = (
+        ('yearly', keep_yearly, lambda d: d == date(d.year, 12, 31)),
+        ('monthly', keep_monthly, lambda d: d.day == calendar.monthrange(d.year, d.month)[1]),
+        ('weekly', keep_weekly, lambda d: d == d + timedelta(days=6 - int(d.strftime('%w')))),
+    )
+    for rule, count, matches in rules:
+        keep[rule] = [x for x in snapshots if matches(sd(x))][-count:]
+        snapshots = [x for x in snapshots if x not in keep[rule]]
+    keep['daily'] = [x for x in snapshots if sd(x) > today - timedelta(days=keep_daily)]
+    return keep
+
+
+def hourly(start, hours, step=1):
+    return [(start + timedelta(hours=i)).strftime('%Y-%m-%d_%H%M%S') for i in range(0, hours, step)]
+
+
+@pytest.mark.parametrize('names, today, options', [
+    (hourly(datetime(2017, 11, 20, 8, 15, 27), 24 * 800, 7), date(2020, 1, 29), (30, 24, 60, 10)),
+    (hourly(datetime(2018, 12, 1, 1, 1, 1), 24 * 400, 24), date(2020, 1, 5), (7, 4, 12, 2)),
+    (hourly(datetime(2019, 6, 1), 24 * 200, 5), date(2019, 12, 20), (3, 1, 1, 1)),
+])
+def test_plan_matches_the_old_keep_lists(names, today, options):
+    plan = retention.plan(names, today, *options)
+    old = old_keep(names, today, *options)
+    assert plan.keep_yearly == old['yearly']
+    assert plan.keep_monthly == old['monthly']
+    assert plan.keep_weekly == old['weekly']
+    assert plan.keep_daily == old['daily']
+    kept = set(old['yearly'] + old['monthly'] + old['weekly'] + old['daily'])
+    assert plan.delete == sorted(x for x in set(names) if x not in kept)
+
+
+def test_plan_never_deletes_what_is_not_a_snapshot():
+    names = ['2020-01-01_010101', '2020-02-30_010101', 'lost+found', '2020-01-02_010101.partial']
+    plan = retention.plan(names, date(2021, 1, 1), 1, 0, 0, 0)
+    assert plan.delete == ['2020-01-01_010101']
+    assert plan.ignored == ['2020-01-02_010101.partial', '2020-02-30_010101', 'lost+found']
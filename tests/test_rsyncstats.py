@@ -0,0 +1,89 @@
+from mreschke.serverbackups.rsyncstats import RsyncStats
+
+# rsync 3.2 --stats --itemize-changes --info=progress2 output (progress lines end in \r, split by the Runner)
+OUTPUT = """cd+++++++++ etc/
+>f+++++++++ etc/hosts
+         32,768  10%    1.00MB/s    0:00:01 (xfr#1, ir-chk=1000/2000)
+.d..t...... etc/x/
+hf+++++++++ etc/y => etc/hosts
+>f.st...... etc/passwd
+*deleting   etc/old
+      1,234,567 100%    2.50MB/s    0:00:03 (xfr#2, to-chk=0/2000)
+
+Number of files: 2,000 (reg: 1,500, dir: 500)
+Number of created files: 3 (reg: 2, dir: 1)
+Number of deleted files: 1 (reg: 1)
+Number of regular files transferred: 2
+Total file size: 12,345,678 bytes
+Total transferred file size: 1,234,567 bytes
+Literal data: 1,000,000 bytes
+Matched data: 234,567 bytes
+File list size: 65,432
+File list generation time: 0.010 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 1,100,000
+Total bytes received: 1,234
+
+sent 1,100,000 bytes  received 1,234 bytes  366,744.67 bytes/sec
+total size is 12,345,678  speedup is 11.21"""
+
+# rsync 3.0 prints numbers without separators and no created/deleted counts
+OLD_OUTPUT = """Number of files: 2000
+Number of files transferred: 2
+Total file size: 12345678 bytes
+Total transferred file size: 1234567 bytes
+Literal data: 1000000 bytes
+Matched data: 234567 bytes
+Total bytes sent: 1100000
+Total bytes received: 1234
+total size is 12345678  speedup is 11.21"""
+
+
+def parse(output):
+    parser = RsyncStats(report=False)
+    for line in output.split('\n'): parser.feed(line)
+    return parser
+
+
+def test_stats_itemized_changes_and_progress_are_parsed():
+    parser = parse(OUTPUT)
+    stats = parser.to_dict()
+    assert stats['files'] == 2000
+    assert stats['createdFiles'] == 3
+    assert stats['deletedFiles'] == 1
+    assert stats['transferredFiles'] == 2
+    assert stats['totalFileSize'] == 12345678
+    assert stats['transferredFileSize'] == 1234567
+    assert stats['literalBytes'] == 1000000
+    assert stats['matchedBytes'] == 234567
+    assert stats['fileListGenerationTime'] == 0.01
+    assert stats['sentBytes'] == 1100000
+    assert stats['receivedBytes'] == 1234
+    assert stats['speedup'] == 11.21
+    assert stats['itemized'] == {'transferred': 2, 'created': 1, 'deleted': 1, 'hardlinked': 1, 'changed': 1}
+    assert parser.progress == {
+        'bytes': 1234567, 'percent': 100, 'rate': '2.50MB/s', 'elapsed': '0:00:03',
+        'transferred': 2, 'remaining': 0, 'total': 2000,
+    }
+
+
+def test_old_rsync_stats_without_separators():
+    stats = parse(OLD_OUTPUT).to_dict()
+    assert stats['files'] == 2000
+    assert stats['transferredFiles'] == 2
+    assert stats['createdFiles'] is None
+    assert stats['literalBytes'] == 1000000
+
+
+def test_combine_adds_up_streams():
+    one = parse(OUTPUT).to_dict()
+    two = parse(OLD_OUTPUT).to_dict()
+    combined = RsyncStats.combine([one, two, None])
+    assert combined['streams'] == 2
+    assert combined['files'] == 4000
+    assert combined['createdFiles'] == 3
+    assert combined['literalBytes'] == 2000000
+    assert combined['itemized']['transferred'] == 2
+    assert combined['speedup'] == round(2 * 12345678 / (2 * 1101234), 2)
+    assert RsyncStats.combine([one]) is one
+    assert RsyncStats.combine([None]) is None
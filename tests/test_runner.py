@@ -0,0 +1,41 @@
+import threading
+import time
+
+from mreschke.serverbackups.runner import Runner
+
+
+def test_timeout_kills_processes_started_by_the_command():
+    # sh -c runs sleep as a child that holds stdout open, the timeout must kill it too
+    runner = Runner()
+    start = time.time()
+    result = runner.run(['sh', '-c', 'sleep 4; echo done'], timeout=1)
+    assert time.time() - start < 2
+    assert result.timed_out
+    assert not result.ok
+    assert result.stdout == []
+
+
+def test_timeout_covers_processes_left_holding_the_pipe():
+    runner = Runner()
+    start = time.time()
+    result = runner.run(['sh', '-c', 'sleep 4 & echo started'], timeout=1)
+    assert time.time() - start < 2
+    assert result.timed_out
+    assert result.stdout == ['started']
+
+
+def test_cancel_kills_processes_started_by_the_command():
+    runner = Runner()
+    threading.Timer(0.5, runner.cancel).start()
+    start = time.time()
+    result = runner.run(['sh', '-c', 'sleep 4; echo done'])
+    assert time.time() - start < 2
+    assert result.cancelled
+    assert runner.run(['true']).cancelled
+
+
+def test_pipeline_without_timeout():
+    runner = Runner()
+    result = runner.pipeline([['printf', 'a\\nb\\n'], ['sort', '-r']], timeout=5)
+    assert result.ok
+    assert result.stdout == ['b', 'a']
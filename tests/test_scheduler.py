@@ -0,0 +1,90 @@
+import io
+import logging
+import threading
+import time
+
+from mreschke.serverbackups import log
+from mreschke.serverbackups.graph import Graph
+from mreschke.serverbackups.runner import Runner
+from mreschke.serverbackups.scheduler import Scheduler
+
+
+class Job:
+    def __init__(self, server):
+        self.server = server
+
+    def run(self):
+        graph = Graph()
+        graph.add('step', lambda: log.bullet('step of ' + self.server))
+        graph.run()
+        Runner().run(['sh', '-c', 'echo stderr of {} >&2'.format(self.server)], on_stderr=log.warning)
+
+    def cancel(self):
+        pass
+
+
+def options():
+    return {'enabled': True, 'source': {'location': 'local'}, 'destination': {'location': 'local'}}
+
+
+def test_parallel_servers_prefix_their_log_lines():
+    log.init({'console': {'enabled': False}})
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(log.PrefixFormatter('%(message)s'))
+    handler.addFilter(log.PrefixFilter())
+    logging.getLogger().addHandler(handler)
+    try:
+        Scheduler(workers=2).run([('a', options()), ('b', options())], lambda server, options: Job(server))
+    finally:
+        logging.getLogger().removeHandler(handler)
+    lines = stream.getvalue().splitlines()
+    for server in ('a', 'b'):
+        assert '[{0}] * step of {0}'.format(server) in lines
+        assert '[{0}] stderr of {0}'.format(server) in lines
+    # The summary is logged by the main thread, without a prefix
+    assert any(line.startswith('* a OK') for line in lines)
+
+
+def ssh(host):
+    return {'location': 'ssh', 'ssh': {'host': host, 'port': 22}}
+
+
+def test_caps_limit_concurrent_jobs_per_destination_and_source():
+    log.init({'console': {'enabled': False}})
+    lock = threading.Lock()
+    running = {}
+    peaks = {}
+
+    class Counted:
+        def __init__(self, keys):
+            self.keys = keys
+
+        def run(self):
+            with lock:
+                for key in self.keys:
+                    running[key] = running.get(key, 0) + 1
+                    peaks[key] = max(peaks.get(key, 0), running[key])
+            time.sleep(0.05)
+            with lock:
+                for key in self.keys: running[key] -= 1
+
+        def cancel(self):
+            pass
+
+    jobs = []
+    for i in range(8):
+        options = {'enabled': True, 'source': ssh('src{}'.format(i % 2)), 'destination': ssh('dest{}'.format(i % 4))}
+        jobs.append(('s{}'.format(i), options))
+
+    def factory(server, options):
+        keys = ['any', Scheduler.source_key(options), Scheduler.destination_key(options)]
+        return Counted(keys)
+
+    results = Scheduler(workers=8, max_per_destination=1, max_per_source=3).run(jobs, factory)
+    assert [x['server'] for x in results] == [x[0] for x in jobs]
+    assert all(x['status'] == 'ok' for x in results)
+    assert all(peaks['ssh://dest{}:22'.format(i)] == 1 for i in range(4))
+    assert all(peaks['ssh://src{}:22'.format(i)] <= 3 for i in range(2))
+    # Capped by the sources, never by the worker count
+    assert 1 < peaks['any'] <= 6
@@ -0,0 +1,44 @@
+import subprocess
+import time
+from types import SimpleNamespace as obj
+
+from mreschke.serverbackups import Backups, log
+
+
+def server(tmp_path):
+    log.init({'console': {'level': 'ERROR', 'colors': False}})
+    backups = Backups(servers={'x': {'destination': {'path': str(tmp_path)}}})
+    return backups.server('x', backups.servers['x'])
+
+
+def script(name, command, **options):
+    return obj(name=name, script=command, enabled=True, **options)
+
+
+def test_script_timeout_stops_the_script(tmp_path):
+    results = {}
+    start = time.time()
+    server(tmp_path).run_script('pre', script('hang', 'sleep 5; echo done', timeout='1'), [], results)
+    assert time.time() - start < 2
+    assert results['hang'].timed_out
+    assert not results['hang'].ok
+
+
+def test_hung_script_does_not_hold_up_other_scripts(tmp_path):
+    start = time.time()
+    results = server(tmp_path).backup_scripts('pre', [
+        script('hang', 'sleep 5; echo done', timeout=1, parallel=True),
+        script('quick', 'echo quick', parallel=True),
+        script('next', 'echo next'),
+    ])
+    assert time.time() - start < 2
+    assert [(x.name, x.ok, x.timed_out) for x in results] == [('hang', False, True), ('quick', True, False), ('next', True, False)]
+
+
+def test_remote_command_stops_itself_after_the_timeout(tmp_path):
+    backup = server(tmp_path)
+    assert backup.remote_command('echo hi') == 'echo hi'
+    start = time.time()
+    # What SRC runs over ssh, killing ssh alone would leave it running
+    assert subprocess.run(['sh', '-c', backup.remote_command('sleep 5 | cat', 1)]).returncode == 124
+    assert time.time() - start < 2
@@ -0,0 +1,123 @@
+import os
+
+from mreschke.serverbackups import Backups, archive, log
+
+
+def server(tmp_path, **options):
+    log.init({'console': {'level': 'ERROR', 'colors': False}})
+    backups = Backups(servers={'x': dict({'destination': {'path': str(tmp_path)}}, **options)})
+    return backups.server('x', backups.servers['x'])
+
+
+def test_cleanup_promotes_the_snapshot_and_swaps_current(tmp_path):
+    old = tmp_path / 'x' / 'snapshots' / '2020-01-01_000000'
+    old.mkdir(parents=True)
+    os.symlink(str(old), str(tmp_path / 'x' / 'current'))
+    backup = server(tmp_path)
+    backup.prepare()
+    try:
+        backup.cleanup()
+    finally:
+        backup.workspace.close()
+    final = str(tmp_path / 'x' / 'snapshots' / backup.dest.snapshot)
+    assert backup.promoted
+    assert os.readlink(str(tmp_path / 'x' / 'current')) == final
+    assert sorted(os.listdir(str(tmp_path / 'x'))) == ['current', 'snapshots']
+    assert sorted(os.listdir(str(tmp_path / 'x' / 'snapshots'))) == ['2020-01-01_000000', backup.dest.snapshot]
+
+
+def test_prepare_resumes_a_partial_snapshot(tmp_path):
+    partial = tmp_path / 'x' / 'snapshots' / '2020-01-01_000000.partial'
+    (partial / 'mysqldump').mkdir(parents=True)
+    (partial / 'file').write_text('kept')
+    os.symlink(str(partial), str(tmp_path / 'x' / 'partial'))
+    backup = server(tmp_path)
+    try:
+        backup.prepare()
+    finally:
+        backup.workspace.close()
+    staging = backup.dest.staging_path
+    assert os.listdir(str(tmp_path / 'x' / 'snapshots')) == [os.path.basename(staging)]
+    assert os.listdir(staging) == ['file']
+    assert os.readlink(str(tmp_path / 'x' / 'partial')) == staging
+
+
+def test_link_dests_skips_the_snapshot_current_points_to(tmp_path):
+    tmp_path = tmp_path.resolve()
+    snapshots = tmp_path / 'x' / 'snapshots'
+    for name in ('2020-01-01_000000', '2020-01-02_000000', '2020-01-03_000000'):
+        (snapshots / name).mkdir(parents=True)
+    os.symlink(str(snapshots / '2020-01-03_000000'), str(tmp_path / 'x' / 'current'))
+    backup = server(tmp_path, rsync={'linkDestHistory': 2})
+    # The last two snapshots, current itself is not listed twice
+    assert backup.link_dests() == [str(tmp_path / 'x' / 'current'), str(snapshots / '2020-01-02_000000')]
+
+
+def test_link_unchanged_hard_links_a_previous_dump(tmp_path):
+    old = tmp_path / 'x' / 'snapshots' / '2020-01-01_000000' / 'mysqldump'
+    (old / 'db2' / 'tables').mkdir(parents=True)
+    (old / 'db1.sql.gz').write_bytes(b'dump')
+    (old / 'db2' / 'tables' / 't.sql.gz').write_bytes(b'table')
+    backup = server(tmp_path)
+    backup.prepare()
+    try:
+        os.makedirs(backup.dest.snapshot_path + '/mysqldump')
+        for file in ('mysqldump/db1.sql.gz', 'mysqldump/db2'):
+            assert backup.link_unchanged('db', file, '2020-01-01_000000').linked == '2020-01-01_000000'
+    finally:
+        backup.workspace.close()
+    new = backup.dest.snapshot_path + '/mysqldump/'
+    assert os.path.samefile(str(old / 'db1.sql.gz'), new + 'db1.sql.gz')
+    assert os.path.samefile(str(old / 'db2' / 'tables' / 't.sql.gz'), new + 'db2/tables/t.sql.gz')
+
+
+def test_background_prune_moves_snapshots_to_the_trash(tmp_path):
+    old = tmp_path / 'x' / 'snapshots' / '2020-01-01_000000'
+    (old / 'etc').mkdir(parents=True)
+    backup = server(tmp_path, prune={'background': True})
+    assert backup.delete_snapshots([str(old)]) == {str(old)}
+    assert not old.exists()
+
+
+def test_parallel_rsync_streams_do_not_share_console_progress(tmp_path, monkeypatch, caplog):
+    bin = tmp_path / 'bin'
+    bin.mkdir()
+    (bin / 'rsync').write_text('#!/bin/sh\nfor a; do last="$a"; done\nmkdir -p "$last"\necho "sent $#"\n')
+    (bin / 'rsync').chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin, os.environ['PATH']))
+    for name in ('a', 'b'):
+        (tmp_path / 'src' / name).mkdir(parents=True)
+    files = [str(tmp_path / 'src' / x) + '/' for x in ('a', 'b')]
+    backup = server(tmp_path / 'dest', rsync={'streams': 2}, backup={'files': {'common': files}})
+    backup.prepare()
+    try:
+        backup.backup_files()
+    finally:
+        backup.workspace.close()
+    rsyncs = [x for x in backup.runner.results if x.argv[0] == 'rsync']
+    assert len(rsyncs) == 2
+    assert not any('--progress' in x.argv for x in rsyncs)
+    assert backup.files_complete
+    # Stream output is logged under the stream name instead of written to the console
+    logged = [x.split(' ')[0] for x in caplog.messages if ' sent ' in x]
+    assert sorted(logged) == ['rsync[1/2]', 'rsync[2/2]']
+
+
+def reapers(backup):
+    return [x for x in backup.runner.results if 'nohup' in str(x.argv)]
+
+
+def test_archive_starts_the_reaper_only_when_it_trashed_something(tmp_path):
+    options = {'archive': {'enabled': True, 'olderThan': 2}, 'prune': {'background': True}}
+    (tmp_path / 'x' / 'snapshots').mkdir(parents=True)
+    backup = server(tmp_path, **options)
+    backup.archive_snapshots()
+    assert reapers(backup) == []
+
+    old = tmp_path / 'x' / 'snapshots' / '2020-01-01_000000'
+    old.mkdir()
+    (old / 'hosts').write_text('127.0.0.1 localhost\n')
+    backup = server(tmp_path, **options)
+    backup.archive_snapshots()
+    assert len(reapers(backup)) == 1
+    assert archive.read(str(old), 'hosts') == b'127.0.0.1 localhost\n'
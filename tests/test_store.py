@@ -0,0 +1,61 @@
+import fcntl
+import hashlib
+import os
+import threading
+
+import pytest
+
+from mreschke.serverbackups import log
+from mreschke.serverbackups.store import Store, gc
+
+
+def store(tmp_path):
+    log.init({'console': {'level': 'CRITICAL', 'colors': False}})
+    s = Store(str(tmp_path / '.store'), chunk_size=64)
+    s.load()
+    return s
+
+
+def test_reused_chunk_waits_for_its_upload(tmp_path):
+    s = store(tmp_path)
+    assert s.claim('a' * 64) == 'new'
+    assert s.claim('a' * 64) == 'pending'
+    done = []
+    waiter = threading.Thread(target=lambda: done.append(s.wait(['a' * 64])))
+    waiter.start()
+    waiter.join(0.2)
+    assert not done
+    s.confirm(['a' * 64])
+    waiter.join(1)
+    assert done == [True]
+    assert s.claim('a' * 64) == 'stored'
+    s.close()
+
+
+def test_no_recipe_for_chunks_whose_upload_failed(tmp_path):
+    s = store(tmp_path)
+    data = b'hello\n'
+    # Another output (an ssh upload in progress) claimed the only chunk of this one
+    digest = hashlib.sha256(data).hexdigest()
+    assert s.claim(digest) == 'new'
+    writer = s.writer(str(tmp_path / 'x.recipe'))
+    writer.write(data)
+    closer = threading.Thread(target=lambda: writer.close())
+    closer.start()
+    closer.join(0.2)
+    assert closer.is_alive()
+    s.release([digest])
+    closer.join(1)
+    assert writer.error
+    assert not os.path.exists(str(tmp_path / 'x.recipe'))
+    s.close()
+
+
+def test_gc_refuses_to_run_during_a_backup(tmp_path):
+    s = store(tmp_path)
+    with pytest.raises(OSError):
+        gc(str(tmp_path))
+    s.close()
+    assert gc(str(tmp_path)) == (0, 0, 0)
+    with open(str(tmp_path / '.store' / 'lock')) as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
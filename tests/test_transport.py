@@ -0,0 +1,37 @@
+import pytest
+
+from mreschke.serverbackups.transport import SKIP_COMPRESS, Transport
+
+
+def test_default_profile_keeps_the_historical_arguments():
+    transport = Transport.from_options(None)
+    assert transport.rsync_args() == ['--hard-links', '--compress']
+    assert transport.ssh_args() == []
+
+
+def test_profile_arguments():
+    assert Transport('local').rsync_args() == ['--hard-links', '--whole-file']
+    assert Transport('lan').rsync_args() == ['--hard-links']
+    assert Transport('lan').ssh_args() == ['-c', 'aes128-gcm@openssh.com']
+    assert Transport('wan').rsync_args() == [
+        '--hard-links', '--compress', '--compress-choice=zstd', '--compress-level=3',
+        '--skip-compress=' + '/'.join(SKIP_COMPRESS),
+    ]
+    assert Transport('wan').ssh_args() == ['-c', 'chacha20-poly1305@openssh.com']
+    assert Transport('wan').describe() == (
+        '--hard-links --compress --compress-choice=zstd --compress-level=3 '
+        '--skip-compress=({} suffixes) -c chacha20-poly1305@openssh.com'.format(len(SKIP_COMPRESS))
+    )
+
+
+def test_server_options_override_the_profile():
+    transport = Transport.from_options({
+        'profile': 'wan', 'compress': 'none', 'hardLinks': False, 'checksum': 'xxh128', 'streams': 4,
+    })
+    assert transport.rsync_args() == ['--checksum-choice=xxh128']
+    assert transport.ssh_args() == ['-c', 'chacha20-poly1305@openssh.com']
+    assert Transport.from_options({'profile': None, 'compress': 'lz4'}).rsync_args() == [
+        '--hard-links', '--compress', '--compress-choice=lz4',
+    ]
+    with pytest.raises(ValueError):
+        Transport.from_options({'profile': 'fast'})